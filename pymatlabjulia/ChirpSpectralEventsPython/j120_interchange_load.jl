@@ -0,0 +1,53 @@
+# Open recordings exported by p107_interchange.py (or util_htpBridgeExport.m)
+# without re-parsing the .set file. The samples are memory-mapped as a
+# column-major (channels, samples, epochs) array, the layout NeuroAnalyzer uses.
+#
+# Python side, run once per recording:
+#   python p107_interchange.py   (or export_set("D0113_rest_postica.set"))
+
+using Pkg
+Pkg.add(["JSON"])
+
+using JSON
+using Mmap
+
+const BUFFER_TYPES = Dict(
+    "float32" => Float32, "float64" => Float64,
+    "int8" => Int8, "int16" => Int16, "int32" => Int32, "int64" => Int64,
+    "uint8" => UInt8, "uint16" => UInt16, "uint32" => UInt32, "uint64" => UInt64,
+)
+
+# Memory-map every array of a vhtp-buffer; returns (arrays, meta)
+function read_vhtp_buffer(header_file::AbstractString)
+    header = JSON.parsefile(header_file)
+    header["format"] == "vhtp-buffer" || error("$header_file is not a vhtp-buffer header")
+    buffer_dir = dirname(abspath(header_file))
+    arrays = Dict{String,Any}()
+    for (name, spec) in header["arrays"]
+        T = BUFFER_TYPES[spec["dtype"]]
+        dims = Tuple(Int.(spec["shape"]))
+        # files are little-endian, column-major: the native Julia layout on x86/ARM
+        arrays[name] = open(joinpath(buffer_dir, spec["file"])) do io
+            Mmap.mmap(io, Array{T,length(dims)}, dims)
+        end
+    end
+    return arrays, header["meta"]
+end
+
+# MATLAB jsonencode writes 1x1 struct arrays as objects
+as_vector(x) = x === nothing ? [] : (x isa AbstractVector ? x : [x])
+
+header_file = joinpath(get(ENV, "VHTP_INTERCHANGE_DIR", joinpath(homedir(), ".cache", "vhtp", "interchange")),
+                       "D0113_rest_postica.json")
+
+arrays, meta = read_vhtp_buffer(header_file)
+eeg_data = arrays["data"]                  # channels x samples x epochs, microvolts
+sampling_rate = meta["srate"]
+channel_labels = [String(loc["labels"]) for loc in as_vector(meta["chanlocs"])]
+events = as_vector(meta["event"])
+
+println("$(size(eeg_data, 1)) channels, $(size(eeg_data, 2)) samples, $(size(eeg_data, 3)) epochs @ $(sampling_rate) Hz")
+println("First channels: ", channel_labels[1:min(5, end)])
+
+# only the pages touched here are read from disk
+epoch1 = eeg_data[:, :, 1]
@@ -0,0 +1,447 @@
+# ==============================================================================
+# Stage Instrumentation and Sampling Profiler
+# ==============================================================================
+# Python counterpart of log4vhtp.m for the analysis scripts. Wrap each stage
+# (loading, epoching, PSD, fitting, event detection, export) in ``stage`` and
+# every processed file in ``track_file``/``finish_file`` to record:
+#
+#   wall time, CPU time, peak RSS (reset per stage on Linux), sizes of the
+#   arrays produced, and cache hits/misses counted with ``count``
+#
+# Instrumentation is opt-in: it is on when $VHTP_INSTRUMENT_LOG is set or
+# $VHTP_INSTRUMENT=1 (and $VHTP_INSTRUMENT=0 always turns it off), so library
+# code that calls ``stage``/``count`` costs nothing by default. Each stage and
+# file emits one JSON line. Lines are appended to the $VHTP_INSTRUMENT_LOG file
+# so batch runners can aggregate them across processes; without it the records
+# stay in memory (get_records) and a one-line summary goes to stderr.
+#
+# Setting $VHTP_PROFILE=1 also runs a signal-based sampling profiler (SIGPROF,
+# Unix only) while a file is tracked. The collapsed stacks of the slowest
+# $VHTP_PROFILE_KEEP files (default 5) are kept in $VHTP_PROFILE_DIR as .folded
+# files, which flamegraph.pl, speedscope or inferno render as flamegraphs. The
+# profile index is updated under a file lock, so concurrent workers (p021,
+# p141) do not drop each other's entries.
+#
+# Importing this module has no side effects. Entry points (p020 main, the
+# p15x/p16x scripts) call install_hooks, after which a script that ends without
+# finish_file still gets its file record at exit and an uncaught exception is
+# recorded as status 'error' through sys.excepthook.
+#
+# Peak RSS comes from /proc (Linux), resource (Unix) or psutil (Windows, if
+# installed), and is None where none of them is available.
+#
+# Main Functions Used:
+# 1. stage - Context manager that measures one stage.
+# 2. track_file / finish_file - Per-file scope (and profiler) for a script.
+# 3. instrument_file - Context manager form of track_file/finish_file.
+# 4. count - Cache hit/miss and other counters attributed to the running stage.
+# 5. peak_rss_mb / reset_peak_rss - Peak resident memory helpers.
+# 6. install_hooks - Record unfinished and failed files (entry points only).
+# ==============================================================================
+
+import atexit
+import collections
+import contextlib
+import datetime
+import json
+import os
+import platform
+import signal
+import sys
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+LOG_FILE = os.environ.get('VHTP_INSTRUMENT_LOG')
+ENABLED = os.environ.get('VHTP_INSTRUMENT', '1' if LOG_FILE else '0') == '1'
+PROFILE = os.environ.get('VHTP_PROFILE', '0') == '1'
+PROFILE_DIR = os.environ.get('VHTP_PROFILE_DIR',
+                             os.path.join(os.path.expanduser('~'), '.cache', 'vhtp', 'profiles'))
+PROFILE_KEEP = int(os.environ.get('VHTP_PROFILE_KEEP', '5'))
+PROFILE_INTERVAL = float(os.environ.get('VHTP_PROFILE_INTERVAL', '0.005'))
+
+RUN_ID = uuid.uuid4().hex[:12]
+
+_records = []
+_counters = collections.Counter()
+_stack = []           # open stages (and the file scope) as dicts
+_file_scope = None
+
+# ==============================================================================
+# Memory
+# ==============================================================================
+
+def reset_peak_rss():
+    """Reset the kernel's RSS high-water mark (Linux >= 4.0); False if unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _status_mb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """Peak resident set size in MB (VmHWM, ru_maxrss or psutil; None if unavailable)."""
+    peak = _status_mb('VmHWM:')
+    if peak is not None:
+        return peak
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux
+        return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    # peak_wset is the Windows peak working set; elsewhere only the current RSS exists
+    return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+
+
+def _max_mb(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def rss_mb():
+    """Current resident set size in MB (None where /proc is unavailable)."""
+    return _status_mb('VmRSS:')
+
+# ==============================================================================
+# Records
+# ==============================================================================
+
+def _describe(value):
+    """Shape, dtype and size of an array-like (MNE objects via their data array)."""
+    if hasattr(value, 'memory_usage') and hasattr(value, 'shape'):  # DataFrame
+        return {'shape': list(value.shape), 'nbytes': int(value.memory_usage(deep=False).sum())}
+    data = getattr(value, '_data', value)
+    # numpy is not imported here so importing this module stays stdlib-only;
+    # an ndarray can only exist if numpy is already loaded
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(data, np.ndarray):
+        return {'shape': list(data.shape), 'dtype': data.dtype.name, 'nbytes': int(data.nbytes)}
+    if hasattr(value, '__len__'):
+        return {'len': len(value)}
+    return {'type': type(value).__name__}
+
+
+def _emit(record):
+    _records.append(record)
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(os.path.abspath(LOG_FILE)), exist_ok=True)
+        # One write per line keeps appends from concurrent processes intact
+        with open(LOG_FILE, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    else:
+        label = f"{record['event']}:{record.get('stage', '')}".rstrip(':')
+        peak = record['peak_rss_mb']
+        print(f"[instrument] {label} {os.path.basename(record.get('file') or '')} "
+              f"{record['wall_s']:.3f} s wall, {record['cpu_s']:.3f} s cpu, "
+              f"{'?' if peak is None else f'{peak:.1f}'} MB peak", file=sys.stderr)
+
+
+def get_records():
+    """Records emitted by this process (list of dict)."""
+    return list(_records)
+
+
+def count(name, n=1):
+    """
+    Increment a counter attributed to the running stage and file.
+
+    Use 'name.hit' / 'name.miss' for caches, e.g. count('coreg_cache.hit').
+    """
+    if ENABLED:
+        _counters[name] += n
+
+
+class _Stage:
+    """Handle returned by ``stage``; collects arrays and extra fields."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = dict(fields)
+        self.array_info = {}
+
+    def arrays(self, **arrays):
+        """Record shape/dtype/size of arrays (or MNE objects, DataFrames) produced by the stage."""
+        for key, value in arrays.items():
+            self.array_info[key] = _describe(value)
+
+    def note(self, **fields):
+        """Attach extra JSON-serializable fields to the stage record."""
+        self.fields.update(fields)
+
+
+def _open_scope():
+    # The parent's peak so far must be captured before the high-water mark is reset
+    if _stack:
+        _stack[-1]['peak'] = _max_mb(_stack[-1]['peak'], peak_rss_mb())
+    reset_peak_rss()
+    return {'wall': time.perf_counter(), 'cpu': time.process_time(), 'peak': None,
+            'rss': rss_mb(), 'counters': collections.Counter(_counters)}
+
+
+def _close_scope(scope):
+    peak = _max_mb(scope['peak'], peak_rss_mb())
+    if _stack:
+        _stack[-1]['peak'] = _max_mb(_stack[-1]['peak'], peak)
+    counters = {k: v - scope['counters'].get(k, 0) for k, v in _counters.items()
+                if v != scope['counters'].get(k, 0)}
+    return {'wall_s': time.perf_counter() - scope['wall'], 'cpu_s': time.process_time() - scope['cpu'],
+            'peak_rss_mb': peak, 'rss_start_mb': scope['rss'], 'rss_end_mb': rss_mb(), 'counters': counters}
+
+
+def _base_record(event):
+    return {'event': event, 'run_id': RUN_ID, 'pid': os.getpid(), 'host': platform.node(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='milliseconds'),
+            'file': _file_scope['file'] if _file_scope else None}
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Measure one analysis stage.
+
+    Parameters
+    ----------
+    name : str
+        Stage name ('load', 'epoch', 'psd', 'fit', 'events', 'export', ...).
+    **fields
+        Extra fields stored in the record.
+
+    Yields
+    ------
+    handle
+        ``handle.arrays(name=array)`` records array sizes, ``handle.note(**kw)``
+        adds fields.
+    """
+    handle = _Stage(name, fields)
+    if not ENABLED:
+        yield handle
+        return
+    scope = _open_scope()
+    _stack.append(scope)
+    status, error = 'ok', None
+    try:
+        yield handle
+    except BaseException as e:
+        status, error = 'error', f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _stack.pop()
+        record = _base_record('stage')
+        record.update(stage=name, status=status, **_close_scope(scope),
+                      arrays=handle.array_info, **handle.fields)
+        if error:
+            record['error'] = error
+        _emit(record)
+
+# ==============================================================================
+# Per-File Scope and Sampling Profiler
+# ==============================================================================
+
+class _SamplingProfiler:
+    """SIGPROF sampler that collapses Python stacks into flamegraph lines."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._previous = None
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        if not hasattr(signal, 'setitimer'):
+            return False
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return True
+
+    def stop(self):
+        if hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+    def folded(self):
+        return ''.join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+def _keep_profile(profiler, file, wall_s):
+    """Write the folded stacks if this file is among the slowest PROFILE_KEEP files."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    # Read-modify-write of the index under an exclusive lock: processes
+    # finishing at the same time would otherwise overwrite each other's entries
+    with open(os.path.join(PROFILE_DIR, 'index.lock'), 'w') as lock:
+        # The sampling profiler needs SIGPROF, so profiles are only kept on
+        # Unix, where fcntl is available
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return _update_profile_index(profiler, file, wall_s)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _update_profile_index(profiler, file, wall_s):
+    index_file = os.path.join(PROFILE_DIR, 'index.json')
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = []
+
+    name = f"{os.path.splitext(os.path.basename(file or 'script'))[0]}_{RUN_ID}_{os.getpid()}.folded"
+    index.append({'file': file, 'wall_s': wall_s, 'profile': name})
+    index.sort(key=lambda entry: entry['wall_s'], reverse=True)
+    kept, dropped = index[:PROFILE_KEEP], index[PROFILE_KEEP:]
+
+    if any(entry['profile'] == name for entry in kept):
+        with open(os.path.join(PROFILE_DIR, name), 'w') as f:
+            f.write(profiler.folded())
+    for entry in dropped:
+        path = os.path.join(PROFILE_DIR, entry['profile'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    tmp_file = f"{index_file}.tmp{os.getpid()}"
+    with open(tmp_file, 'w') as f:
+        json.dump(kept, f, indent=2)
+    os.replace(tmp_file, index_file)
+    return os.path.join(PROFILE_DIR, name) if any(e['profile'] == name for e in kept) else None
+
+
+def track_file(file, profile=None, **fields):
+    """
+    Start the per-file scope: later stage records carry this file name.
+
+    Parameters
+    ----------
+    file : str
+        File being processed.
+    profile : bool, optional
+        Run the sampling profiler (defaults to $VHTP_PROFILE).
+    **fields
+        Extra fields stored in the file record.
+    """
+    global _file_scope
+    if not ENABLED:
+        return
+    if _file_scope is not None:
+        finish_file()
+    scope = _open_scope()
+    scope.update(file=file, fields=fields, profiler=None)
+    _file_scope = scope
+    _stack.append(scope)
+    if PROFILE if profile is None else profile:
+        profiler = _SamplingProfiler()
+        if profiler.start():
+            scope['profiler'] = profiler
+
+
+def finish_file(status='ok', error=None):
+    """End the per-file scope and emit its record (no-op if no file is tracked)."""
+    global _file_scope
+    scope = _file_scope
+    if scope is None:
+        return
+    profiler = scope['profiler']
+    if profiler is not None:
+        profiler.stop()
+    if scope in _stack:
+        _stack.remove(scope)
+    record = _base_record('file')
+    record.update(status=status, **_close_scope(scope), **scope['fields'])
+    if error:
+        record['error'] = error
+    if profiler is not None:
+        record['profile'] = _keep_profile(profiler, scope['file'], record['wall_s'])
+    _file_scope = None
+    _emit(record)
+
+
+@contextlib.contextmanager
+def instrument_file(file, profile=None, **fields):
+    """Context manager form of track_file/finish_file."""
+    track_file(file, profile=profile, **fields)
+    try:
+        yield
+    except BaseException as e:
+        finish_file(status='error', error=f"{type(e).__name__}: {e}")
+        raise
+    finish_file()
+
+
+def _excepthook(exc_type, exc, tb):
+    # sys.exc_info() is empty inside atexit handlers, so an uncaught exception
+    # has to close the file scope here to be recorded as a failure
+    try:
+        finish_file(status='error', error=f"{exc_type.__name__}: {exc}")
+    finally:
+        _previous_excepthook(exc_type, exc, tb)
+
+
+_previous_excepthook = None
+
+
+def install_hooks():
+    """
+    Close an open file scope at exit and on an uncaught exception.
+
+    Call from entry points only (CLI main, analysis scripts); importing this
+    module installs nothing. Repeated calls are no-ops.
+    """
+    global _previous_excepthook
+    if _previous_excepthook is not None:
+        return
+    _previous_excepthook = sys.excepthook
+    sys.excepthook = _excepthook
+    # A script that ends without finish_file still gets its file record
+    atexit.register(finish_file)
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    import numpy as np
+
+    ENABLED = True  # the example records even without $VHTP_INSTRUMENT_LOG
+    install_hooks()
+    track_file('example.set', profile=True)
+    with stage('simulate') as st:
+        data = np.random.default_rng(0).standard_normal((64, 200_000))
+        st.arrays(data=data)
+    with stage('psd') as st:
+        spectrum = np.abs(np.fft.rfft(data, axis=-1)) ** 2
+        st.arrays(spectrum=spectrum)
+        count('fft_plan_cache.miss')
+    finish_file()
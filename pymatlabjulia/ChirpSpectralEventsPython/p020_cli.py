@@ -0,0 +1,613 @@
+# ==============================================================================
+# Headless Command-Line Entry Point for the Analysis Stages
+# ==============================================================================
+# One entry point for the compute stages of p150-p161, meant for cluster jobs:
+#
+#   python p020_cli.py psd D0179_chirp.set --method welch multitaper
+#   python p020_cli.py bandpower *.set --output-dir results/ --precision float32
+#   python p020_cli.py bandpower D0179_chirp.set --kinds absolute relative db
+#   python p020_cli.py specparam D0179_chirp.set --freq-range 3 40
+#   python p020_cli.py events D0179_chirp.set --band 7.5 12.5 --threshold 4
+#   python p020_cli.py events D0179_chirp.set --bands Theta Alpha Beta:5 Gamma1
+#   python p020_cli.py events *.set --n-jobs 8 --block-trials 8 --precision float32
+#   python p020_cli.py sweep D0179_chirp.set --thresholds 3 4 5 6 --band-range 8 13
+#   python p020_cli.py export D0179_chirp.set       # vhtp-buffer for MATLAB/Julia
+#   python p020_cli.py filter rest.set --highpass 0.5 --lowpass 80 --notch 55 65
+#
+# Start-up cost is kept to the standard library: every heavy dependency (mne,
+# scipy, pandas, specparam/fooof, joblib) is imported
+# inside the command that needs it, so '--help' or a failing argument check
+# returns immediately and each command only pays for its own packages.
+#
+# The CLI runs headless by default: MPLBACKEND is set to Agg before anything
+# can import matplotlib, seaborn is never imported and pyplot is only loaded
+# for '--plot', which writes PNG files next to the CSV output. '--import-report'
+# lists the heavy modules a run actually loaded.
+#
+# bandpower and events take '--precision float32' to run the p155/p162 engines
+# in single precision (accuracy bounds in p155_psd_engine.py).
+#
+# Each file is tracked with p010_instrument, so setting $VHTP_INSTRUMENT_LOG
+# collects per-stage timings for batch runs (instrumentation is off otherwise).
+#
+# Main Functions Used:
+# 1. load_epochs - Read a .set file as epochs (continuous data is cut into trials).
+# 2. cmd_psd / cmd_bandpower / cmd_specparam / cmd_events / cmd_sweep / cmd_export / cmd_asr /
+#    cmd_filter - Stages.
+# 3. run_job - Run one command on one file (used by the CLI and by workers).
+# 4. main - Argument parsing and dispatch.
+# ==============================================================================
+
+import argparse
+import os
+import sys
+import time
+
+_START = time.perf_counter()
+
+from p010_instrument import install_hooks, instrument_file, stage
+
+# Modules that dominate start-up; reported by --import-report
+HEAVY_MODULES = ['numpy', 'scipy', 'pandas', 'mne', 'matplotlib', 'matplotlib.pyplot',
+                 'seaborn', 'yasa', 'specparam', 'fooof', 'spectralevents', 'joblib']
+
+DEFAULT_BANDS = [(2, 3.5, 'Delta'), (3.5, 7, 'Theta'), (7.5, 12.5, 'Alpha'), (7.5, 10.5, 'Alpha1'),
+                 (10.5, 12.5, 'Alpha2'), (15, 30, 'Beta'), (30, 55, 'Gamma1'), (65, 80, 'Gamma2')]
+
+
+def set_headless(headless=True):
+    """
+    Select the non-interactive Agg backend before matplotlib can be imported.
+
+    Parameters
+    ----------
+    headless : bool
+        If False the environment is left unchanged.
+    """
+    if headless:
+        os.environ['MPLBACKEND'] = 'Agg'
+
+
+def loaded_heavy_modules():
+    """Names of the heavy modules imported so far in this process."""
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+# ==============================================================================
+# Loading
+# ==============================================================================
+
+def load_epochs(set_file, points_per_trial=1626, n_trials=80, reject=None):
+    """
+    Read an EEGLAB .set file as MNE Epochs.
+
+    Epoched files are read as is; continuous files are cut into fixed-length
+    trials of ``points_per_trial`` samples as in p150-p161.
+
+    Parameters
+    ----------
+    set_file : str
+        EEGLAB .set file.
+    points_per_trial : int
+        Samples per trial for continuous recordings.
+    n_trials : int | None
+        Keep only the first n trials (None keeps all).
+    reject : dict | None
+        Amplitude thresholds in microvolts (see
+        p115_trial_rejection.rejection_mask); n_trials then counts clean trials.
+
+    Returns
+    -------
+    mne.Epochs
+        Loaded epochs.
+    """
+    import mne
+
+    with stage('load') as st:
+        try:
+            epochs = mne.io.read_epochs_eeglab(set_file, verbose=False)
+        except ValueError:
+            raw = mne.io.read_raw_eeglab(set_file, preload=True, verbose=False)
+            st.arrays(raw=raw)
+            epochs = None
+    if epochs is None:
+        with stage('epoch') as st:
+            epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial / raw.info['sfreq'],
+                                                  preload=True, verbose=False)
+            st.arrays(epochs=epochs)
+    if reject:
+        from p115_trial_rejection import screen_trials
+
+        with stage('reject') as st:
+            keep, _, _ = screen_trials(epochs.get_data(copy=False) * 1e6, n_trials, **reject)
+            epochs = epochs[keep]
+            st.arrays(epochs=epochs)
+    elif n_trials is not None:
+        epochs = epochs[:n_trials]
+    return epochs
+
+
+def _reject(args):
+    # Trial rejection thresholds given on the command line, or None
+    reject = {key: getattr(args, option) for key, option in
+              (('ptp', 'reject_ptp'), ('max_abs', 'reject_max_abs'),
+               ('amp_threshold', 'amp_threshold'), ('sd_threshold', 'reject_sd'))
+              if getattr(args, option, None) is not None}
+    return reject or None
+
+
+def _output_file(set_file, output_dir, suffix, ext='.csv'):
+    base = os.path.splitext(os.path.basename(set_file))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(output_dir, f"{base}_{suffix}{ext}")
+
+# ==============================================================================
+# Commands
+# ==============================================================================
+# Each command takes the input file and the parsed options and returns the list
+# of files it wrote.
+
+def cmd_psd(set_file, args):
+    """Welch and/or multitaper PSD per epoch and channel (p150)."""
+    import pandas as pd
+
+    epochs = load_epochs(set_file, args.points_per_trial, args.n_trials, _reject(args))
+    frames = []
+    for method in args.method:
+        with stage('psd', method=method) as st:
+            if method == 'multitaper':
+                # Cached tapers, all epochs x channels in one batch (p156)
+                from p156_multitaper import compute_multitaper, psd_to_frame
+
+                psd, freqs, ch_names = compute_multitaper(epochs, args.fmin, args.fmax)
+                st.arrays(psd=psd)
+                df = psd_to_frame(psd, freqs, ch_names, epochs)
+            else:
+                psd = epochs.compute_psd(method=method, fmin=args.fmin, fmax=args.fmax,
+                                         picks='eeg', verbose=False)
+                st.arrays(psd=psd)
+                df = psd.to_data_frame()
+        df.insert(0, 'Filename', os.path.basename(set_file))
+        df.insert(1, 'Method', method.capitalize())
+        frames.append(df)
+
+    out_file = _output_file(set_file, args.output_dir, 'pow_spectrum')
+    with stage('export'):
+        pd.concat(frames, ignore_index=True).to_csv(out_file, index=False)
+    written = [out_file]
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(figsize=(7, 5))
+        for df in frames:
+            mean_psd = df.drop(columns=['Filename', 'Method', 'epoch', 'condition'], errors='ignore') \
+                         .groupby('freq').mean().mean(axis=1)
+            ax.semilogy(mean_psd.index, mean_psd.values, label=df['Method'].iloc[0])
+        ax.set_xlabel('Frequency (Hz)')
+        ax.set_ylabel('Power Spectral Density')
+        ax.set_title(os.path.basename(set_file))
+        ax.legend()
+        fig.tight_layout()
+        png_file = _output_file(set_file, args.output_dir, 'pow_spectrum', '.png')
+        fig.savefig(png_file)
+        plt.close(fig)
+        written.append(png_file)
+    return written
+
+
+def cmd_bandpower(set_file, args):
+    """Bandpower per epoch and channel from a Welch PSD (p152)."""
+    import numpy as np
+    import pandas as pd
+    from p155_psd_engine import load_trials, welch_psd
+    from p157_band_integrator import BandIntegrator
+
+    with stage('load') as st:
+        data, sf, ch_names = load_trials(set_file, args.points_per_trial, args.n_trials, args.precision, _reject(args))
+        st.arrays(data=data)  # (epochs, channels, times)
+
+    # scipy.signal.welch defaults: Hann window, 50 % overlap
+    n_per_seg = int(args.window * sf)
+    with stage('psd', method='welch', precision=args.precision) as st:
+        freqs, psd = welch_psd(data, sf, n_fft=n_per_seg, n_overlap=n_per_seg // 2, window='hann')
+        st.arrays(psd=psd)
+    with stage('bandpower', kinds=','.join(args.kinds)) as st:
+        # One prefix-sum index over the PSD answers every kind (p157)
+        index = BandIntegrator(psd, freqs)
+        bandpower = np.concatenate([np.round(index.power(DEFAULT_BANDS, kind), 6) for kind in args.kinds])
+        st.arrays(bandpower=bandpower)
+
+    # (kinds x bands, epochs, channels) -> one row per channel and epoch
+    names = [band[2] for band in DEFAULT_BANDS]
+    if args.kinds != ['relative']:
+        names = [f"{kind}_{name}" for kind in args.kinds for name in names]
+    n_epochs, n_channels = bandpower.shape[1:]
+    df = pd.DataFrame(bandpower.transpose(2, 1, 0).reshape(-1, len(names)), columns=names)
+    df.insert(0, 'Channel', np.repeat(ch_names, n_epochs))
+    df.insert(1, 'Epoch', np.tile(np.arange(1, n_epochs + 1), n_channels))
+    df.insert(0, 'filename', os.path.basename(set_file))
+
+    out_file = _output_file(set_file, args.output_dir, 'bandpower')
+    with stage('export'):
+        df.to_csv(out_file, index=False)
+    return [out_file]
+
+
+def cmd_specparam(set_file, args):
+    """Aperiodic and peak parameters per channel of the mean Welch PSD (p153)."""
+    import pandas as pd
+    try:
+        from specparam import SpectralGroupModel as GroupModel
+    except ImportError:
+        from fooof import FOOOFGroup as GroupModel
+
+    epochs = load_epochs(set_file, args.points_per_trial, args.n_trials, _reject(args))
+    with stage('psd', method='welch') as st:
+        psd = epochs.compute_psd(method='welch', fmin=1, fmax=80, picks='eeg', verbose=False)
+        spectra, freqs = psd.get_data(return_freqs=True)
+        spectra = spectra.mean(axis=0)
+        st.arrays(spectra=spectra)
+
+    fg = GroupModel(peak_width_limits=[1.0, 8.0], max_n_peaks=8, verbose=False)
+    with stage('fit', model=GroupModel.__name__) as st:
+        fg.fit(freqs, spectra, list(args.freq_range))
+        st.note(n_spectra=len(spectra))
+
+    df = pd.DataFrame({
+        'Filename': os.path.basename(set_file),
+        'Channel': psd.ch_names,
+        'Offset': fg.get_params('aperiodic_params', 'offset'),
+        'Exponent': fg.get_params('aperiodic_params', 'exponent'),
+        'R_Squared': fg.get_params('r_squared'),
+        'Error': fg.get_params('error'),
+    })
+    out_file = _output_file(set_file, args.output_dir, 'specparam')
+    with stage('export'):
+        df.to_csv(out_file, index=False)
+    return [out_file]
+
+
+def _event_bands(args):
+    """Bands and per-band FOM thresholds from --bands NAME[:FOM] or --band FMIN FMAX."""
+    if not args.bands:
+        lo, hi = args.band
+        name = f"{lo:g}-{hi:g}"
+        return [(lo, hi, name)], {name: args.threshold}
+    known = {band[2].lower(): band for band in DEFAULT_BANDS}
+    bands, thresholds = [], {}
+    for spec in args.bands:
+        name, _, fom = spec.partition(':')
+        if name.lower() not in known:
+            raise ValueError(f"Unknown band '{name}'; use one of {[band[2] for band in DEFAULT_BANDS]}.")
+        band = known[name.lower()]
+        bands.append(band)
+        thresholds[band[2]] = float(fom) if fom else args.threshold
+    return bands, thresholds
+
+
+def _channel_events(chan_data, freqs, sf, times, bands, thresholds, precision=None, block_trials=0):
+    import numpy as np
+    import pandas as pd
+    from p155_psd_engine import resolve_dtype
+    from p162_wavelet_bank import tfr
+    from p163_spectral_events import (events_to_frame, find_band_events, median_power,
+                                      stream_band_events, trial_power)
+
+    dtype = resolve_dtype(precision)
+    if block_trials:
+        # TFR in trial blocks; same events, memory bounded by the block size
+        events, _, band_powers = stream_band_events(chan_data, freqs, sf, bands, thresholds,
+                                                    block_trials=block_trials, dtype=dtype, times=times)
+    else:
+        # One TFR and one median per channel for all bands
+        tfrs = tfr(chan_data, freqs, sf, dtype=dtype)
+        med_powers = median_power(tfrs)
+        events = find_band_events(tfrs, times, freqs, bands, threshold_FOM=thresholds, med_powers=med_powers)
+        band_powers = np.array([trial_power(tfrs, freqs, band, med_powers) for band in bands])
+    n_trials = len(chan_data)
+    powers = pd.DataFrame({'Band': np.repeat([name for _, _, name in bands], n_trials),
+                           'Trial': np.tile(np.arange(n_trials), len(bands)),
+                           'Trial_Power': band_powers.ravel()})
+    return events_to_frame(events), powers
+
+
+def cmd_events(set_file, args):
+    """Spectral events and their per-channel summary (p160/p161, p163)."""
+    import numpy as np
+    import pandas as pd
+    from p163_spectral_events import SPECTRALEVENTS_COLUMNS, summarize_events
+
+    epochs = load_epochs(set_file, args.points_per_trial, args.n_trials, _reject(args))
+    sf = epochs.info['sfreq']
+    epoch_data = epochs.get_data()
+    freqs = np.arange(args.fmin, args.fmax + 1, 1)
+    times = np.arange(epoch_data.shape[-1]) / sf
+    channels = range(epoch_data.shape[1])
+    bands, thresholds = _event_bands(args)
+
+    with stage('events', n_channels=len(channels), n_bands=len(bands)) as st:
+        if args.n_jobs == 1:
+            results = [_channel_events(epoch_data[:, ch, :], freqs, sf, times, bands, thresholds,
+                                       args.precision, args.block_trials)
+                       for ch in channels]
+        else:
+            from joblib import Parallel, delayed
+            results = Parallel(n_jobs=args.n_jobs)(
+                delayed(_channel_events)(epoch_data[:, ch, :], freqs, sf, times, bands, thresholds,
+                                         args.precision, args.block_trials)
+                for ch in channels)
+        for ch, (df, powers) in zip(channels, results):
+            df.insert(0, 'Filename', os.path.basename(set_file))
+            df.insert(0, 'Channel_Number', ch)
+            powers.insert(0, 'Channel_Number', ch)
+        events_df = pd.concat([df for df, _ in results], ignore_index=True)
+        st.arrays(epoch_data=epoch_data, spec_events=events_df)
+
+    with stage('summary') as st:
+        summary_df = summarize_events(events_df, len(epoch_data), epoch_data.shape[-1] / sf,
+                                      pd.concat([powers for _, powers in results], ignore_index=True),
+                                      by=['Channel_Number', 'Band'])
+        summary_df.insert(1, 'Channel', [epochs.ch_names[ch] for ch in summary_df['Channel_Number']])
+        summary_df.insert(0, 'Filename', os.path.basename(set_file))
+        st.arrays(summary=summary_df)
+
+    out_file = _output_file(set_file, args.output_dir, 'spectral_events')
+    summary_file = _output_file(set_file, args.output_dir, 'spectral_events_summary')
+    with stage('export'):
+        # Event columns keep the spectralevents names, as p160/p161 write them
+        events_df.rename(columns=SPECTRALEVENTS_COLUMNS).to_csv(out_file, index=False)
+        summary_df.to_csv(summary_file, index=False)
+    return [out_file, summary_file]
+
+
+def _channel_sweep(chan_data, freqs, sf, times, bands, thresholds, precision=None):
+    from p155_psd_engine import resolve_dtype
+    from p162_wavelet_bank import tfr
+    from p163_spectral_events import sweep_summary
+
+    return sweep_summary(tfr(chan_data, freqs, sf, dtype=resolve_dtype(precision)), times, freqs, bands, thresholds)
+
+
+def cmd_sweep(set_file, args):
+    """Spectral event summaries over a grid of FOM thresholds and bands (p163)."""
+    import numpy as np
+    import pandas as pd
+
+    known = {band[2].lower(): band for band in DEFAULT_BANDS}
+    unknown = [name for name in args.bands if name.lower() not in known]
+    if unknown:
+        raise ValueError(f"Unknown band(s) {unknown}; use {[band[2] for band in DEFAULT_BANDS]}.")
+    bands = [known[name.lower()] for name in args.bands]
+    bands += [(lo, hi, f"{lo:g}-{hi:g}") for lo, hi in args.band_range or []]
+
+    epochs = load_epochs(set_file, args.points_per_trial, args.n_trials, _reject(args))
+    sf = epochs.info['sfreq']
+    epoch_data = epochs.get_data()
+    freqs = np.arange(args.fmin, args.fmax + 1, 1)
+    times = np.arange(epoch_data.shape[-1]) / sf
+
+    frames = []
+    with stage('sweep', n_channels=len(epochs.ch_names), n_points=len(bands) * len(args.thresholds)) as st:
+        for ch, name in enumerate(epochs.ch_names):
+            df = _channel_sweep(epoch_data[:, ch, :], freqs, sf, times, bands, args.thresholds, args.precision)
+            df.insert(0, 'Channel', name)
+            df.insert(0, 'Channel_Number', ch)
+            frames.append(df)
+        sweep_df = pd.concat(frames, ignore_index=True)
+        sweep_df.insert(0, 'Filename', os.path.basename(set_file))
+        st.arrays(sweep=sweep_df)
+
+    out_file = _output_file(set_file, args.output_dir, 'spectral_events_sweep')
+    with stage('export'):
+        sweep_df.to_csv(out_file, index=False)
+    return [out_file]
+
+
+def cmd_export(set_file, args):
+    """vhtp-buffer interchange files for MATLAB and Julia (p107)."""
+    from p107_interchange import export_set
+
+    with stage('export'):
+        header_file = export_set(set_file, directory=args.output_dir, overwrite=args.overwrite)
+    return [header_file]
+
+
+def cmd_asr(set_file, args):
+    """Artifact subspace reconstruction of a continuous recording into a p106 buffer (p116)."""
+    from p116_asr_stream import asr_clean_set
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    header_file = asr_clean_set(set_file, directory=args.output_dir, cutoff=args.cutoff,
+                                ref_seconds=args.ref_seconds, highpass=args.highpass, max_mem=args.max_mem)
+    return [header_file]
+
+
+def cmd_filter(set_file, args):
+    """Fused FIR filtering of a .set recording into a p106 buffer (p117)."""
+    from p117_filter_bank import filter_set
+
+    specs = []
+    if args.highpass is not None:
+        specs.append(('highpass', args.highpass))
+    if args.lowpass is not None:
+        specs.append(('lowpass', args.lowpass))
+    specs += [('bandpass', lo, hi) for lo, hi in args.bandpass or []]
+    specs += [('notch', lo, hi) for lo, hi in args.notch or []]
+    if not specs:
+        raise ValueError("filter needs at least one of --highpass, --lowpass, --bandpass, --notch")
+    os.makedirs(args.output_dir, exist_ok=True)
+    return [filter_set(set_file, specs, directory=args.output_dir, design=args.design,
+                       block_seconds=args.block_seconds)]
+
+# ==============================================================================
+# Argument Parsing
+# ==============================================================================
+
+def _add_trial_options(parser):
+    parser.add_argument('--points-per-trial', type=int, default=1626,
+                        help='samples per trial when cutting continuous data (default: 1626)')
+    parser.add_argument('--n-trials', type=int, default=80,
+                        help='keep the first n trials; 0 keeps all (default: 80)')
+    parser.add_argument('--reject-ptp', type=float, default=None,
+                        help='drop trials with a channel peak-to-peak above this (uV)')
+    parser.add_argument('--reject-max-abs', type=float, default=None,
+                        help='drop trials with a channel |amplitude| above this (uV)')
+    parser.add_argument('--amp-threshold', type=float, default=None,
+                        help='drop trials with a channel |mean| above this (uV), as ampThreshold in MATLAB')
+    parser.add_argument('--reject-sd', type=float, default=None,
+                        help='drop trials with a channel mean |amplitude| above the channel mean + n SD '
+                             '(3 for source/MEA data in MATLAB)')
+
+
+def _add_precision_option(parser):
+    parser.add_argument('--precision', choices=['float64', 'float32'], default=None,
+                        help='compute dtype (default: $VHTP_PRECISION or float64)')
+
+
+def build_parser():
+    """Argument parser with one subcommand per analysis stage."""
+    parser = argparse.ArgumentParser(
+        prog='p020_cli.py', description='Headless vHTP spectral analysis stages.')
+    parser.add_argument('--output-dir', default='.', help='directory for output files (default: .)')
+    parser.add_argument('--plot', action='store_true',
+                        help='also write figures (imports matplotlib with the Agg backend)')
+    parser.add_argument('--import-report', action='store_true',
+                        help='print start-up time and the heavy modules that were loaded')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('psd', help='power spectral density (p150)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--method', nargs='+', choices=['welch', 'multitaper'], default=['welch'])
+    p.add_argument('--fmin', type=float, default=0.5)
+    p.add_argument('--fmax', type=float, default=80)
+    _add_trial_options(p)
+    p.set_defaults(func=cmd_psd)
+
+    p = sub.add_parser('bandpower', help='bandpower per epoch (p152)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--window', type=float, default=1.0, help='Welch window in seconds (default: 1)')
+    p.add_argument('--kinds', nargs='+', choices=['absolute', 'relative', 'db'], default=['relative'],
+                   help='power columns; more than one prefixes the band names, e.g. absolute_Alpha')
+    _add_trial_options(p)
+    _add_precision_option(p)
+    p.set_defaults(func=cmd_bandpower)
+
+    p = sub.add_parser('specparam', help='aperiodic fit per channel (p153, requires specparam or fooof)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--freq-range', type=float, nargs=2, default=[3, 40], metavar=('FMIN', 'FMAX'))
+    _add_trial_options(p)
+    p.set_defaults(func=cmd_specparam)
+
+    p = sub.add_parser('events', help='spectral events per channel (p160/p161)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--band', type=float, nargs=2, default=[7.5, 12.5], metavar=('FMIN', 'FMAX'))
+    p.add_argument('--bands', nargs='+', metavar='NAME[:FOM]',
+                   help='detect in several bands of the default band list from one TFR, '
+                        'e.g. Theta Alpha:4 Beta Gamma1 (overrides --band)')
+    p.add_argument('--threshold', type=float, default=4.0, help='factor-of-the-median threshold')
+    p.add_argument('--fmin', type=int, default=1)
+    p.add_argument('--fmax', type=int, default=60)
+    p.add_argument('--n-jobs', type=int, default=1, help='channels processed in parallel (joblib)')
+    p.add_argument('--block-trials', type=int, default=0,
+                   help='compute the TFR in blocks of this many trials to cap memory; 0 = all at once')
+    _add_trial_options(p)
+    _add_precision_option(p)
+    p.set_defaults(func=cmd_events)
+
+    p = sub.add_parser('sweep', help='spectral event summaries over FOM thresholds and band edges (p163)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--thresholds', type=float, nargs='+', default=[2, 3, 4, 5, 6],
+                   help='factor-of-the-median thresholds (default: 2 3 4 5 6)')
+    p.add_argument('--bands', nargs='*', default=['Alpha'], help='bands of the default band list (default: Alpha)')
+    p.add_argument('--band-range', type=float, nargs=2, action='append', metavar=('FMIN', 'FMAX'),
+                   help='extra band edges to test; may be repeated')
+    p.add_argument('--fmin', type=int, default=1)
+    p.add_argument('--fmax', type=int, default=60)
+    _add_trial_options(p)
+    _add_precision_option(p)
+    p.set_defaults(func=cmd_sweep)
+
+    p = sub.add_parser('export', help='vhtp-buffer interchange files (p107)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--overwrite', action='store_true')
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser('asr', help='artifact subspace reconstruction of continuous data (p116)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--cutoff', type=float, default=20, help='burst criterion in SD (default: 20)')
+    p.add_argument('--ref-seconds', type=float, default=300,
+                   help='initial span searched for clean calibration data (default: 300)')
+    p.add_argument('--highpass', type=float, default=None,
+                   help='zero-phase FIR high-pass edge in Hz (p117) for data that is not yet filtered')
+    p.add_argument('--max-mem', type=float, default=64, help='working memory per chunk in MB (default: 64)')
+    p.set_defaults(func=cmd_asr)
+
+    p = sub.add_parser('filter', help='fused FIR high-/low-/band-pass and notch filtering (p117)')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--highpass', type=float, default=None, help='high-pass edge in Hz')
+    p.add_argument('--lowpass', type=float, default=None, help='low-pass edge in Hz')
+    p.add_argument('--bandpass', type=float, nargs=2, action='append', metavar=('LO', 'HI'),
+                   help='band-pass edges in Hz; may be repeated')
+    p.add_argument('--notch', type=float, nargs=2, action='append', metavar=('LO', 'HI'),
+                   help='band-stop edges in Hz, e.g. 55 65 for line noise; may be repeated')
+    p.add_argument('--design', choices=['firws', 'firwin'], default='firws',
+                   help='pop_eegfiltnew (firws) or MNE (firwin) kernel design (default: firws)')
+    p.add_argument('--block-seconds', type=float, default=10.0,
+                   help='length of the blocks read from disk in s (default: 10)')
+    p.set_defaults(func=cmd_filter)
+    return parser
+
+
+def run_job(func, set_file, args):
+    """
+    Run one command on one file inside an instrumented file scope.
+
+    Parameters
+    ----------
+    func : callable
+        Command function (cmd_psd, cmd_events, ...).
+    set_file : str
+        Input .set file.
+    args : argparse.Namespace
+        Parsed options.
+
+    Returns
+    -------
+    list of str
+        Files written by the command.
+    """
+    if getattr(args, 'n_trials', None) == 0:
+        args.n_trials = None
+    with instrument_file(set_file, command=args.command):
+        return func(set_file, args)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    install_hooks()
+    # Figures are only ever written to files, so Agg is used with --plot as well
+    set_headless()
+
+    status = 0
+    for set_file in args.files:
+        print(f"Processing file: {os.path.basename(set_file)}")
+        try:
+            for out_file in run_job(args.func, set_file, args):
+                print(f"  wrote {out_file}")
+        except ImportError as err:
+            sys.exit(f"{args.command} requires a package that is not installed: {err.name}")
+        except Exception as err:
+            print(f"  failed: {type(err).__name__}: {err}", file=sys.stderr)
+            status = 1
+
+    if args.import_report:
+        print(f"Elapsed {time.perf_counter() - _START:.2f} s; heavy modules loaded: "
+              f"{', '.join(loaded_heavy_modules()) or 'none'}")
+    return status
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,349 @@
+# ==============================================================================
+# Persistent Warm Worker for the Analysis Stages
+# ==============================================================================
+# Every script run (and every p020_cli.py call) is a new process that imports
+# MNE, SciPy and pandas again and rebuilds the caches the stages keep in memory
+# (DPSS tapers in p156, wavelet banks in p162, filter kernels in p117). For a
+# scheduler that submits many small per-file jobs, that start-up cost dominates.
+#
+# This module runs a long-lived worker service on a Unix socket. Its process
+# pool is started from a forkserver that has already imported the heavy
+# packages, and the pool processes stay alive between jobs, so module-level
+# caches built by one job are reused by the next one on the same process.
+#
+# Protocol: the client sends one JSON object per line and receives JSON lines
+# back, one per finished file as soon as it is done, then a final 'done' line.
+#
+#   -> {"id": "job1", "command": "psd", "files": ["a.set", "b.set"],
+#       "options": ["--method", "welch"], "output_dir": "results"}
+#   <- {"id": "job1", "file": "a.set", "status": "ok", "outputs": [...], "wall_s": 0.8}
+#   <- {"id": "job1", "file": "b.set", "status": "error", "error": "..."}
+#   <- {"id": "job1", "done": true, "n_ok": 1, "n_error": 1}
+#
+# Commands and options are those of p020_cli.py. {"command": "ping"} reports
+# the worker status and {"command": "shutdown"} stops the service.
+#
+# A pool process that dies (out of memory, segfault) breaks the whole
+# ProcessPoolExecutor. The files it held are reported as errors and the pool
+# is started again, so the service keeps accepting jobs.
+#
+# Usage:
+#   python p021_worker.py serve --workers 4 &
+#   python p021_worker.py submit psd a.set b.set --output-dir results -- --method welch
+#
+# Main Functions Used:
+# 1. serve - Start the worker service on a Unix socket.
+# 2. submit - Send a job and yield the streamed results.
+# 3. ping / shutdown - Service status and shutdown.
+# ==============================================================================
+
+import argparse
+import importlib
+import json
+import multiprocessing as mp
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+DEFAULT_SOCKET = os.environ.get('VHTP_WORKER_SOCKET',
+                                os.path.join(os.path.expanduser('~'), '.cache', 'vhtp', 'worker.sock'))
+
+# Imported once in the forkserver; missing optional packages are skipped
+WARM_MODULES = ['numpy', 'scipy.signal', 'scipy.io', 'pandas', 'mne', 'mne.io', 'mne.epochs',
+                'mne.time_frequency', 'yasa', 'specparam', 'fooof', 'spectralevents', 'joblib',
+                'p020_cli', 'p116_asr_stream', 'p117_filter_bank', 'p156_multitaper', 'p162_wavelet_bank',
+                'p163_spectral_events']
+
+# ==============================================================================
+# Pool Side
+# ==============================================================================
+
+def warm_imports(modules=None):
+    """
+    Import the heavy modules so later jobs do not pay for them.
+
+    Parameters
+    ----------
+    modules : list of str | None
+        Modules to import. Defaults to WARM_MODULES.
+
+    Returns
+    -------
+    list of str
+        Modules that were imported (uninstalled ones are skipped).
+    """
+    loaded = []
+    for name in WARM_MODULES if modules is None else modules:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except ImportError:
+            pass
+    return loaded
+
+
+def _run_file(command, set_file, options, output_dir):
+    """Run one p020_cli command on one file inside a pool process."""
+    from p020_cli import build_parser, run_job
+
+    start = time.perf_counter()
+    result = {'file': set_file, 'pid': os.getpid()}
+    try:
+        args = build_parser().parse_args(['--output-dir', output_dir, command, set_file, *options])
+        result['outputs'] = run_job(args.func, set_file, args)
+        result['status'] = 'ok'
+    except SystemExit:
+        # argparse reports bad options by exiting; keep the worker alive
+        result.update(status='error', error=f"invalid options for {command}: {options}")
+    except Exception as err:
+        result.update(status='error', error=f"{type(err).__name__}: {err}")
+    result['wall_s'] = round(time.perf_counter() - start, 4)
+    return result
+
+# ==============================================================================
+# Service
+# ==============================================================================
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def _send(self, message):
+        self.wfile.write((json.dumps(message, default=str) + '\n').encode())
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as err:
+                self._send({'done': True, 'status': 'error', 'error': f"invalid JSON: {err}"})
+                continue
+            job_id = job.get('id') or uuid.uuid4().hex[:8]
+            command = job.get('command')
+
+            if command == 'ping':
+                self._send({'id': job_id, 'done': True, **self.server.status()})
+            elif command == 'shutdown':
+                self._send({'id': job_id, 'done': True, 'status': 'shutting down'})
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+            else:
+                self._run_job(job_id, command, job)
+
+    def _run_job(self, job_id, command, job):
+        options = [str(opt) for opt in job.get('options', [])]
+        output_dir = job.get('output_dir', '.')
+        futures = {}
+        for set_file in job.get('files', []):
+            futures[self.server.submit(_run_file, command, set_file, options, output_dir)] = set_file
+        self.server.jobs_started += len(futures)
+        counts = {'ok': 0, 'error': 0}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool as err:
+                # A pool process died; this file fails and the pool is replaced
+                result = {'file': futures[future], 'status': 'error',
+                          'error': f"worker process died: {err}"}
+                self.server.restart_pool()
+            counts[result['status']] += 1
+            self._send({'id': job_id, **result})
+        self._send({'id': job_id, 'done': True, 'n_ok': counts['ok'], 'n_error': counts['error']})
+
+
+class WorkerServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server that hands jobs to a warm process pool."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, n_workers=None, modules=None):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+        super().__init__(socket_path, _Handler)
+        self.socket_path = socket_path
+        self.started = time.time()
+        self.jobs_started = 0
+        self.pool_restarts = 0
+        self.modules = modules
+        self._pool_lock = threading.Lock()
+
+        # The forkserver imports the heavy modules once; every pool process is
+        # forked from it with those modules already loaded
+        self._ctx = mp.get_context('forkserver')
+        self._ctx.set_forkserver_preload(WARM_MODULES if modules is None else modules)
+        self.n_workers = n_workers or os.cpu_count()
+        self.pool = self._start_pool()
+
+    def _start_pool(self):
+        pool = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=self._ctx,
+                                   initializer=warm_imports, initargs=(self.modules,))
+        # Start the pool processes now rather than on the first job
+        for future in [pool.submit(os.getpid) for _ in range(self.n_workers)]:
+            future.result()
+        return pool
+
+    def restart_pool(self):
+        """Replace the pool if a process died (no-op if it is healthy)."""
+        with self._pool_lock:
+            if not self.pool._broken:
+                return
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = self._start_pool()
+            self.pool_restarts += 1
+
+    def submit(self, fn, *args):
+        """Submit to the pool, replacing it first if it is broken."""
+        try:
+            return self.pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self.restart_pool()
+            return self.pool.submit(fn, *args)
+
+    def status(self):
+        return {'status': 'ok', 'pid': os.getpid(), 'workers': self.n_workers,
+                'uptime_s': round(time.time() - self.started, 1), 'files_submitted': self.jobs_started,
+                'pool_restarts': self.pool_restarts}
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def serve(socket_path=DEFAULT_SOCKET, n_workers=None, modules=None):
+    """
+    Run the worker service until a shutdown request or Ctrl-C.
+
+    Parameters
+    ----------
+    socket_path : str
+        Unix socket to listen on. Defaults to $VHTP_WORKER_SOCKET or
+        ~/.cache/vhtp/worker.sock.
+    n_workers : int | None
+        Pool processes. Defaults to the number of CPUs.
+    modules : list of str | None
+        Modules to import before accepting jobs. Defaults to WARM_MODULES.
+    """
+    start = time.perf_counter()
+    with WorkerServer(socket_path, n_workers, modules) as server:
+        print(f"Worker ready on {socket_path} ({server.n_workers} processes, "
+              f"warm-up {time.perf_counter() - start:.1f} s)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    print("Worker stopped")
+
+# ==============================================================================
+# Client Side
+# ==============================================================================
+
+def _request(message, socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        with sock.makefile('r') as reply:
+            for line in reply:
+                result = json.loads(line)
+                yield result
+                if result.get('done'):
+                    return
+
+
+def submit(command, files, options=(), output_dir='.', socket_path=DEFAULT_SOCKET, job_id=None):
+    """
+    Submit a job to a running worker and yield results as files finish.
+
+    Parameters
+    ----------
+    command : str
+        p020_cli.py command ('psd', 'bandpower', 'specparam', 'events', 'export').
+    files : list of str
+        Input .set files.
+    options : sequence of str
+        Command options as on the p020_cli.py command line.
+    output_dir : str
+        Output directory for the results.
+    socket_path : str
+        Unix socket of the worker.
+    job_id : str | None
+        Identifier echoed in every reply.
+
+    Yields
+    ------
+    dict
+        One result per file ('file', 'status', 'outputs' or 'error', 'wall_s'),
+        then a summary with 'done' set.
+    """
+    message = {'id': job_id or uuid.uuid4().hex[:8], 'command': command,
+               'files': [os.path.abspath(f) for f in files], 'options': list(options),
+               'output_dir': os.path.abspath(output_dir)}
+    yield from _request(message, socket_path)
+
+
+def ping(socket_path=DEFAULT_SOCKET):
+    """Status of a running worker (raises OSError if none is listening)."""
+    return next(_request({'command': 'ping'}, socket_path))
+
+
+def shutdown(socket_path=DEFAULT_SOCKET):
+    """Ask a running worker to stop."""
+    return next(_request({'command': 'shutdown'}, socket_path))
+
+# ==============================================================================
+# Command Line
+# ==============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='p021_worker.py', description='Warm vHTP analysis worker.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'Unix socket (default: {DEFAULT_SOCKET})')
+    sub = parser.add_subparsers(dest='action', required=True)
+    p = sub.add_parser('serve', help='start the worker service')
+    p.add_argument('--workers', type=int, default=None, help='pool processes (default: CPU count)')
+    p = sub.add_parser('submit', help="run a p020_cli.py command on the worker; its options follow '--'")
+    p.add_argument('command')
+    p.add_argument('files', nargs='+')
+    p.add_argument('--output-dir', default='.')
+    sub.add_parser('ping', help='show worker status')
+    sub.add_parser('shutdown', help='stop the worker')
+    # Everything after '--' is passed through to the p020_cli.py command
+    argv = sys.argv[1:] if argv is None else list(argv)
+    options = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, options = argv[:split], argv[split + 1:]
+    args = parser.parse_args(argv)
+
+    if args.action == 'serve':
+        serve(args.socket, args.workers)
+        return 0
+    if args.action in ('ping', 'shutdown'):
+        print(json.dumps((ping if args.action == 'ping' else shutdown)(args.socket)))
+        return 0
+
+    status = 0
+    for result in submit(args.command, args.files, options, args.output_dir, args.socket):
+        if result.get('done'):
+            print(f"{result['n_ok']} ok, {result['n_error']} failed")
+        elif result['status'] == 'ok':
+            print(f"{os.path.basename(result['file'])}: {result['wall_s']:.2f} s -> {', '.join(result['outputs'])}")
+        else:
+            print(f"{os.path.basename(result['file'])}: {result['error']}", file=sys.stderr)
+            status = 1
+    return status
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
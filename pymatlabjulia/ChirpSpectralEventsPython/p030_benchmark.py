@@ -0,0 +1,467 @@
+# ==============================================================================
+# Benchmark Suite for the Python Analysis Stages
+# ==============================================================================
+# Runs each analysis stage (loading, epoching, Welch/multitaper PSD, bandpower,
+# specparam, wavelet TFR, spectral events, source) on the bundled test datasets
+# in tests/ at several data scales, and records for every run:
+#
+#   wall time (median of repeats), peak RSS, peak numpy/Python allocation and
+#   throughput in channel-seconds of EEG processed per second.
+#
+# Results are appended to a JSON-lines history file. A baseline (one entry per
+# dataset/scale/stage) can be stored from any run; later runs are compared to
+# it and the script exits with status 1 when a stage is slower or uses more
+# memory than the baseline allows, so it can gate cohort runs or CI.
+#
+# Wall times come from the timed repeats alone; the allocation peak is taken
+# from one extra run with tracemalloc on, whose tracing overhead would
+# otherwise inflate the timings. Time and memory have separate tolerances
+# (--time-tolerance, --memory-tolerance) because timings are much noisier.
+#
+# The memory gate compares the RSS growth during a stage (peak RSS minus the
+# RSS at its start), not the process-wide peak, which would include whatever
+# earlier stages and the loaded dataset left behind. It needs a resettable
+# high-water mark (/proc/self/clear_refs, Linux); where the mark cannot be
+# reset the stage is only timed and its memory is not gated.
+#
+# Scales tile the recording along the epoch axis (scale 4 = 4x the epochs), so
+# per-channel-second cost is measured on the same signal at growing sizes.
+#
+# Stages whose packages (yasa, specparam/fooof) are not
+# installed, or datasets whose sample data cannot be read (.set files without
+# their .fdt), are recorded as skipped rather than failing the suite.
+#
+# Main Functions Used:
+# 1. load_dataset - Read and tile a test dataset.
+# 2. run_stage - Time one stage (wall time, peak RSS, allocations).
+# 3. run_benchmarks - Run all stages over datasets and scales.
+# 4. compare_to_baseline - Flag regressions against a stored baseline.
+#
+# Usage:
+#   python p030_benchmark.py                       # all datasets, scales 1 2 4
+#   python p030_benchmark.py --stages psd_welch psd_multitaper --scales 1 8
+#   python p030_benchmark.py --save-baseline       # store this run as baseline
+#   python p030_benchmark.py --time-tolerance 0.5 --memory-tolerance 0.1
+# ==============================================================================
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import mne
+
+from p010_instrument import peak_rss_mb, reset_peak_rss, rss_mb
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, '..', '..', 'tests'))
+DEFAULT_DATASETS = ['example_data_32.set', 'example_data_128.set',
+                    'example_data_erp.set', 'example_data_mea.set']
+DEFAULT_OUTPUT_DIR = os.environ.get('VHTP_BENCH_DIR',
+                                    os.path.join(os.path.expanduser('~'), '.cache', 'vhtp', 'benchmarks'))
+
+# ==============================================================================
+# Datasets
+# ==============================================================================
+
+def load_dataset(set_file, scale=1):
+    """
+    Read a test dataset as MNE Epochs and tile it along the epoch axis.
+
+    Continuous recordings are cut into 2 s epochs so every stage sees the
+    same container type.
+
+    Parameters
+    ----------
+    set_file : str
+        EEGLAB .set file.
+    scale : int
+        Number of copies of the epochs.
+
+    Returns
+    -------
+    mne.Epochs
+        Loaded (and tiled) epochs.
+    """
+    try:
+        epochs = mne.io.read_epochs_eeglab(set_file, verbose=False)
+    except ValueError:
+        raw = mne.io.read_raw_eeglab(set_file, preload=True, verbose=False)
+        epochs = mne.make_fixed_length_epochs(raw, duration=2.0, preload=True, verbose=False)
+    if scale > 1:
+        epochs = mne.EpochsArray(np.tile(epochs.get_data(), (scale, 1, 1)), epochs.info,
+                                 tmin=epochs.tmin, verbose=False)
+    return epochs
+
+
+def _to_raw(epochs):
+    """Concatenate epochs into a continuous RawArray (eeg_htpEegEpoch2Cont.m)."""
+    data = epochs.get_data()
+    return mne.io.RawArray(np.concatenate(list(data), axis=-1), epochs.info, verbose=False)
+
+
+def _has_positions(epochs):
+    montage = epochs.get_montage()
+    return montage is not None and len(montage.get_positions()['ch_pos']) == len(epochs.ch_names)
+
+# ==============================================================================
+# Stages
+# ==============================================================================
+# Each stage takes a context dict ('file', 'scale', 'epochs') and returns the
+# channel-seconds it processed. Stages listed with required modules are skipped
+# when those modules are not installed.
+
+def stage_load(ctx):
+    ctx['epochs'] = load_dataset(ctx['file'], ctx['scale'])
+    return _channel_seconds(ctx['epochs'])
+
+
+def stage_load_memmap(ctx):
+    from p103_mea_memmap import read_set_memmap
+    eeg = read_set_memmap(ctx['file'])
+    for _ in range(ctx['scale']):
+        np.asarray(eeg[:, :, :]).sum()
+    return ctx['scale'] * eeg.n_channels * eeg.n_times * eeg.n_trials / eeg.srate
+
+
+def stage_epoch(ctx):
+    raw = _to_raw(ctx['epochs'])
+    mne.make_fixed_length_epochs(raw, duration=1.0, preload=True, verbose=False)
+    return _channel_seconds(ctx['epochs'])
+
+
+def stage_psd_welch(ctx):
+    ctx['psd'] = ctx['epochs'].compute_psd(method='welch', fmin=1, fmax=80, verbose=False)
+    return _channel_seconds(ctx['epochs'])
+
+
+def stage_psd_multitaper(ctx):
+    from p156_multitaper import compute_multitaper
+    compute_multitaper(ctx['epochs'], fmin=1, fmax=80, picks=None)
+    return _channel_seconds(ctx['epochs'])
+
+
+def stage_bandpower(ctx):
+    import yasa
+    yasa.bandpower(_to_raw(ctx['epochs']), relative=True)
+    return _channel_seconds(ctx['epochs'])
+
+
+def stage_specparam(ctx):
+    try:
+        from specparam import SpectralGroupModel as GroupModel
+    except ImportError:
+        from fooof import FOOOFGroup as GroupModel
+    psd = ctx.get('psd') or ctx['epochs'].compute_psd(method='welch', fmin=1, fmax=80, verbose=False)
+    spectra, freqs = psd.get_data(return_freqs=True)
+    GroupModel(peak_width_limits=[1, 8], max_n_peaks=6, verbose=False).fit(freqs, spectra.mean(axis=0), [2, 55])
+    return _channel_seconds(ctx['epochs'])
+
+
+def stage_tfr(ctx):
+    from p162_wavelet_bank import tfr
+    epochs = ctx['epochs']
+    data = epochs.get_data()
+    for ch in range(data.shape[1]):
+        tfr(data[:, ch, :], np.arange(1, 61), epochs.info['sfreq'])
+    return _channel_seconds(epochs)
+
+
+def stage_spectral_events(ctx):
+    from p162_wavelet_bank import tfr
+    from p163_spectral_events import find_events
+    epochs = ctx['epochs']
+    sf = epochs.info['sfreq']
+    freqs = np.arange(1, 61)
+    chan_data = epochs.get_data(picks=[0])[:, 0, :]
+    tfrs = tfr(chan_data, freqs, sf)
+    find_events(tfrs, epochs.times - epochs.tmin, freqs, event_band=[7.5, 12.5], threshold_FOM=4.0)
+    return len(epochs) * len(epochs.times) / sf
+
+
+def stage_source(ctx):
+    # Spherical head model keeps the stage independent of template downloads
+    epochs = ctx['epochs'].copy().set_eeg_reference(projection=True, verbose=False)
+    sphere = mne.make_sphere_model('auto', 'auto', epochs.info, verbose=False)
+    src = mne.setup_volume_source_space(sphere=sphere, pos=15.0, verbose=False)
+    fwd = mne.make_forward_solution(epochs.info, trans=None, src=src, bem=sphere, eeg=True, verbose=False)
+    noise_cov = mne.make_ad_hoc_cov(epochs.info, verbose=False)
+    inv = mne.minimum_norm.make_inverse_operator(epochs.info, fwd, noise_cov, verbose=False)
+    mne.minimum_norm.apply_inverse(epochs.average(), inv, lambda2=1.0 / 9.0 ** 2, method='MNE', verbose=False)
+    return _channel_seconds(ctx['epochs'])
+
+
+def _channel_seconds(epochs):
+    return len(epochs) * len(epochs.ch_names) * len(epochs.times) / epochs.info['sfreq']
+
+
+# (name, function, required modules - any one of each tuple, needs positions)
+STAGES = [
+    ('load', stage_load, [], False),
+    ('load_memmap', stage_load_memmap, [], False),
+    ('epoch', stage_epoch, [], False),
+    ('psd_welch', stage_psd_welch, [], False),
+    ('psd_multitaper', stage_psd_multitaper, [], False),
+    ('bandpower', stage_bandpower, [('yasa',)], False),
+    ('specparam', stage_specparam, [('specparam', 'fooof')], False),
+    ('tfr', stage_tfr, [], False),
+    ('spectral_events', stage_spectral_events, [], False),
+    ('source', stage_source, [], True),
+]
+
+
+def _missing_modules(requires):
+    return [' or '.join(options) for options in requires
+            if not any(importlib.util.find_spec(m) for m in options)]
+
+# ==============================================================================
+# Running
+# ==============================================================================
+
+def run_stage(func, ctx, repeats=3):
+    """
+    Time one stage.
+
+    Parameters
+    ----------
+    func : callable
+        Stage function taking the context dict.
+    ctx : dict
+        Stage context.
+    repeats : int
+        Number of timed runs; the median wall time is reported. One more
+        untimed run measures the allocation peak with tracemalloc.
+
+    Returns
+    -------
+    dict
+        wall_s, wall_min_s, peak_rss_mb, stage_rss_mb (RSS growth during the
+        stage, None if the peak could not be reset), alloc_peak_mb,
+        channel_seconds, throughput.
+    """
+    walls = []
+    rss_reset = reset_peak_rss()
+    rss_start = rss_mb()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        channel_seconds = func(ctx)
+        walls.append(time.perf_counter() - start)
+    peak_rss = peak_rss_mb()
+    stage_rss = peak_rss - rss_start if rss_reset and None not in (peak_rss, rss_start) else None
+
+    # Allocations in a separate run so tracing does not slow the timed ones
+    tracemalloc.start()
+    try:
+        func(ctx)
+        alloc_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    wall = float(np.median(walls))
+    return {
+        'wall_s': wall,
+        'wall_min_s': float(np.min(walls)),
+        'peak_rss_mb': peak_rss,
+        'peak_rss_is_process_max': not rss_reset,
+        'stage_rss_mb': stage_rss,
+        'alloc_peak_mb': alloc_peak / 1024 ** 2,
+        'channel_seconds': channel_seconds,
+        'throughput': channel_seconds / wall if wall > 0 else float('inf'),
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {'commit': commit, 'host': platform.node(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'mne': mne.__version__}
+
+
+def run_benchmarks(datasets, scales, stages=None, repeats=3):
+    """
+    Run the selected stages over datasets and scales.
+
+    Parameters
+    ----------
+    datasets : list of str
+        EEGLAB .set files.
+    scales : list of int
+        Tiling factors.
+    stages : list of str, optional
+        Stage names to run (default: all). 'load' always runs first since the
+        other stages use its output.
+    repeats : int
+        Timed runs per stage.
+
+    Returns
+    -------
+    list of dict
+        One record per dataset/scale/stage, with 'status' 'ok', 'skipped' or 'error'.
+    """
+    selected = [s for s in STAGES if stages is None or s[0] in stages or s[0] == 'load']
+    env = _environment()
+    timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+    records = []
+
+    for set_file in datasets:
+        dataset = os.path.basename(set_file)
+        for scale in scales:
+            ctx = {'file': set_file, 'scale': scale}
+            base = {'timestamp': timestamp, **env, 'dataset': dataset, 'scale': scale}
+            for name, func, requires, needs_positions in selected:
+                record = {**base, 'stage': name}
+                missing = _missing_modules(requires)
+                if missing:
+                    record.update(status='skipped', reason=f"not installed: {', '.join(missing)}")
+                elif name != 'load' and 'epochs' not in ctx:
+                    record.update(status='skipped', reason='dataset could not be loaded')
+                elif needs_positions and not _has_positions(ctx['epochs']):
+                    record.update(status='skipped', reason='no channel positions')
+                else:
+                    try:
+                        record.update(status='ok', **run_stage(func, ctx, repeats=repeats))
+                    except (FileNotFoundError, ValueError, NotImplementedError) as e:
+                        # Missing .fdt files and unsupported layouts are properties of the dataset
+                        record.update(status='skipped', reason=f"{type(e).__name__}: {e}")
+                    except Exception as e:
+                        record.update(status='error', reason=f"{type(e).__name__}: {e}")
+                if 'epochs' in ctx and name == 'load':
+                    record.update(n_channels=len(ctx['epochs'].ch_names), n_epochs=len(ctx['epochs']),
+                                  sfreq=ctx['epochs'].info['sfreq'])
+                records.append(record)
+                _print_record(record)
+    return records
+
+
+def _print_record(record):
+    label = f"{record['dataset']:<22} x{record['scale']:<3} {record['stage']:<16}"
+    if record['status'] == 'ok':
+        peak = record['peak_rss_mb']
+        print(f"{label} {record['wall_s']:8.3f} s  {'?' if peak is None else f'{peak:8.1f}':>8} MB  "
+              f"{record['throughput']:10.1f} ch*s/s")
+    else:
+        print(f"{label} {record['status']}: {record['reason']}")
+
+# ==============================================================================
+# History and Baseline
+# ==============================================================================
+
+def _key(record):
+    return f"{record['dataset']}|{record['scale']}|{record['stage']}"
+
+
+def append_history(records, history_file):
+    """Append records to a JSON-lines history file."""
+    os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+    with open(history_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def save_baseline(records, baseline_file):
+    """Store the successful records of a run as the baseline."""
+    baseline = {_key(r): {k: r[k] for k in ('wall_s', 'peak_rss_mb', 'stage_rss_mb', 'throughput', 'commit',
+                                            'timestamp')}
+                for r in records if r['status'] == 'ok'}
+    os.makedirs(os.path.dirname(os.path.abspath(baseline_file)), exist_ok=True)
+    with open(baseline_file, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare_to_baseline(records, baseline_file, time_tolerance=0.25, memory_tolerance=0.10,
+                        min_wall_s=0.05, min_rss_mb=5.0):
+    """
+    Flag stages that regressed against a stored baseline.
+
+    Parameters
+    ----------
+    records : list of dict
+        Records from run_benchmarks.
+    baseline_file : str
+        Baseline JSON written by save_baseline.
+    time_tolerance, memory_tolerance : float
+        Allowed relative increase in wall time and in RSS growth during the
+        stage. Memory is not gated when either run could not reset the peak.
+    min_wall_s : float
+        Wall-time differences below this many seconds are ignored (timer noise).
+    min_rss_mb : float
+        RSS growth differences below this many MB are ignored (allocator noise).
+
+    Returns
+    -------
+    list of str
+        One message per regression (empty if none or no baseline).
+    """
+    if not os.path.exists(baseline_file):
+        return []
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for record in records:
+        ref = baseline.get(_key(record))
+        if record['status'] != 'ok' or ref is None:
+            continue
+        slower = record['wall_s'] - ref['wall_s']
+        if slower > min_wall_s and record['wall_s'] > ref['wall_s'] * (1 + time_tolerance):
+            regressions.append(f"{_key(record)}: wall {record['wall_s']:.3f} s vs baseline "
+                               f"{ref['wall_s']:.3f} s ({record['wall_s'] / ref['wall_s']:.2f}x)")
+        grown, ref_grown = record.get('stage_rss_mb'), ref.get('stage_rss_mb')
+        if grown is None or ref_grown is None:
+            continue
+        if grown - ref_grown > min_rss_mb and grown > ref_grown * (1 + memory_tolerance):
+            regressions.append(f"{_key(record)}: stage RSS growth {grown:.1f} MB vs baseline "
+                               f"{ref_grown:.1f} MB")
+    return regressions
+
+# ==============================================================================
+# Command Line
+# ==============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Python analysis stages on the test datasets.')
+    parser.add_argument('--datasets', nargs='+', default=[os.path.join(TEST_DIR, f) for f in DEFAULT_DATASETS],
+                        help='EEGLAB .set files (default: tests/example_data_*.set)')
+    parser.add_argument('--scales', nargs='+', type=int, default=[1, 2, 4], help='data tiling factors')
+    parser.add_argument('--stages', nargs='+', choices=[s[0] for s in STAGES], help='stages to run (default: all)')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help='history and baseline directory')
+    parser.add_argument('--baseline', help='baseline file (default: <output-dir>/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown (default: 0.25)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.10,
+                        help='allowed relative increase in RSS growth per stage (default: 0.10)')
+    args = parser.parse_args(argv)
+
+    records = run_benchmarks(args.datasets, args.scales, args.stages, args.repeats)
+
+    history_file = os.path.join(args.output_dir, 'history.jsonl')
+    baseline_file = args.baseline or os.path.join(args.output_dir, 'baseline.json')
+    append_history(records, history_file)
+    print(f"Appended {len(records)} records to {history_file}")
+
+    if args.save_baseline:
+        save_baseline(records, baseline_file)
+        print(f"Saved baseline to {baseline_file}")
+        return 0
+
+    regressions = compare_to_baseline(records, baseline_file, args.time_tolerance, args.memory_tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
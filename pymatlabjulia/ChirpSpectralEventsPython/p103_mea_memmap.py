@@ -0,0 +1,424 @@
+# ==============================================================================
+# Memory-Mapped EEGLAB / MEA Data Loading
+# ==============================================================================
+# This module opens EEGLAB .set/.fdt pairs without reading the sample data into
+# RAM. The .fdt file is float32, channel-fastest (MATLAB column-major) with the
+# shape (nbchan, pnts, trials), so it can be mapped directly with numpy.memmap.
+#
+# Mouse MEA recordings additionally need their 30 probe channels reordered
+# (see eeg_htpMeaFixChannelOrder30.m and util_htpRemapXdatMea.m). Here the
+# reorder is kept as an index permutation that is applied when data are
+# accessed, so high-channel-count, high-rate recordings never get copied just
+# to put the rows in the right order.
+#
+# Main Functions Used:
+# 1. read_set_header - Reads the EEG structure fields stored in a .set file.
+# 2. read_set_memmap - Opens a .set/.fdt pair as a MemmapEEG object.
+# 3. mea30_order - Converts an MEA channel mapping into a row permutation.
+# ==============================================================================
+
+import os
+
+import numpy as np
+import scipy.io as sio
+
+# ==============================================================================
+# MEA 30 Channel Maps
+# ==============================================================================
+# EDF channel -> MEA channel, table provided by Carrie Jonak (Binder Lab, UC
+# Riverside) on March 2nd 2020. Same values as edf2meaLookupTest() in
+# eeg_htpMeaFixChannelOrder30.m.
+MEA30_EDF_TO_MEA = {
+    23: 1, 22: 2, 30: 3, 21: 4, 29: 5, 20: 6, 28: 7, 19: 8, 27: 9, 18: 10,
+    26: 11, 17: 12, 25: 13, 16: 14, 24: 15, 15: 16, 7: 17, 14: 18, 6: 19,
+    13: 20, 5: 21, 12: 22, 4: 23, 11: 24, 3: 25, 10: 26, 2: 27, 9: 28, 1: 29,
+    8: 30,
+}
+
+# Current XDAT location -> correct location. Same values as mappingDict in
+# util_htpRemapXdatMea.m.
+MEA30_XDAT_TO_MEA = {
+    1: 29, 2: 27, 3: 25, 4: 23, 5: 21, 6: 19, 7: 17, 8: 30, 9: 28, 10: 26,
+    11: 24, 12: 22, 13: 20, 14: 18, 15: 16, 16: 14, 17: 12, 18: 10, 19: 8,
+    20: 6, 21: 4, 22: 2, 23: 1, 24: 15, 25: 13, 26: 11, 27: 9, 28: 7, 29: 5,
+    30: 3,
+}
+
+# Channel labels written by eeg_htpMeaFixChannelOrder30.m after the reorder
+MEA30_LABELS = [f"Ch {i:02d}" for i in range(1, 31)]
+
+
+def mea30_order(mapping):
+    """
+    Convert a 1-based {current channel: correct channel} map into a row permutation.
+
+    Parameters
+    ----------
+    mapping : dict
+        Map from the channel position in the file to its correct position,
+        both 1-based as in the MATLAB lookup tables.
+
+    Returns
+    -------
+    order : ndarray of int
+        0-based permutation where ``order[new_row] = old_row``. Indexing the
+        original rows with it gives the same result as the MATLAB loops
+        ``data(correct, :) = tempData(current, :)``.
+    """
+    order = np.empty(len(mapping), dtype=np.intp)
+    for current, correct in mapping.items():
+        order[correct - 1] = current - 1
+    return order
+
+
+# ==============================================================================
+# EEGLAB Header Reading
+# ==============================================================================
+
+def read_set_header(set_file):
+    """
+    Read the EEG structure fields of an EEGLAB .set file without loading .fdt data.
+
+    Parameters
+    ----------
+    set_file : str
+        Path to the EEGLAB .set file.
+
+    Returns
+    -------
+    dict
+        The EEG structure fields (nbchan, pnts, trials, srate, chanlocs, ...).
+        Older EEGLAB versions nest everything in an ``EEG`` variable, newer
+        versions store the fields at the top level; both are returned flat.
+    """
+    try:
+        mat = sio.loadmat(set_file, squeeze_me=True, struct_as_record=False)
+    except NotImplementedError:
+        raise ValueError(f"{set_file} is saved as MATLAB v7.3; resave it with pop_saveset(..., 'version', '7').")
+
+    if 'EEG' in mat:
+        eeg = mat['EEG']
+        return {name: getattr(eeg, name) for name in eeg._fieldnames}
+    return {name: value for name, value in mat.items() if not name.startswith('__')}
+
+
+def _struct_to_dicts(value):
+    """Convert a (possibly scalar) MATLAB struct array into a list of dictionaries."""
+    if value is None or (isinstance(value, np.ndarray) and value.size == 0):
+        return []
+    items = np.atleast_1d(value)
+    return [{name: getattr(item, name) for name in item._fieldnames} for item in items]
+
+
+def _channel_labels(chanlocs, n_channels):
+    """Return channel labels from EEG.chanlocs, numbering channels if labels are missing."""
+    labels = [str(loc.get('labels', '')) for loc in _struct_to_dicts(chanlocs)]
+    if len(labels) != n_channels or not all(labels):
+        labels = [str(i + 1) for i in range(n_channels)]
+    return labels
+
+
+# ==============================================================================
+# Memory-Mapped EEG Container
+# ==============================================================================
+
+class MemmapEEG:
+    """
+    Lazily indexed view over EEGLAB sample data.
+
+    Data are addressed in MNE layout, ``(n_trials, n_channels, n_times)``,
+    while the underlying buffer stays in EEGLAB's (nbchan, pnts, trials)
+    column-major layout. A channel permutation is applied on access, so
+    reordering and picking channels never copy the recording.
+
+    Parameters
+    ----------
+    data : ndarray or numpy.memmap
+        Sample data shaped (nbchan, pnts, trials), in microvolts.
+    srate : float
+        Sampling frequency (Hz).
+    ch_names : list of str
+        Channel labels in file order.
+    xmin : float
+        Time of the first sample of each trial (seconds).
+    events : list of dict, optional
+        EEG.event entries.
+    order : array-like of int, optional
+        Rows of ``data`` to expose, in output order. Defaults to all rows.
+    setname : str
+        EEG.setname, used for reporting.
+    trials : array-like of int, optional
+        Trials of ``data`` to expose, in output order. Defaults to all trials.
+    chanlocs : list of dict, optional
+        Full EEG.chanlocs entries in file order; views expose the entries of
+        their channels as ``chanlocs``.
+    """
+
+    def __init__(self, data, srate, ch_names, xmin=0.0, events=None, order=None, setname='', trials=None,
+                 chanlocs=None):
+        self._data = data
+        self.srate = float(srate)
+        self._ch_names = list(ch_names)
+        self.xmin = float(xmin)
+        self.events = events if events is not None else []
+        self.setname = setname
+        n_rows = data.shape[0]
+        self._order = np.arange(n_rows, dtype=np.intp) if order is None else np.asarray(order, dtype=np.intp)
+        self._trials = None if trials is None else np.asarray(trials, dtype=np.intp)
+        self._chanlocs = None if chanlocs is None else list(chanlocs)
+
+    # --------------------------------------------------------------------------
+    # Shape information
+    # --------------------------------------------------------------------------
+    @property
+    def n_channels(self):
+        return len(self._order)
+
+    @property
+    def n_times(self):
+        return self._data.shape[1]
+
+    @property
+    def n_trials(self):
+        return self._data.shape[2] if self._trials is None else len(self._trials)
+
+    @property
+    def shape(self):
+        return (self.n_trials, self.n_channels, self.n_times)
+
+    @property
+    def ch_names(self):
+        return [self._ch_names[i] for i in self._order]
+
+    @property
+    def chanlocs(self):
+        if self._chanlocs is None:
+            return None
+        return [dict(self._chanlocs[i]) for i in self._order]
+
+    @property
+    def times(self):
+        return self.xmin + np.arange(self.n_times) / self.srate
+
+    def __len__(self):
+        return self.n_trials
+
+    def __repr__(self):
+        return (f"<MemmapEEG | {self.setname or 'unnamed'} | {self.n_trials} trials x "
+                f"{self.n_channels} channels x {self.n_times} samples @ {self.srate:g} Hz>")
+
+    # --------------------------------------------------------------------------
+    # Channel permutation
+    # --------------------------------------------------------------------------
+    def _is_identity(self):
+        return len(self._order) == self._data.shape[0] and np.array_equal(self._order, np.arange(len(self._order)))
+
+    def reorder(self, order, ch_names=None):
+        """
+        Return a new view whose channels are the current channels reordered by ``order``.
+
+        Parameters
+        ----------
+        order : array-like of int
+            0-based permutation where ``order[new] = current``.
+        ch_names : list of str, optional
+            Labels for the reordered channels. By default the existing labels
+            travel with their rows.
+
+        Returns
+        -------
+        MemmapEEG
+            A view sharing the same buffer.
+        """
+        new_order = self._order[np.asarray(order, dtype=np.intp)]
+        view = MemmapEEG(self._data, self.srate, self._ch_names, self.xmin, self.events, new_order, self.setname,
+                         self._trials, self._chanlocs)
+        if ch_names is not None:
+            labels = list(self._ch_names)
+            for row, name in zip(new_order, ch_names):
+                labels[row] = name
+            view._ch_names = labels
+        return view
+
+    def pick(self, picks):
+        """
+        Return a view restricted to the given channels.
+
+        Parameters
+        ----------
+        picks : list of int or str
+            Channel indices (in the current order) or channel labels.
+
+        Returns
+        -------
+        MemmapEEG
+            A view sharing the same buffer.
+        """
+        names = self.ch_names
+        idx = [names.index(p) if isinstance(p, str) else int(p) for p in picks]
+        return self.reorder(idx)
+
+    def select_trials(self, trials):
+        """
+        Return a view restricted to the given trials.
+
+        Parameters
+        ----------
+        trials : array-like of int or bool
+            Trial indices (in the current order) or a boolean mask over the
+            current trials, e.g. the clean trials of p115_trial_rejection.
+
+        Returns
+        -------
+        MemmapEEG
+            A view sharing the same buffer; only the selected trials are read.
+        """
+        trials = np.asarray(trials)
+        idx = np.flatnonzero(trials) if trials.dtype == bool else trials.astype(np.intp)
+        current = np.arange(self._data.shape[2], dtype=np.intp) if self._trials is None else self._trials
+        return MemmapEEG(self._data, self.srate, self._ch_names, self.xmin, self.events, self._order,
+                         self.setname, current[idx], self._chanlocs)
+
+    # --------------------------------------------------------------------------
+    # Data access
+    # --------------------------------------------------------------------------
+    def _channel_index(self, key):
+        if self._is_identity():
+            return key
+        if isinstance(key, slice):
+            return self._order[key]
+        return self._order[np.asarray(key) if not np.isscalar(key) else key]
+
+    def _trial_index(self, key):
+        if self._trials is None:
+            return key
+        if isinstance(key, slice):
+            return self._trials[key]
+        return self._trials[np.asarray(key) if not np.isscalar(key) else key]
+
+    def __getitem__(self, key):
+        """Index as ``eeg[trials, channels, times]``; only the selected samples are read."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        trial_key, chan_key, time_key = key
+        trial_key = self._trial_index(trial_key)
+        # Buffer layout is (channels, times, trials); reorder the key to match
+        keys = [self._channel_index(chan_key), time_key, trial_key]
+        scalar = [np.ndim(k) == 0 and not isinstance(k, slice) for k in keys]
+        if any(not isinstance(k, slice) and not s for k, s in zip(keys, scalar)):
+            # Array keys: use outer indexing so every axis keeps its position
+            keys = [np.atleast_1d(np.arange(n)[k] if isinstance(k, slice) else k)
+                    for k, n in zip(keys, self._data.shape)]
+            data = self._data[np.ix_(*keys)]
+            data = data.reshape([d for d, s in zip(data.shape, scalar) if not s])
+        else:
+            data = self._data[tuple(keys)]
+        axes = [ax for ax, s in zip(('chan', 'time', 'trial'), scalar) if not s]
+        target = [ax for ax in ('trial', 'chan', 'time') if ax in axes]
+        return np.transpose(data, [axes.index(ax) for ax in target])
+
+    def get_data(self, picks=None, start=0, stop=None, trials=None, units='uV'):
+        """
+        Read samples into memory.
+
+        Parameters
+        ----------
+        picks : list of int or str, optional
+            Channels to read. Defaults to all channels.
+        start, stop : int, optional
+            Sample range within each trial.
+        trials : slice or array-like of int, optional
+            Trials to read. Defaults to all trials.
+        units : str
+            'uV' (EEGLAB storage units) or 'V' (MNE convention).
+
+        Returns
+        -------
+        ndarray
+            (n_trials, n_channels, n_times) for epoched data, or
+            (n_channels, n_times) when the recording is continuous.
+        """
+        view = self if picks is None else self.pick(picks)
+        trial_key = slice(None) if trials is None else trials
+        data = view[trial_key, :, start:stop]
+        if units == 'V':
+            data = data * 1e-6
+        elif units != 'uV':
+            raise ValueError(f"Unsupported units: {units}")
+        # Only a continuous recording drops the trial axis; a one-trial
+        # selection of epoched data keeps the (n_trials, ...) layout
+        if self._trials is None and self._data.shape[2] == 1 and trials is None:
+            data = data[0]
+        return data
+
+
+# ==============================================================================
+# Readers
+# ==============================================================================
+
+def read_set_memmap(set_file, remap=None):
+    """
+    Open an EEGLAB .set/.fdt pair with the sample data memory-mapped.
+
+    Parameters
+    ----------
+    set_file : str
+        Path to the EEGLAB .set file.
+    remap : {None, 'edf', 'xdat'} or array-like of int
+        Channel reorder applied lazily on access.
+        'edf'  - EDF import order, as eeg_htpMeaFixChannelOrder30.m (labels become Ch 01..Ch 30).
+        'xdat' - Allego XDAT import order, as util_htpRemapXdatMea.m (labels keep their positions).
+        A sequence is used directly as a 0-based ``order[new] = old`` permutation.
+
+    Returns
+    -------
+    MemmapEEG
+        Lazily indexed view of the recording.
+    """
+    header = read_set_header(set_file)
+    nbchan = int(header['nbchan'])
+    pnts = int(header['pnts'])
+    trials = int(header.get('trials', 1) or 1)
+
+    data = header['data']
+    if isinstance(data, str):
+        # Data stored in a separate .fdt file next to the .set file
+        fdt_file = os.path.join(os.path.dirname(os.path.abspath(set_file)), data)
+        if not os.path.exists(fdt_file):
+            raise FileNotFoundError(f"Data file {fdt_file} referenced by {set_file} not found.")
+        buffer = np.memmap(fdt_file, dtype='<f4', mode='r', shape=(nbchan, pnts, trials), order='F')
+    else:
+        # Data embedded in the .set file cannot be mapped; keep the loaded array
+        buffer = np.asarray(data, dtype=np.float32).reshape((nbchan, pnts, trials), order='F')
+
+    eeg = MemmapEEG(buffer, header['srate'], _channel_labels(header.get('chanlocs'), nbchan),
+                    xmin=header.get('xmin', 0.0), events=_struct_to_dicts(header.get('event')),
+                    setname=str(header.get('setname', '')))
+
+    if remap is None:
+        return eeg
+    if isinstance(remap, str):
+        if nbchan != 30:
+            raise ValueError(f"MEA30 remap requires 30 channels, {set_file} has {nbchan}.")
+        if remap == 'edf':
+            return eeg.reorder(mea30_order(MEA30_EDF_TO_MEA), ch_names=MEA30_LABELS)
+        if remap == 'xdat':
+            return eeg.reorder(mea30_order(MEA30_XDAT_TO_MEA), ch_names=eeg.ch_names)
+        raise ValueError(f"Unknown remap: {remap}")
+    return eeg.reorder(remap)
+
+
+# ==============================================================================
+# Example: MEA Test Dataset
+# ==============================================================================
+if __name__ == '__main__':
+    mea_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests', 'example_data_mea.set')
+
+    eeg = read_set_memmap(mea_file, remap='edf')
+    print(eeg)
+    print(f"First channels after remap: {eeg.ch_names[:5]}")
+
+    # Only the requested channel/trials are read from disk
+    chan_data = eeg[:10, 0, :]
+    print(f"Channel 0 data shape: {chan_data.shape}")
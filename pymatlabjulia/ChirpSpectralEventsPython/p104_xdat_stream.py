@@ -0,0 +1,422 @@
+# ==============================================================================
+# Streaming Allego .xdat Reader with TTL Event Extraction
+# ==============================================================================
+# Allego recordings are stored as a JSON header (<name>.xdat.json), a float32
+# sample file (<name>_data.xdat, channel-fastest) and an int64 timestamp file
+# (<name>_timestamp.xdat). See external/import/allegoXDatFileReader.m.
+#
+# util_allegoXDatEvents_chirp.m and util_allegoXDatEvents_assr.m read the whole
+# recording, filter the second auxiliary channel and threshold it sample by
+# sample. This module reads the data file in fixed-size blocks instead and runs
+# the same detection rules incrementally, carrying the detector and filter state
+# across block boundaries. Events are emitted as soon as they are complete, so
+# a multi-gigabyte session is processed in one sequential pass at constant memory.
+#
+# Main Functions Used:
+# 1. read_xdat_meta - Reads the .xdat.json header.
+# 2. iter_xdat_blocks - Yields blocks of selected channels from the data file.
+# 3. TTLEventDetector - Chirp paradigm threshold rules (util_allegoXDatEvents_chirp.m).
+# 4. HysteresisEventDetector - ASSR paradigm hysteresis rules (util_detectEventsWithHysteresis_samples.m).
+# 5. stream_xdat_events - Reads, filters and detects events in a single pass.
+# ==============================================================================
+
+import json
+import os
+
+import numpy as np
+from scipy import signal
+
+from p105_trigger_detect import apply_refractory, edges, hysteresis_state
+
+# ==============================================================================
+# Header and Block Reading
+# ==============================================================================
+
+def read_xdat_meta(datasource):
+    """
+    Read the JSON header of an Allego recording.
+
+    Parameters
+    ----------
+    datasource : str
+        Full data source name, including the path and excluding file extensions
+        (e.g. '/data/mouse01' for mouse01.xdat.json / mouse01_data.xdat).
+
+    Returns
+    -------
+    dict
+        Decoded header. ``meta['status']['shape']`` is [n_samples, n_channels].
+    """
+    with open(f"{datasource}.xdat.json") as f:
+        return json.load(f)
+
+
+def xdat_channel_groups(meta):
+    """
+    Return 0-based channel indices for each signal group in the data file.
+
+    The last six channels are two auxiliary analog, two digital input and two
+    digital output channels, as in allegoXDatFileReader.m.
+
+    Parameters
+    ----------
+    meta : dict
+        Header returned by read_xdat_meta.
+
+    Returns
+    -------
+    dict
+        Keys 'pri', 'aux', 'din', 'dout' mapped to index arrays.
+    """
+    n_channels = int(meta['status']['shape'][1])
+    return {
+        'pri': np.arange(0, n_channels - 6),
+        'aux': np.arange(n_channels - 6, n_channels - 4),
+        'din': np.arange(n_channels - 4, n_channels - 2),
+        'dout': np.arange(n_channels - 2, n_channels),
+    }
+
+
+def iter_xdat_blocks(datasource, block_samples=100000, channels=None, meta=None):
+    """
+    Read an Allego data file sequentially in fixed-size blocks.
+
+    Parameters
+    ----------
+    datasource : str
+        Data source name (see read_xdat_meta).
+    block_samples : int
+        Number of samples per block.
+    channels : array-like of int, optional
+        0-based channels to return. Defaults to all channels.
+    meta : dict, optional
+        Header, if already read.
+
+    Yields
+    ------
+    first_sample : int
+        Index of the first sample of the block within the recording.
+    block : ndarray, float32
+        Data shaped (n_selected_channels, n_block_samples).
+    """
+    if meta is None:
+        meta = read_xdat_meta(datasource)
+    n_channels = int(meta['status']['shape'][1])
+    frame_bytes = n_channels * 4
+    data_file = f"{datasource}_data.xdat"
+    n_samples = os.path.getsize(data_file) // frame_bytes
+
+    with open(data_file, 'rb') as f:
+        first_sample = 0
+        while first_sample < n_samples:
+            count = min(block_samples, n_samples - first_sample)
+            frames = np.fromfile(f, dtype='<f4', count=count * n_channels).reshape(count, n_channels)
+            block = frames.T if channels is None else frames[:, channels].T
+            yield first_sample, np.ascontiguousarray(block)
+            first_sample += count
+
+
+# ==============================================================================
+# Streaming Filters
+# ==============================================================================
+
+class StreamingSosFilter:
+    """
+    Causal second-order-sections filter that keeps its state between blocks.
+
+    The MATLAB functions use filtfilt, which needs the whole signal. Streaming
+    requires a causal filter, so latencies carry the filter group delay; the
+    Butterworth designs below keep that delay to a few samples for the TTL
+    pulse edges.
+
+    Parameters
+    ----------
+    sos : ndarray
+        Second-order sections, e.g. from scipy.signal.butter(..., output='sos').
+    """
+
+    def __init__(self, sos):
+        self.sos = np.asarray(sos)
+        self.zi = None
+
+    def process(self, x):
+        """Filter one block shaped (..., n_samples) and carry the state forward."""
+        x = np.asarray(x, dtype=np.float64)
+        if self.zi is None:
+            zi = signal.sosfilt_zi(self.sos)
+            shape = (self.sos.shape[0],) + x.shape[:-1] + (2,)
+            self.zi = np.broadcast_to(zi.reshape((zi.shape[0],) + (1,) * (x.ndim - 1) + (2,)), shape) * x[..., :1]
+        y, self.zi = signal.sosfilt(self.sos, x, zi=self.zi)
+        return y
+
+
+def design_chirp_prefilter(sf):
+    """
+    Butterworth cascade from util_allegoXDatEvents_chirp.m as one SOS array.
+
+    Notches at 60, 120 and 180 Hz (order 2), lowpass at 100 Hz (order 8) and
+    highpass at 2 Hz (order 8).
+    """
+    sections = [signal.butter(1, [f - 5, f + 5], btype='bandstop', fs=sf, output='sos')
+                for f in (60, 120, 180) if f + 5 < sf / 2]
+    sections.append(signal.butter(8, 100, btype='lowpass', fs=sf, output='sos'))
+    sections.append(signal.butter(8, 2, btype='highpass', fs=sf, output='sos'))
+    return np.vstack(sections)
+
+
+def design_assr_prefilter(sf):
+    """
+    Butterworth cascade from util_allegoXDatEvents_assr.m as one SOS array.
+
+    Lowpass at 300 Hz (order 6) and a 57.5-62.5 Hz notch (order 8).
+    """
+    sections = []
+    if 300 < sf / 2:
+        sections.append(signal.butter(6, 300, btype='lowpass', fs=sf, output='sos'))
+    sections.append(signal.butter(4, [57.5, 62.5], btype='bandstop', fs=sf, output='sos'))
+    return np.vstack(sections)
+
+
+# ==============================================================================
+# Incremental Event Detectors
+# ==============================================================================
+
+class TTLEventDetector:
+    """
+    Chirp TTL detection rules from util_allegoXDatEvents_chirp.m, applied block by block.
+
+    An event starts at the first sample at or above ``threshold`` (ignoring the
+    first ``skip_samples``) and ends at the first sample below ``-threshold``
+    that is at least ``min_duration`` samples after the start.
+
+    Parameters
+    ----------
+    threshold : float
+        Voltage threshold for detecting events.
+    min_duration : int
+        Minimum event duration (samples).
+    skip_samples : int
+        Samples at the start of the recording that cannot start an event.
+    """
+
+    def __init__(self, threshold=0.4, min_duration=200, skip_samples=1000):
+        self.threshold = threshold
+        self.min_duration = min_duration
+        self.skip_samples = skip_samples
+        self.in_event = False
+        self.event_start = None
+        self.n_seen = 0
+
+    def update(self, x):
+        """
+        Process the next block of the trigger channel.
+
+        Parameters
+        ----------
+        x : ndarray, shape (n_samples,)
+            Next block of the (filtered) trigger channel.
+
+        Returns
+        -------
+        list of dict
+            Events completed within this block.
+        """
+        offset = self.n_seen
+        idx = np.arange(offset, offset + x.size)
+        starts = idx[(x >= self.threshold) & (idx >= self.skip_samples)]
+        ends = idx[x < -self.threshold]
+        self.n_seen += x.size
+
+        events = []
+        cursor = offset
+        while True:
+            if not self.in_event:
+                k = np.searchsorted(starts, cursor)
+                if k == starts.size:
+                    break
+                self.event_start = int(starts[k])
+                self.in_event = True
+                cursor = self.event_start
+            k = np.searchsorted(ends, self.event_start + self.min_duration)
+            if k == ends.size:
+                break
+            end = int(ends[k])
+            events.extend(_event_pair(self.event_start, end - self.event_start))
+            self.in_event = False
+            cursor = end + 1
+        return events
+
+
+class HysteresisEventDetector:
+    """
+    ASSR detection rules from util_detectEventsWithHysteresis_samples.m, applied block by block.
+
+    The rectified signal is thresholded with hysteresis. Each rising edge that
+    is at least ``refractory`` samples after the end of the previous event
+    starts a fixed-length event of ``event_duration`` samples.
+
+    The MATLAB function derives the thresholds from percentiles of the whole
+    recording; for streaming they must be given up front (see
+    stream_xdat_events, which estimates them from a calibration segment).
+
+    Parameters
+    ----------
+    high, low : float
+        Hysteresis thresholds on the rectified signal.
+    event_duration : int
+        Event length (samples).
+    refractory : int
+        Minimum gap between the end of an event and the next start (samples).
+    min_duration : int
+        Events truncated by the end of the recording to fewer samples are dropped.
+    """
+
+    def __init__(self, high, low, event_duration=2980, refractory=1976, min_duration=2500):
+        self.high = high
+        self.low = low
+        self.event_duration = event_duration
+        self.refractory = refractory
+        self.min_duration = min_duration
+        self.active = False
+        self.last_event_end = -1
+        self.pending = None
+        self.n_seen = 0
+
+    def update(self, x):
+        """
+        Process the next block of the trigger channel.
+
+        Returns
+        -------
+        list of dict
+            Events whose full duration has been seen by the end of this block.
+        """
+        offset = self.n_seen
+        state = hysteresis_state(np.abs(x), self.high, self.low, self.active)
+        rising = edges(state, self.active)[0] + offset
+        self.active = bool(state[-1]) if state.size else self.active
+        self.n_seen += x.size
+
+        events = self._release()
+        for start in apply_refractory(rising, self.event_duration, self.refractory, self.last_event_end):
+            self.last_event_end = start + self.event_duration - 1
+            self.pending = int(start)
+            events.extend(self._release())
+        return events
+
+    def _release(self):
+        if self.pending is not None and self.pending + self.event_duration <= self.n_seen:
+            events = _event_pair(self.pending, self.event_duration)
+            self.pending = None
+            return events
+        return []
+
+    def finish(self):
+        """Emit an event cut short by the end of the recording if it is long enough."""
+        if self.pending is None:
+            return []
+        start, self.pending = self.pending, None
+        # Samples left in the recording, as the truncated square wave of the
+        # MATLAB function and p105 detect_events
+        duration = self.n_seen - start
+        return _event_pair(start, duration) if duration >= self.min_duration else []
+
+
+def _event_pair(start, duration):
+    """Start/end event dictionaries with 0-based sample latencies (EEGLAB latency = sample + 1)."""
+    return [
+        {'type': 'TTL_pulse_start', 'sample': int(start), 'duration': int(duration)},
+        {'type': 'TTL_pulse_end', 'sample': int(start + duration), 'duration': 0},
+    ]
+
+
+# ==============================================================================
+# Single-Pass Event Extraction
+# ==============================================================================
+
+def stream_xdat_events(datasource, paradigm='chirp', channel=('aux', 1), block_seconds=10.0,
+                       prefilter=True, calibration_seconds=60.0, **detector_args):
+    """
+    Extract TTL events from an Allego recording in one sequential pass.
+
+    Parameters
+    ----------
+    datasource : str
+        Data source name (see read_xdat_meta).
+    paradigm : {'chirp', 'assr'}
+        Detection rules to apply.
+    channel : tuple of (str, int) or int
+        Trigger channel as (group, index within group) or a 0-based channel
+        index. Defaults to the second auxiliary channel, as in the MATLAB code.
+    block_seconds : float
+        Length of each read block (seconds).
+    prefilter : bool
+        Apply the paradigm's Butterworth cascade causally before detection.
+    calibration_seconds : float
+        ASSR only: length of the initial segment used to estimate the
+        hysteresis percentile thresholds when 'high'/'low' are not given.
+    **detector_args
+        Passed to TTLEventDetector or HysteresisEventDetector. For ASSR,
+        'high_percentile' (92.7) and 'low_percentile' (30) set the calibration.
+
+    Yields
+    ------
+    dict
+        Events with 'type', 'sample' (0-based) and 'duration' (samples).
+    """
+    meta = read_xdat_meta(datasource)
+    sf = float(meta['status']['samp_freq'])
+    if isinstance(channel, tuple):
+        group, index = channel
+        channel = int(xdat_channel_groups(meta)[group][index])
+    block_samples = max(1, int(round(block_seconds * sf)))
+
+    sos = None
+    if prefilter:
+        sos = design_chirp_prefilter(sf) if paradigm == 'chirp' else design_assr_prefilter(sf)
+    filt = StreamingSosFilter(sos) if sos is not None else None
+    blocks = ((first, filt.process(block[0]) if filt else block[0].astype(np.float64))
+              for first, block in iter_xdat_blocks(datasource, block_samples, [channel], meta))
+
+    if paradigm == 'chirp':
+        detector = TTLEventDetector(**detector_args)
+    elif paradigm == 'assr':
+        high_pct = detector_args.pop('high_percentile', 92.7)
+        low_pct = detector_args.pop('low_percentile', 30)
+        if 'high' not in detector_args or 'low' not in detector_args:
+            # Buffer only the calibration segment to estimate the thresholds
+            calibration, buffered = [], 0
+            for first, x in blocks:
+                calibration.append(x)
+                buffered += x.size
+                if buffered >= calibration_seconds * sf:
+                    break
+            rect = np.abs(np.concatenate(calibration))
+            detector_args.setdefault('high', np.percentile(rect, high_pct))
+            detector_args.setdefault('low', np.percentile(rect, low_pct))
+            blocks = _chain(((None, x) for x in calibration), blocks)
+        detector = HysteresisEventDetector(**detector_args)
+    else:
+        raise ValueError(f"Unknown paradigm: {paradigm}")
+
+    for _, x in blocks:
+        for event in detector.update(x):
+            yield event
+    if paradigm == 'assr':
+        for event in detector.finish():
+            yield event
+
+
+def _chain(*iterables):
+    for iterable in iterables:
+        yield from iterable
+
+
+# ==============================================================================
+# Example: Chirp Session
+# ==============================================================================
+if __name__ == '__main__':
+    xdat_source = '/Users/ernie/Documents/ExampleData/MEA/chirp_session'
+
+    for event in stream_xdat_events(xdat_source, paradigm='chirp'):
+        print(event)
@@ -0,0 +1,402 @@
+# ==============================================================================
+# Vectorized Hysteresis Trigger Detection
+# ==============================================================================
+# util_detectEventsWithHysteresis.m and util_detectEventsWithHysteresis_samples.m
+# recover stimulus onsets from analog trigger channels with a per-sample loop,
+# and eeg_htpEegFixChirpStartStop.m then pairs the detected events into chirp
+# START/END markers. This module performs the same steps with array operations:
+#
+#   rectify -> percentile thresholds -> hysteresis state (forward fill)
+#   -> rising/falling edges -> refractory filtering -> event table
+#
+# Channels can be numpy arrays or memmaps (see p103_mea_memmap.py). Long
+# recordings can be processed in chunks with the hysteresis state carried over,
+# and several trigger channels can be processed in one batch call. The output is
+# a pandas DataFrame that converts directly into an MNE events array for epoching.
+#
+# Main Functions Used:
+# 1. hysteresis_state - Vectorized hysteresis thresholding along the last axis.
+# 2. detect_events - Event table for one trigger channel.
+# 3. detect_events_batch - Event table for several channels at once.
+# 4. pair_chirp_events - START/END pairing from eeg_htpEegFixChirpStartStop.m.
+# 5. events_to_mne - MNE (n_events, 3) events array for mne.Epochs.
+# ==============================================================================
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# Core Array Operations
+# ==============================================================================
+
+def hysteresis_state(x, high, low, initial=False):
+    """
+    Hysteresis thresholding along the last axis without a per-sample loop.
+
+    A sample above ``high`` switches the state on, a sample below ``low``
+    switches it off and any sample in between keeps the previous state. The
+    state is propagated with a running maximum over the index of the last
+    deciding sample.
+
+    Parameters
+    ----------
+    x : ndarray, shape (..., n_samples)
+        Signal (usually rectified).
+    high, low : float or ndarray, shape (...)
+        Thresholds, scalar or one per channel.
+    initial : bool or ndarray of bool, shape (...)
+        State before the first sample (carried over between chunks).
+
+    Returns
+    -------
+    ndarray of bool, shape (..., n_samples)
+        Hysteresis state.
+    """
+    x = np.asarray(x)
+    high = np.asarray(high)[..., np.newaxis]
+    low = np.asarray(low)[..., np.newaxis]
+    decided = np.full(x.shape, -1, dtype=np.int8)
+    decided[x < low] = 0
+    decided[x > high] = 1
+    last = np.where(decided >= 0, np.arange(x.shape[-1]), -1)
+    np.maximum.accumulate(last, axis=-1, out=last)
+    state = np.take_along_axis(decided, np.maximum(last, 0), axis=-1).astype(bool)
+    initial = np.broadcast_to(np.asarray(initial, dtype=bool)[..., np.newaxis], x.shape)
+    return np.where(last >= 0, state, initial)
+
+
+def edges(state, initial=False):
+    """
+    Rising and falling edges of a boolean state vector.
+
+    Parameters
+    ----------
+    state : ndarray of bool, shape (n_samples,)
+        Binary state.
+    initial : bool
+        State before the first sample.
+
+    Returns
+    -------
+    rising, falling : ndarray of int
+        Indices of the first sample after each off->on and on->off transition.
+    """
+    previous = np.concatenate(([initial], state[:-1]))
+    return np.flatnonzero(state & ~previous), np.flatnonzero(~state & previous)
+
+
+def apply_refractory(starts, event_duration, refractory, last_event_end=-1):
+    """
+    Keep event starts that respect the refractory period after the previous event.
+
+    Same rule as util_detectEventsWithHysteresis_samples.m: a start is kept if it
+    is at least ``refractory`` samples after the end of the last kept event,
+    where each kept event lasts ``event_duration`` samples. The loop runs once
+    per kept event, jumping over rejected starts with a binary search.
+
+    Parameters
+    ----------
+    starts : ndarray of int
+        Sorted candidate starts.
+    event_duration : int
+        Event length (samples).
+    refractory : int
+        Minimum gap (samples).
+    last_event_end : int
+        End of the last event before ``starts`` (-1 if none).
+
+    Returns
+    -------
+    ndarray of int
+        Accepted starts.
+    """
+    kept = []
+    k = np.searchsorted(starts, last_event_end + refractory)
+    while k < starts.size:
+        start = starts[k]
+        kept.append(start)
+        k = np.searchsorted(starts, start + event_duration - 1 + refractory, side='left')
+    return np.asarray(kept, dtype=np.int64)
+
+
+def _thresholds(rect, high_percentile, low_percentile, stride):
+    sample = rect[..., ::stride]
+    return (np.percentile(sample, high_percentile, axis=-1),
+            np.percentile(sample, low_percentile, axis=-1))
+
+
+# ==============================================================================
+# Event Tables
+# ==============================================================================
+
+def _peak_amplitude(rect, starts, stops):
+    """Maximum of ``rect`` within each [start, stop) window, in one reduceat call."""
+    if starts.size == 0:
+        return np.empty(0)
+    bounds = np.column_stack((starts, stops)).ravel()
+    if bounds[-1] >= rect.size:
+        bounds = bounds[:-1]
+    return np.maximum.reduceat(rect, bounds)[::2]
+
+
+def _event_table(starts, stops, peak, sf, channel):
+    return pd.DataFrame({
+        'Channel': channel,
+        'Type': 'TTL_pulse_start',
+        'Onset_Sample': starts,
+        'Offset_Sample': stops,
+        'Duration_Samples': stops - starts,
+        'Onset_Sec': starts / sf,
+        'Peak_Amplitude': peak,
+    })
+
+
+def detect_events(x, sf, high=None, low=None, high_percentile=92.7, low_percentile=40,
+                  event_duration=2980, refractory=1976, min_duration=None, expected_count=None,
+                  rectify=True, chunk_samples=None, threshold_stride=1, channel=0):
+    """
+    Detect stimulus events on one analog trigger channel.
+
+    Defaults follow util_detectEventsWithHysteresis_samples.m. With
+    ``event_duration=None`` the events span the hysteresis on-periods
+    (onset = rising edge, offset = falling edge) instead of a fixed length.
+
+    Parameters
+    ----------
+    x : ndarray or numpy.memmap, shape (n_samples,)
+        Trigger channel.
+    sf : float
+        Sampling frequency (Hz).
+    high, low : float, optional
+        Absolute thresholds. Default to the percentiles below.
+    high_percentile, low_percentile : float
+        Percentiles of the rectified signal used as hysteresis thresholds.
+    event_duration : int or None
+        Fixed event length (samples).
+    refractory : int
+        Minimum gap between the end of an event and the next start (samples).
+    min_duration : int, optional
+        Drop events shorter than this (e.g. truncated by the end of the file).
+    expected_count : int, optional
+        Keep only the ``expected_count`` events with the highest peak
+        amplitude, as the cluster step of util_detectEventsWithHysteresis.m.
+    rectify : bool
+        Threshold ``abs(x)`` rather than ``x``.
+    chunk_samples : int, optional
+        Process the channel in chunks of this many samples, carrying the
+        hysteresis state, so only one chunk is in memory at a time.
+    threshold_stride : int
+        Estimate percentiles on every n-th sample to limit reads on long memmaps.
+    channel : int or str
+        Label stored in the 'Channel' column.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per event: Channel, Type, Onset_Sample, Offset_Sample,
+        Duration_Samples, Onset_Sec and Peak_Amplitude.
+    """
+    n = x.shape[-1]
+    chunk_samples = chunk_samples or n
+    prep = (lambda v: np.abs(v)) if rectify else (lambda v: np.asarray(v))
+
+    if high is None or low is None:
+        est_high, est_low = _thresholds(prep(x), high_percentile, low_percentile, threshold_stride)
+        high = est_high if high is None else high
+        low = est_low if low is None else low
+
+    rising, falling = [], []
+    active = False
+    for first in range(0, n, chunk_samples):
+        chunk = prep(x[first:first + chunk_samples])
+        state = hysteresis_state(chunk, high, low, active)
+        r, f = edges(state, active)
+        rising.append(r + first)
+        falling.append(f + first)
+        active = bool(state[-1])
+    rising = np.concatenate(rising)
+    falling = np.concatenate(falling)
+
+    if event_duration is None:
+        # The state starts off, so edges alternate; close an event still on at the end
+        if falling.size < rising.size:
+            falling = np.append(falling, n)
+        starts, stops = rising, falling
+    else:
+        starts = apply_refractory(rising, event_duration, refractory)
+        stops = np.minimum(starts + event_duration, n)
+
+    if min_duration is not None:
+        keep = (stops - starts) >= min_duration
+        starts, stops = starts[keep], stops[keep]
+
+    # Read back only the event windows for the peak amplitudes
+    peak = np.array([prep(x[a:b]).max() for a, b in zip(starts, stops)])
+    table = _event_table(starts, stops, peak, sf, channel)
+    if expected_count is not None and len(table) > expected_count:
+        table = table.nlargest(expected_count, 'Peak_Amplitude').sort_values('Onset_Sample')
+    return table.reset_index(drop=True)
+
+
+def detect_events_batch(data, sf, ch_names=None, high_percentile=92.7, low_percentile=40,
+                        event_duration=2980, refractory=1976, min_duration=None, rectify=True,
+                        threshold_stride=1):
+    """
+    Detect events on several trigger channels at once.
+
+    Thresholds and hysteresis states are computed for all channels in single
+    array operations; only the refractory filtering runs per channel. With
+    ``event_duration=None`` the events span the hysteresis on-periods, as in
+    detect_events.
+
+    Parameters
+    ----------
+    data : ndarray or numpy.memmap, shape (n_channels, n_samples)
+        Trigger channels.
+    sf : float
+        Sampling frequency (Hz).
+    ch_names : list of str, optional
+        Labels for the 'Channel' column. Defaults to channel indices.
+    Other parameters
+        As detect_events.
+
+    Returns
+    -------
+    pd.DataFrame
+        Event table for all channels, sorted by channel then onset.
+    """
+    rect = np.abs(data) if rectify else np.asarray(data)
+    high, low = _thresholds(rect, high_percentile, low_percentile, threshold_stride)
+    state = hysteresis_state(rect, high, low)
+    previous = np.concatenate((np.zeros((rect.shape[0], 1), dtype=bool), state[:, :-1]), axis=1)
+    n = rect.shape[1]
+    chan_idx, sample_idx = np.nonzero(state & ~previous)
+    bounds = np.searchsorted(chan_idx, np.arange(rect.shape[0] + 1))
+    if event_duration is None:
+        fall_chan, fall_idx = np.nonzero(~state & previous)
+        fall_bounds = np.searchsorted(fall_chan, np.arange(rect.shape[0] + 1))
+    ch_names = ch_names if ch_names is not None else list(range(rect.shape[0]))
+
+    tables = []
+    for ci in range(rect.shape[0]):
+        rising = sample_idx[bounds[ci]:bounds[ci + 1]]
+        if event_duration is None:
+            # Edges alternate from an off state; close an event still on at the end
+            starts, stops = rising, fall_idx[fall_bounds[ci]:fall_bounds[ci + 1]]
+            if stops.size < starts.size:
+                stops = np.append(stops, n)
+        else:
+            starts = apply_refractory(rising, event_duration, refractory)
+            stops = np.minimum(starts + event_duration, n)
+        if min_duration is not None:
+            keep = (stops - starts) >= min_duration
+            starts, stops = starts[keep], stops[keep]
+        tables.append(_event_table(starts, stops, _peak_amplitude(rect[ci], starts, stops), sf, ch_names[ci]))
+    return pd.concat(tables, ignore_index=True)
+
+
+# ==============================================================================
+# Chirp Start/Stop Pairing and Epoching Output
+# ==============================================================================
+
+def pair_chirp_events(onsets, sf, expected_stim_duration_sec=2.0, tol_sec=0.05):
+    """
+    Recode consecutive events into START/END pairs, as eeg_htpEegFixChirpStartStop.m.
+
+    Walking forward through the events, an event whose successor follows after
+    ``expected_stim_duration_sec`` (within ``tol_sec``) starts a trial and the
+    successor ends it; every other event is 'EXTRA'. The greedy walk is
+    computed without a loop: within each run of consecutive valid intervals,
+    every second interval starting from the first forms a pair.
+
+    Parameters
+    ----------
+    onsets : array-like of int
+        Event latencies (samples), sorted.
+    sf : float
+        Sampling frequency (Hz).
+    expected_stim_duration_sec : float
+        Expected START to END interval (seconds).
+    tol_sec : float
+        Allowed deviation from the expected interval (seconds).
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns Index, LatencySamples, LatencySec, DiffSec, RecodedType and
+        TrialNumber, matching the MATLAB summary table.
+    """
+    onsets = np.asarray(onsets)
+    if onsets.size == 0:
+        onsets = np.empty(0, dtype=np.int64)
+    latency_sec = onsets / sf
+    diff_sec = np.diff(latency_sec)
+    valid = np.abs(diff_sec - expected_stim_duration_sec) <= tol_sec
+
+    # Position of each valid interval within its run of consecutive valid intervals
+    idx = np.arange(valid.size)
+    run_begin = valid & ~np.concatenate(([False], valid[:-1]))
+    pos = idx - np.maximum.accumulate(np.where(run_begin, idx, 0)) if valid.size else idx
+    pair_start = np.flatnonzero(valid & (pos % 2 == 0))
+
+    recoded = np.full(onsets.size, 'EXTRA', dtype=object)
+    trial = np.full(onsets.size, np.nan)
+    recoded[pair_start] = 'START'
+    recoded[pair_start + 1] = 'END'
+    trial[pair_start] = trial[pair_start + 1] = np.arange(1, pair_start.size + 1)
+
+    return pd.DataFrame({
+        'Index': np.arange(1, onsets.size + 1),
+        'LatencySamples': onsets,
+        'LatencySec': latency_sec,
+        'DiffSec': np.concatenate(([np.nan], diff_sec))[:onsets.size],
+        'RecodedType': recoded,
+        'TrialNumber': trial,
+    })
+
+
+def events_to_mne(table, event_id=None, sample_column='Onset_Sample', type_column='Type'):
+    """
+    Convert an event table into an MNE events array.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        Output of detect_events, detect_events_batch or pair_chirp_events.
+    event_id : dict, optional
+        Map from event type to integer code. Defaults to codes 1..n in order
+        of first appearance.
+    sample_column, type_column : str
+        Columns holding the sample latency and the event type.
+
+    Returns
+    -------
+    events : ndarray, shape (n_events, 3)
+        [sample, 0, code] rows for mne.Epochs.
+    event_id : dict
+        Map from event type to code.
+    """
+    types = table[type_column].astype(str)
+    if event_id is None:
+        event_id = {name: i + 1 for i, name in enumerate(pd.unique(types))}
+    events = np.column_stack((table[sample_column].to_numpy(dtype=np.int64),
+                              np.zeros(len(table), dtype=np.int64),
+                              types.map(event_id).to_numpy(dtype=np.int64)))
+    return events[np.argsort(events[:, 0], kind='stable')], event_id
+
+
+# ==============================================================================
+# Example: Trigger Channel of an MEA Recording
+# ==============================================================================
+if __name__ == '__main__':
+    import os
+    from p103_mea_memmap import read_set_memmap
+
+    trigger_file = '/Users/ernie/Documents/ExampleData/MEA/assr_session.set'
+    eeg = read_set_memmap(trigger_file)
+    trigger = eeg[0, eeg.n_channels - 1, :]
+
+    events_df = detect_events(trigger, eeg.srate, min_duration=2500)
+    events, event_id = events_to_mne(events_df)
+    print(f"{os.path.basename(trigger_file)}: {len(events_df)} events")
+    print(events[:5])
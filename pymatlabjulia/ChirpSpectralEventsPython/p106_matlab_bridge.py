@@ -0,0 +1,372 @@
+# ==============================================================================
+# MATLAB <-> Python Shared Buffer Bridge
+# ==============================================================================
+# Mixed pipelines (MATLAB preprocessing, Python analysis) used to hand data over
+# by saving a full .set file and reading it back. This module replaces that
+# round trip with a shared buffer: a small JSON header plus one raw binary file
+# per array, placed in shared memory (/dev/shm) when available.
+#
+# Buffer layout
+#   <name>.json        - header: {"format", "version", "meta", "arrays"}
+#   <name>_<array>.bin - raw samples, column-major (Fortran) order
+#
+# Arrays are stored column-major, so EEG.data is written by MATLAB with a single
+# fwrite in its native (nbchan, pnts, trials) layout - the same layout as an
+# EEGLAB .fdt file - and Python maps it without copying (see p103_mea_memmap.py).
+# Results travel back the same way: arrays become .bin files, everything else
+# (scalars, strings, tables) goes into the header metadata.
+#
+# MATLAB side: util_htpBridgeExport.m, util_htpBridgeImport.m and
+# util_htpBridgeRunPython.m in the repository root.
+#
+# Main Functions Used:
+# 1. write_buffer - Write arrays and metadata as a buffer.
+# 2. read_buffer - Memory-map the arrays of a buffer.
+# 3. buffer_to_eeg - MemmapEEG view of a buffer exported from MATLAB.
+# 4. run_bridge - Call a Python analysis function on a buffer and write its results.
+# 5. update_buffer_meta - Merge entries into a buffer's metadata.
+# 6. remove_buffer - Delete a buffer and its array files.
+# ==============================================================================
+
+import importlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from p103_mea_memmap import MemmapEEG
+
+BUFFER_FORMAT = 'vhtp-buffer'
+BUFFER_VERSION = 1
+
+# Precision names understood by both numpy and MATLAB fread/fwrite/memmapfile
+BUFFER_DTYPES = ('float32', 'float64', 'int8', 'int16', 'int32', 'int64',
+                 'uint8', 'uint16', 'uint32', 'uint64')
+
+# ==============================================================================
+# Buffer Files
+# ==============================================================================
+
+def bridge_dir():
+    """
+    Directory for bridge buffers.
+
+    Uses $VHTP_BRIDGE_DIR if set, otherwise /dev/shm (RAM-backed on Linux) and
+    finally the system temporary directory.
+
+    Returns
+    -------
+    str
+        Buffer directory.
+    """
+    directory = os.environ.get('VHTP_BRIDGE_DIR')
+    if directory:
+        return directory
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _header_path(name, directory=None):
+    if name.endswith('.json'):
+        return name
+    return os.path.join(bridge_dir() if directory is None else directory, name + '.json')
+
+
+def _json_default(value):
+    """Convert numpy scalars/arrays and pandas objects for json.dump."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, pd.DataFrame):
+        return value.to_dict(orient='list')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _write_header(header_file, header):
+    # Written to a temporary file and renamed into place, so readers never see
+    # a partially written header
+    tmp_file = f"{header_file}.tmp{os.getpid()}"
+    with open(tmp_file, 'w') as f:
+        json.dump(header, f, default=_json_default)
+    os.replace(tmp_file, header_file)
+
+
+def allocate_buffer(name, shapes, meta=None, directory=None):
+    """
+    Create a buffer with writable, uninitialized arrays.
+
+    Analysis code can write results directly into the returned memmaps, so the
+    output never exists twice in memory.
+
+    Parameters
+    ----------
+    name : str
+        Buffer name (or full path to the .json header).
+    shapes : dict
+        Array name -> (shape, dtype).
+    meta : dict, optional
+        JSON-serializable metadata.
+    directory : str, optional
+        Buffer directory. Defaults to bridge_dir().
+
+    Returns
+    -------
+    header_file : str
+        Path to the buffer header.
+    arrays : dict
+        Array name -> writable numpy.memmap (Fortran order).
+    """
+    header_file = _header_path(name, directory)
+    # $VHTP_BRIDGE_DIR or a result directory may not exist yet (the MATLAB
+    # side creates it in util_htpBridgeExport)
+    os.makedirs(os.path.dirname(os.path.abspath(header_file)), exist_ok=True)
+    base = header_file[:-len('.json')]
+    arrays, specs = {}, {}
+    for key, (shape, dtype) in shapes.items():
+        dtype = np.dtype(dtype).name
+        if dtype not in BUFFER_DTYPES:
+            raise ValueError(f"Array '{key}' has unsupported dtype {dtype}.")
+        shape = tuple(int(n) for n in np.atleast_1d(shape))
+        array_file = f"{base}_{key}.bin"
+        if int(np.prod(shape)) == 0:
+            open(array_file, 'wb').close()
+            arrays[key] = np.empty(shape, dtype=dtype, order='F')
+        else:
+            arrays[key] = np.memmap(array_file, dtype=np.dtype(dtype).newbyteorder('<'),
+                                    mode='w+', shape=shape, order='F')
+        specs[key] = {'file': os.path.basename(array_file), 'dtype': dtype,
+                      'shape': list(shape), 'order': 'F'}
+    header = {'format': BUFFER_FORMAT, 'version': BUFFER_VERSION,
+              'meta': meta or {}, 'arrays': specs}
+    _write_header(header_file, header)
+    return header_file, arrays
+
+
+def write_buffer(name, arrays, meta=None, directory=None):
+    """
+    Write arrays and metadata as a buffer.
+
+    Parameters
+    ----------
+    name : str
+        Buffer name (or full path to the .json header).
+    arrays : dict
+        Array name -> ndarray. Arrays are stored column-major so MATLAB reads
+        them with the same shape.
+    meta : dict, optional
+        JSON-serializable metadata.
+    directory : str, optional
+        Buffer directory. Defaults to bridge_dir().
+
+    Returns
+    -------
+    str
+        Path to the buffer header.
+    """
+    arrays = {key: np.asarray(value) for key, value in arrays.items()}
+    shapes = {key: (value.shape, value.dtype) for key, value in arrays.items()}
+    header_file, targets = allocate_buffer(name, shapes, meta=meta, directory=directory)
+    for key, target in targets.items():
+        if target.size:
+            target[...] = arrays[key]
+            target.flush()
+    return header_file
+
+
+def read_buffer(header_file, mode='r'):
+    """
+    Memory-map the arrays of a buffer.
+
+    Parameters
+    ----------
+    header_file : str
+        Path to the buffer header (.json).
+    mode : {'r', 'r+', 'c'}
+        numpy.memmap mode; 'r+' lets Python modify the buffer in place.
+
+    Returns
+    -------
+    arrays : dict
+        Array name -> numpy.memmap with the shape recorded in the header.
+    meta : dict
+        Header metadata.
+    """
+    with open(header_file) as f:
+        header = json.load(f)
+    if header.get('format') != BUFFER_FORMAT:
+        raise ValueError(f"{header_file} is not a {BUFFER_FORMAT} header.")
+
+    directory = os.path.dirname(os.path.abspath(header_file))
+    arrays = {}
+    for key, spec in (header.get('arrays') or {}).items():
+        shape = tuple(int(n) for n in np.atleast_1d(spec['shape']))
+        dtype = np.dtype(spec['dtype']).newbyteorder('<')
+        if int(np.prod(shape)) == 0:
+            arrays[key] = np.empty(shape, dtype=dtype)
+            continue
+        arrays[key] = np.memmap(os.path.join(directory, spec['file']), dtype=dtype, mode=mode,
+                                shape=shape, order=spec.get('order', 'F'))
+    return arrays, header.get('meta') or {}
+
+
+def update_buffer_meta(header_file, meta):
+    """
+    Merge entries into the metadata of an existing buffer.
+
+    Parameters
+    ----------
+    header_file : str
+        Path to the buffer header (.json).
+    meta : dict
+        JSON-serializable metadata entries to add or replace.
+    """
+    with open(header_file) as f:
+        header = json.load(f)
+    header.setdefault('meta', {}).update(meta)
+    _write_header(header_file, header)
+
+
+def remove_buffer(header_file):
+    """
+    Delete a buffer header and its array files.
+
+    Parameters
+    ----------
+    header_file : str
+        Path to the buffer header (.json).
+    """
+    if not os.path.exists(header_file):
+        return
+    with open(header_file) as f:
+        header = json.load(f)
+    directory = os.path.dirname(os.path.abspath(header_file))
+    for spec in (header.get('arrays') or {}).values():
+        array_file = os.path.join(directory, spec['file'])
+        if os.path.exists(array_file):
+            os.remove(array_file)
+    os.remove(header_file)
+
+# ==============================================================================
+# EEG Buffers
+# ==============================================================================
+
+def _as_list(value):
+    """MATLAB jsonencode writes 1x1 struct arrays as objects and empty ones as []."""
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def buffer_to_eeg(header_file):
+    """
+    MemmapEEG view of an EEG buffer exported by util_htpBridgeExport.m.
+
+    Parameters
+    ----------
+    header_file : str
+        Path to the buffer header (.json).
+
+    Returns
+    -------
+    MemmapEEG
+        Lazily indexed view of EEG.data, with srate, chanlocs labels, xmin and
+        events taken from the header. ``eeg.chanlocs`` holds copies of the full
+        chanlocs (None if they do not match the channel count).
+    """
+    arrays, meta = read_buffer(header_file)
+    data = arrays['data']
+    if data.ndim == 2:
+        data = data.reshape(data.shape + (1,), order='F')
+
+    chanlocs = _as_list(meta.get('chanlocs'))
+    ch_names = [str(loc.get('labels', '')) for loc in chanlocs]
+    if len(ch_names) != data.shape[0] or not all(ch_names):
+        ch_names = [str(i + 1) for i in range(data.shape[0])]
+
+    return MemmapEEG(data, meta['srate'], ch_names, xmin=meta.get('xmin', 0.0),
+                     events=_as_list(meta.get('event')), setname=str(meta.get('setname', '')),
+                     chanlocs=[dict(loc) for loc in chanlocs] if len(chanlocs) == data.shape[0] else None)
+
+
+def _split_result(result):
+    """Split a function result into arrays (for .bin files) and metadata."""
+    if not isinstance(result, dict):
+        result = {'result': result}
+    arrays, meta = {}, {}
+    for key, value in result.items():
+        if isinstance(value, pd.DataFrame):
+            meta[key] = value.to_dict(orient='list')
+        elif isinstance(value, np.ndarray) and value.ndim > 0 and value.dtype.name in BUFFER_DTYPES:
+            arrays[key] = value
+        elif isinstance(value, np.ndarray) and value.ndim > 0 and value.dtype == bool:
+            arrays[key] = value.astype(np.uint8)
+        else:
+            meta[key] = value
+    return arrays, meta
+
+
+def run_bridge(header_file, module, function, output=None, **kwargs):
+    """
+    Call a Python analysis function on an EEG buffer and write its results.
+
+    The function receives a MemmapEEG as its first argument and may return an
+    ndarray, a DataFrame or a dict of them; arrays are written as .bin files and
+    everything else is stored in the result header.
+
+    Parameters
+    ----------
+    header_file : str
+        Path to the input buffer header.
+    module : str
+        Module that defines the analysis function (e.g. 'p163_spectral_events').
+    function : str
+        Function name.
+    output : str, optional
+        Result buffer name or header path. Defaults to '<input>_result'.
+    **kwargs
+        Keyword arguments passed to the function.
+
+    Returns
+    -------
+    str
+        Path to the result buffer header.
+    """
+    eeg = buffer_to_eeg(header_file)
+    func = getattr(importlib.import_module(module), function)
+    arrays, meta = _split_result(func(eeg, **kwargs))
+    if output is None:
+        output = header_file[:-len('.json')] + '_result.json'
+    directory = os.path.dirname(os.path.abspath(header_file))
+    return write_buffer(output, arrays, meta=meta, directory=directory)
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    from p103_mea_memmap import read_set_memmap
+
+    mea_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests', 'example_data_mea.set')
+    source = read_set_memmap(mea_file)
+
+    # Same buffer util_htpBridgeExport.m writes from MATLAB
+    header_file = write_buffer('example_data_mea',
+                               {'data': np.asfortranarray(source._data)},
+                               meta={'srate': source.srate, 'xmin': source.xmin, 'setname': source.setname,
+                                     'chanlocs': [{'labels': ch} for ch in source.ch_names]})
+    eeg = buffer_to_eeg(header_file)
+    print(eeg)
+
+    # Results written by Python are read in MATLAB with util_htpBridgeImport.m
+    result_file = write_buffer('example_data_mea_result',
+                               {'channel_rms': np.sqrt((eeg[:, :, :] ** 2).mean(axis=(0, 2)))},
+                               meta={'units': 'uV'})
+    arrays, meta = read_buffer(result_file)
+    print(arrays['channel_rms'][:5], meta)
+
+    remove_buffer(header_file)
+    remove_buffer(result_file)
@@ -0,0 +1,232 @@
+# ==============================================================================
+# Python -> Julia Interchange Files
+# ==============================================================================
+# p101_load_set.py (MNE) and j100/j110 (NeuroAnalyzer import_recording) parse
+# the same EEGLAB .set files independently. This module writes each recording
+# once into the shared buffer format of p106_matlab_bridge.py, which Julia
+# (j120_interchange_load.jl) and Python open with a memory map and no parsing:
+#
+#   <name>.json      - header: sampling rate, channel metadata, events, source
+#   <name>_data.bin  - float32 samples, column-major (n_channels, n_times, n_epochs)
+#
+# Column-major (n_channels, n_times, n_epochs) is the native layout of EEGLAB
+# .fdt files, MATLAB and Julia arrays, so Julia maps it as an
+# Array{Float32,3} directly. Samples are stored in microvolts.
+#
+# The header records the size and modification time of the source file, so
+# export_set skips recordings that were already exported and have not changed.
+#
+# Interchange files are kept across sessions, so they go to an on-disk cache
+# ($VHTP_INTERCHANGE_DIR, default ~/.cache/vhtp/interchange) rather than to
+# bridge_dir(), whose RAM-backed /dev/shm is meant for transient buffers.
+#
+# Main Functions Used:
+# 1. interchange_dir - Default (on-disk) directory of the interchange files.
+# 2. write_interchange - Write MNE Raw/Epochs or MemmapEEG data.
+# 3. export_set - Export an EEGLAB .set file once (skips up-to-date exports).
+# 4. read_interchange - Open an interchange file as a MemmapEEG.
+# ==============================================================================
+
+import os
+
+import numpy as np
+
+from p103_mea_memmap import MemmapEEG, read_set_memmap
+from p106_matlab_bridge import allocate_buffer, buffer_to_eeg, read_buffer, update_buffer_meta
+
+DEFAULT_INTERCHANGE_DIR = os.environ.get('VHTP_INTERCHANGE_DIR',
+                                         os.path.join(os.path.expanduser('~'), '.cache', 'vhtp', 'interchange'))
+
+# ==============================================================================
+# Writing
+# ==============================================================================
+
+def interchange_dir():
+    """
+    Directory for interchange files, created if missing.
+
+    Returns
+    -------
+    str
+        $VHTP_INTERCHANGE_DIR or ~/.cache/vhtp/interchange.
+    """
+    os.makedirs(DEFAULT_INTERCHANGE_DIR, exist_ok=True)
+    return DEFAULT_INTERCHANGE_DIR
+
+def _chanlocs_from_info(info):
+    """EEGLAB-style chanlocs (labels, type, X/Y/Z in meters) from mne.Info."""
+    chanlocs = []
+    for ch, ch_type in zip(info['chs'], info.get_channel_types()):
+        loc = ch['loc'][:3]
+        has_pos = np.all(np.isfinite(loc)) and np.any(loc != 0)
+        chanlocs.append({
+            'labels': ch['ch_name'],
+            'type': ch_type.upper(),
+            'X': float(loc[0]) if has_pos else None,
+            'Y': float(loc[1]) if has_pos else None,
+            'Z': float(loc[2]) if has_pos else None,
+        })
+    return chanlocs
+
+
+def _events_from_mne(inst):
+    """EEG.event-style list (type, 1-based latency) from MNE events."""
+    events = getattr(inst, 'events', None)
+    if events is None:
+        return [{'type': annot['description'], 'latency': float(annot['onset'] * inst.info['sfreq']) + 1,
+                 'duration': float(annot['duration'] * inst.info['sfreq'])}
+                for annot in inst.annotations]
+    id_to_type = {code: name for name, code in getattr(inst, 'event_id', {}).items()}
+    return [{'type': id_to_type.get(int(code), str(code)), 'latency': int(sample) + 1, 'epoch': i + 1}
+            for i, (sample, _, code) in enumerate(events)]
+
+
+def write_interchange(inst, name, directory=None, source=None):
+    """
+    Write MNE Raw/Epochs or MemmapEEG data as an interchange file.
+
+    Epochs are copied one at a time into the output memmap, so the recording is
+    never held twice in memory.
+
+    Parameters
+    ----------
+    inst : mne.io.Raw | mne.Epochs | MemmapEEG
+        Data to export.
+    name : str
+        Output name (or full path to the .json header).
+    directory : str, optional
+        Output directory. Defaults to interchange_dir().
+    source : str, optional
+        Source file, recorded with its size and modification time.
+
+    Returns
+    -------
+    str
+        Path to the interchange header.
+    """
+    if isinstance(inst, MemmapEEG):
+        n_epochs, n_channels, n_times = inst.shape
+        meta = {'srate': inst.srate, 'xmin': inst.xmin, 'setname': inst.setname,
+                'chanlocs': getattr(inst, 'chanlocs', None) or [{'labels': ch} for ch in inst.ch_names],
+                'event': inst.events}
+        get_epoch = lambda i: inst[i, :, :]
+    else:
+        sfreq = inst.info['sfreq']
+        if hasattr(inst, 'tmin'):
+            n_epochs, n_channels, n_times = len(inst.events), len(inst.ch_names), len(inst.times)
+            get_epoch = lambda i: inst.get_data(item=i, units='uV')[0]
+            xmin = float(inst.tmin)
+        else:
+            n_epochs, n_channels, n_times = 1, len(inst.ch_names), inst.n_times
+            get_epoch = lambda i: inst.get_data(units='uV')
+            xmin = 0.0
+        meta = {'srate': sfreq, 'xmin': xmin, 'setname': os.path.splitext(os.path.basename(name))[0],
+                'chanlocs': _chanlocs_from_info(inst.info), 'event': _events_from_mne(inst)}
+
+    meta.update({'nbchan': n_channels, 'pnts': n_times, 'trials': n_epochs, 'units': 'uV'})
+    if directory is None and not name.endswith('.json'):
+        directory = interchange_dir()
+
+    header_file, arrays = allocate_buffer(name, {'data': ((n_channels, n_times, n_epochs), np.float32)},
+                                          meta=meta, directory=directory)
+    data = arrays['data']
+    for i in range(n_epochs):
+        data[:, :, i] = get_epoch(i)
+    if isinstance(data, np.memmap):
+        data.flush()
+
+    # Source is recorded only once the samples are complete, so an interrupted
+    # export is never mistaken for an up-to-date one
+    if source is not None:
+        stat = os.stat(source)
+        update_buffer_meta(header_file, {'source': {'file': os.path.abspath(source),
+                                                    'size': stat.st_size, 'mtime': stat.st_mtime}})
+    return header_file
+
+
+def _is_current(header_file, source):
+    """True if header_file was exported from the unchanged source file."""
+    if not os.path.exists(header_file):
+        return False
+    try:
+        _, meta = read_buffer(header_file)
+    except (ValueError, OSError, KeyError):
+        return False
+    stat = os.stat(source)
+    recorded = meta.get('source') or {}
+    return recorded.get('size') == stat.st_size and recorded.get('mtime') == stat.st_mtime
+
+
+def export_set(set_file, directory=None, overwrite=False):
+    """
+    Export an EEGLAB .set file once for Julia and Python readers.
+
+    Parameters
+    ----------
+    set_file : str
+        EEGLAB .set file.
+    directory : str, optional
+        Output directory. Defaults to interchange_dir().
+    overwrite : bool
+        Export even if an up-to-date interchange file exists.
+
+    Returns
+    -------
+    str
+        Path to the interchange header.
+    """
+    name = os.path.splitext(os.path.basename(set_file))[0]
+    header_file = os.path.join(interchange_dir() if directory is None else directory, name + '.json')
+    if not overwrite and _is_current(header_file, set_file):
+        print(f"Interchange file {header_file} is up to date")
+        return header_file
+
+    try:
+        inst = read_set_memmap(set_file)
+    except (FileNotFoundError, ValueError):
+        # Data embedded in the .set file, or a MATLAB v7.3 file that scipy
+        # cannot read (read_set_header raises ValueError): let MNE parse it
+        import mne
+        try:
+            inst = mne.io.read_epochs_eeglab(set_file, verbose=False)
+        except ValueError:
+            inst = mne.io.read_raw_eeglab(set_file, preload=False, verbose=False)
+
+    header_file = write_interchange(inst, header_file, source=set_file)
+    print(f"Wrote interchange file {header_file}")
+    return header_file
+
+# ==============================================================================
+# Reading
+# ==============================================================================
+
+def read_interchange(header_file):
+    """
+    Open an interchange file as a MemmapEEG (no parsing, data memory-mapped).
+
+    Parameters
+    ----------
+    header_file : str
+        Path to the interchange header (.json).
+
+    Returns
+    -------
+    MemmapEEG
+        Lazily indexed view; ``eeg.chanlocs`` holds the channel metadata.
+    """
+    return buffer_to_eeg(header_file)
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    resting_file = '/Users/ernie/Documents/ExampleData/APD/D0113_rest_postica.set'
+    if not os.path.exists(resting_file):
+        resting_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests', 'example_data_mea.set')
+
+    # Written once; later calls (and Julia, see j120_interchange_load.jl) reuse it
+    header_file = export_set(resting_file)
+    eeg = read_interchange(header_file)
+    print(eeg)
+    print(f"Channels: {eeg.ch_names[:5]}")
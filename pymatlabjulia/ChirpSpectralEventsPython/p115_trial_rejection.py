@@ -0,0 +1,198 @@
+# ==============================================================================
+# Amplitude-Based Trial Rejection over Memory-Mapped Epochs
+# ==============================================================================
+# eeg_htpCalcChirpItcErsp drops trials in a loop over EEG.trials, either with a
+# fixed ampThreshold on the mean of each channel or, for source and mouse MEA
+# data, with a 3 SD limit on the mean absolute amplitude of each channel. The
+# Python scripts do no screening at all: they keep the first 80 trials,
+# artifacts included.
+#
+# This module computes per-trial, per-channel statistics in a single pass
+# over the epochs, a block of trials at a time, so a memory-mapped recording
+# (p103) is streamed once and never loaded whole:
+#
+#   ptp      - peak-to-peak amplitude
+#   max_abs  - maximum absolute amplitude
+#   var      - variance over time
+#   mean     - mean over time (the ampThreshold statistic)
+#   mean_abs - mean absolute amplitude (the 3 SD statistic)
+#
+# rejection_mask turns thresholds on these statistics into a boolean
+# (trials x channels) mask; clean_trials keeps the trials without any bad
+# channel, optionally only the first N of them. The indices select trials
+# as views: MemmapEEG.select_trials and p155 load_trials read only those
+# trials, and MNE epochs are indexed with them directly.
+#
+# Amplitudes are in microvolts, the EEGLAB storage unit.
+#
+# Main Functions Used:
+# 1. trial_stats - Per-trial, per-channel statistics in one blocked pass.
+# 2. rejection_mask - Bad (trial, channel) pairs for a set of thresholds.
+# 3. clean_trials - Indices of the first N trials without a bad channel.
+# 4. screen_trials - Statistics, mask and clean trials in one call.
+# ==============================================================================
+
+import numpy as np
+
+from p010_instrument import count
+
+STATS = ['ptp', 'max_abs', 'var', 'mean', 'mean_abs']
+
+# Bytes of float64 samples processed per block
+BLOCK_BYTES = 64 * 2 ** 20
+
+# ==============================================================================
+# Statistics
+# ==============================================================================
+
+def trial_stats(data, block_trials=None):
+    """
+    Per-trial, per-channel amplitude statistics in one pass over the trials.
+
+    Parameters
+    ----------
+    data : ndarray | MemmapEEG
+        Epochs shaped (n_trials, n_channels, n_times) in microvolts, or a
+        memory-mapped recording (read a block of trials at a time).
+    block_trials : int | None
+        Trials per block. Defaults to about 64 MB of float64 samples.
+
+    Returns
+    -------
+    dict
+        Statistic name (see STATS) -> ndarray, shape (n_trials, n_channels).
+    """
+    n_trials, n_channels, n_times = data.shape
+    if block_trials is None:
+        block_trials = max(1, BLOCK_BYTES // (8 * n_channels * n_times))
+    stats = {name: np.empty((n_trials, n_channels)) for name in STATS}
+    for start in range(0, n_trials, block_trials):
+        X = np.asarray(data[start:start + block_trials], dtype=np.float64)
+        block = slice(start, start + len(X))
+        low, high = X.min(axis=-1), X.max(axis=-1)
+        stats['ptp'][block] = high - low
+        stats['max_abs'][block] = np.maximum(np.abs(low), np.abs(high))
+        stats['mean'][block] = X.mean(axis=-1)
+        stats['var'][block] = X.var(axis=-1)
+        stats['mean_abs'][block] = np.abs(X).mean(axis=-1)
+    stats['n_times'] = n_times
+    return stats
+
+
+def _channel_mean_std(stats):
+    # Mean and standard deviation (ddof 1) of each channel over all samples
+    # of all trials, combined from the per-trial mean and variance
+    n_times = stats['n_times']
+    mean_t, var_t = stats['mean'], stats['var']
+    grand = mean_t.mean(axis=0)
+    ss = (n_times * var_t + n_times * (mean_t - grand) ** 2).sum(axis=0)
+    return grand, np.sqrt(ss / (n_times * len(mean_t) - 1))
+
+# ==============================================================================
+# Rejection
+# ==============================================================================
+
+def rejection_mask(stats, ptp=None, max_abs=None, var=None, amp_threshold=None, sd_threshold=None):
+    """
+    Bad (trial, channel) pairs for amplitude thresholds.
+
+    Parameters
+    ----------
+    stats : dict
+        Output of trial_stats.
+    ptp, max_abs, var : float | None
+        Upper limits of the peak-to-peak amplitude, maximum absolute
+        amplitude (uV) and variance (uV^2) of a channel within a trial.
+    amp_threshold : float | None
+        ampThreshold rule of eeg_htpCalcChirpItcErsp: |mean over time| of a
+        channel above this value (uV).
+    sd_threshold : float | None
+        Source/MEA rule of eeg_htpCalcChirpItcErsp (3 there): mean absolute
+        amplitude above the channel mean + sd_threshold x the channel
+        standard deviation over all trials.
+
+    Returns
+    -------
+    ndarray of bool, shape (n_trials, n_channels)
+        True where a channel exceeds any threshold in a trial.
+    """
+    bad = np.zeros(stats['ptp'].shape, dtype=bool)
+    for name, limit in (('ptp', ptp), ('max_abs', max_abs), ('var', var)):
+        if limit is not None:
+            bad |= stats[name] > limit
+    if amp_threshold is not None:
+        bad |= np.abs(stats['mean']) > amp_threshold
+    if sd_threshold is not None:
+        channel_mean, channel_std = _channel_mean_std(stats)
+        bad |= stats['mean_abs'] > channel_mean + sd_threshold * channel_std
+    return bad
+
+
+def clean_trials(bad, n_trials=None):
+    """
+    Indices of the trials without a bad channel.
+
+    Parameters
+    ----------
+    bad : ndarray of bool, shape (n_trials, n_channels) or (n_trials,)
+        Output of rejection_mask (or a per-trial mask).
+    n_trials : int | None
+        Keep only the first n clean trials (None keeps all).
+
+    Returns
+    -------
+    ndarray of int
+        Trial indices in recording order.
+    """
+    bad = np.asarray(bad)
+    good = ~bad.any(axis=1) if bad.ndim == 2 else ~bad
+    idx = np.flatnonzero(good)
+    count('trial_rejection.rejected', int(len(good) - len(idx)))
+    return idx if n_trials is None else idx[:n_trials]
+
+
+def screen_trials(data, n_trials=None, block_trials=None, **thresholds):
+    """
+    Statistics, rejection mask and clean trials of a recording.
+
+    Parameters
+    ----------
+    data : ndarray | MemmapEEG
+        Epochs (n_trials, n_channels, n_times) in microvolts.
+    n_trials : int | None
+        Keep only the first n clean trials.
+    block_trials : int | None
+        Trials per block of the statistics pass.
+    **thresholds
+        ptp, max_abs, var, amp_threshold and/or sd_threshold (see rejection_mask).
+
+    Returns
+    -------
+    keep : ndarray of int
+        Clean trial indices, at most n_trials.
+    bad : ndarray of bool, shape (n_trials, n_channels)
+        Bad (trial, channel) pairs.
+    stats : dict
+        Per-trial, per-channel statistics.
+    """
+    stats = trial_stats(data, block_trials)
+    bad = rejection_mask(stats, **thresholds)
+    return clean_trials(bad, n_trials), bad, stats
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    import os
+
+    from p103_mea_memmap import read_set_memmap
+
+    set_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests',
+                            'example_data_mea.set')
+    eeg = read_set_memmap(set_file)
+    keep, bad, stats = screen_trials(eeg, n_trials=20, ptp=500, sd_threshold=3)
+    print(f"{eeg}: {bad.any(axis=1).sum()} bad trials, median peak-to-peak "
+          f"{np.median(stats['ptp']):.1f} uV")
+    clean = eeg.select_trials(keep)
+    print(f"First {len(keep)} clean trials: {keep.tolist()} -> {clean[:].shape}")
@@ -0,0 +1,668 @@
+# ==============================================================================
+# Streaming Artifact Subspace Reconstruction for Long Recordings
+# ==============================================================================
+# eeg_htpEegAsrCleanEeglab.m runs ASR through the clean_rawdata plugin
+# (clean_asr -> asr_calibrate + asr_process) on a fully loaded EEG.data. This
+# module is a Python port of the same burst repair for continuous recordings
+# that are read block by block from a memory map (p103):
+#
+#   calibration  - the reference segment is screened with the clean_windows
+#                  rules (clean_reference); the mixing matrix M is the square
+#                  root of the geometric median of block covariances and the
+#                  rejection thresholds T come from a robust fit of the RMS
+#                  distribution of each principal component
+#   processing   - every stepsize samples the covariance of the spectrally
+#                  weighted signal over the last window is eigendecomposed;
+#                  components above threshold are reconstructed from the rest
+#                  and consecutive reconstruction matrices are blended with a
+#                  raised cosine, as in asr_process
+#
+# AsrStream carries the IIR filter state, the last window of filtered samples
+# (the moving-average covariance state), the look-ahead carry and the last
+# reconstruction matrix from one block to the next. Input is re-cut into
+# chunks on a fixed sample grid, so the output does not depend on how the
+# caller blocks the recording and memory is bounded by max_mem whatever the
+# recording length. Windowed covariances at the update points are differences
+# of prefix sums of X X^T (one BLAS product per segment between update
+# points), and the eigendecompositions and pseudo-inverses of a chunk are
+# computed as stacks.
+#
+# Only BurstCriterion (asrmode 2/4 without the final window rejection) is
+# covered; flatline, channel and line-noise criteria are separate stages. One
+# deviation from clean_asr: the reference is searched in the first
+# ref_seconds of the recording rather than in the whole recording, so
+# calibration also runs at constant memory.
+#
+# Main Functions Used:
+# 1. spectral_filter - clean_rawdata's spectral weighting filter (yulewalk design).
+# 2. fit_eeg_distribution - Robust fit of the clean part of an amplitude distribution.
+# 3. clean_reference - Sample mask of the clean windows of a calibration segment.
+# 4. asr_calibrate - Calibrate ASR on reference data (returns an AsrStream).
+# 5. AsrStream - Blockwise reconstruction with carried filter and covariance state.
+# 6. asr_clean_set - Calibrate and clean a .set file into a p106 buffer at constant memory.
+# ==============================================================================
+
+import os
+
+import numpy as np
+from scipy.signal import freqz, lfilter
+from scipy.special import gamma, gammaincinv
+
+from p010_instrument import count, stage
+
+# eeg_htpEegAsrCleanEeglab defaults
+BURST_CRITERION = 20
+MAX_MEM_MB = 64
+
+# ==============================================================================
+# Spectral Weighting Filter
+# ==============================================================================
+
+def _polystab(a):
+    # Reflect roots outside the unit circle (MATLAB polystab)
+    if len(a) <= 1:
+        return a
+    v = np.roots(a)
+    outside = np.abs(v) > 1
+    v[outside] = 1 / np.conj(v[outside])
+    return np.real(a[0] * np.poly(v))
+
+
+def _numf(h, a, nb):
+    # Least-squares numerator of order nb for impulse response h over denominator a
+    impr = lfilter([1.0], a, np.r_[1.0, np.zeros(len(h) - 1)])
+    col = np.zeros((len(h), nb + 1))
+    for k in range(nb + 1):
+        col[k:, k] = impr[:len(h) - k]
+    return np.linalg.lstsq(col, h, rcond=None)[0]
+
+
+def _yulewalk(order, f, m, npt=512):
+    # Recursive IIR design to a piecewise-linear magnitude response (MATLAB yulewalk)
+    f, m = np.asarray(f, dtype=float), np.asarray(m, dtype=float)
+    lap = npt // 25
+    npt = npt + 1
+    ht = np.zeros(npt)
+    nb, ht[0] = 1, m[0]
+    for i in range(len(f) - 1):
+        if f[i + 1] == f[i]:
+            nb = nb - lap // 2
+            ne = nb + lap
+        else:
+            ne = int(f[i + 1] * npt)
+        j = np.arange(nb, ne + 1)
+        inc = 0 if ne == nb else (j - nb) / (ne - nb)
+        ht[nb - 1:ne] = inc * m[i + 1] + (1 - inc) * m[i]
+        nb = ne + 1
+    ht = np.r_[ht, ht[npt - 2:0:-1]]
+    n = len(ht)
+    n2 = (n + 1) // 2
+    nr = 4 * order
+    nt = np.arange(nr)
+    r = np.real(np.fft.ifft(ht * ht))
+    r = r[:nr] * (0.54 + 0.46 * np.cos(np.pi * nt / (nr - 1)))
+    rwindow = np.r_[0.5, np.ones(n2 - 1), np.zeros(n - n2)]
+    # Denominator from the modified Yule-Walker equations
+    rm = r[order + np.arange(nr - order - 1)[:, None] - np.arange(order)[None, :]]
+    a = _polystab(np.r_[1.0, np.linalg.lstsq(rm, -r[order + 1:nr], rcond=None)[0]])
+    # Numerator from the minimum-phase spectral factor
+    qh = _numf(np.r_[r[0] / 2, r[1:nr]], a, order)
+    _, ss = freqz(qh, a, worN=n, whole=True)
+    ss = 2 * np.real(ss)
+    hh = np.fft.ifft(np.exp(np.fft.fft(rwindow * np.fft.ifft(np.log(ss)))))
+    b = np.real(_numf(hh[:nr], a, order))
+    return b, a
+
+
+def spectral_filter(sfreq):
+    """
+    Spectral weighting filter of asr_calibrate.
+
+    Emphasizes the frequencies at which artifacts dominate (below 2 Hz and
+    above 40 Hz) and attenuates the alpha/theta range before covariances are
+    estimated. Designed as in clean_rawdata with
+    yulewalk(8, [0 2 3 13 16 40 min(80, fs/2 - 1) fs/2], [3 .75 .33 .33 1 1 3 3]).
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency (Hz).
+
+    Returns
+    -------
+    b, a : ndarray
+        IIR filter coefficients (order 8).
+    """
+    freqs = np.r_[np.array([0, 2, 3, 13, 16, 40, min(80, sfreq / 2 - 1)]) * 2 / sfreq, 1]
+    return _yulewalk(8, freqs, [3, 0.75, 0.33, 0.33, 1, 1, 3, 3])
+
+# ==============================================================================
+# Robust Statistics
+# ==============================================================================
+
+def _mround(x):
+    # MATLAB round (half away from zero) for non-negative values
+    return np.floor(np.asarray(x) + 0.5).astype(int)
+
+
+def fit_eeg_distribution(x, min_clean_fraction=0.25, max_dropout_fraction=0.1, quants=(0.022, 0.6),
+                         step_sizes=(0.01, 0.01), beta=np.arange(1.7, 3.51, 0.15)):
+    """
+    Robust fit of the clean part of an EEG amplitude distribution.
+
+    Port of clean_rawdata's fit_eeg_distribution: a truncated generalized
+    Gaussian is fitted to the lower quantiles of the data by a grid search
+    over the interval position, width and shape that minimizes the KL
+    divergence to the histogram.
+
+    Parameters
+    ----------
+    x : ndarray
+        Amplitude values (e.g. window RMS), mostly clean with artifacts
+        mainly in the upper tail.
+    min_clean_fraction : float
+        Minimum fraction of the data assumed clean.
+    max_dropout_fraction : float
+        Maximum fraction of the data that may be missing in the lower tail.
+    quants : tuple of float
+        Quantile range of the fit for perfectly clean data.
+    step_sizes : tuple of float
+        Grid steps of the interval position and width.
+    beta : ndarray
+        Shape values to test.
+
+    Returns
+    -------
+    mu, sig : float
+        Mean and standard deviation of the clean distribution.
+    """
+    x = np.sort(np.ravel(x))
+    n = len(x)
+    quants = np.asarray(quants, dtype=float)
+    zbounds = [np.sign(quants - 0.5) * gammaincinv(1 / b, np.sign(quants - 0.5) * (2 * quants - 1)) ** (1 / b)
+               for b in beta]
+    rescale = beta / (2 * gamma(1 / beta))
+
+    lower_min, max_width = quants.min(), quants[1] - quants[0]
+    min_width = min_clean_fraction * max_width
+    # Shifted data ranges, one column per interval position
+    n_offsets = int(np.floor(max_dropout_fraction / step_sizes[0] + 1e-9)) + 1
+    offsets = _mround(n * (lower_min + step_sizes[0] * np.arange(n_offsets)))
+    rows = offsets[None, :] + np.arange(_mround(n * max_width))[:, None]
+    x = x[np.minimum(rows, n - 1)]
+    x1 = x[0]
+    x = x - x1
+
+    n_widths = int(np.floor((max_width - min_width) / step_sizes[1] + 1e-9)) + 1
+    opt_val, opt = np.inf, None
+    for m in _mround(n * (max_width - step_sizes[1] * np.arange(n_widths))):
+        if m < 1:
+            continue
+        # Scale and bin the data in each interval
+        n_bins = int(_mround(3 * np.log2(1 + m / 2)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            h = x[:m] * (n_bins / x[m - 1])
+        bins = np.clip(np.floor(np.nan_to_num(h, nan=0.0, posinf=n_bins)), 0, n_bins - 1).astype(int)
+        n_cols = bins.shape[1]
+        counts = np.bincount((bins + n_bins * np.arange(n_cols)).ravel(), minlength=n_bins * n_cols)
+        logq = np.log(counts.reshape(n_cols, n_bins).T + 0.01)
+        for b, bounds, scale in zip(beta, zbounds, rescale):
+            # Truncated generalized Gaussian pdf at the bin centers
+            z = bounds[0] + (np.arange(n_bins) + 0.5) / n_bins * (bounds[1] - bounds[0])
+            p = np.exp(-np.abs(z) ** b) * scale
+            p = p / p.sum()
+            kl = (p[:, None] * (np.log(p)[:, None] - logq)).sum(axis=0) + np.log(m)
+            idx = int(np.argmin(kl))
+            if kl[idx] < opt_val:
+                opt_val = kl[idx]
+                opt = (b, bounds, x1[idx], x1[idx] + x[m - 1, idx])
+
+    b, bounds, lower, upper = opt
+    alpha = (upper - lower) / (bounds[1] - bounds[0])
+    mu = lower - bounds[0] * alpha
+    sig = np.sqrt(alpha ** 2 * gamma(3 / b) / gamma(1 / b))
+    return mu, sig
+
+
+def _window_rms(x, n, window_overlap):
+    # RMS over windows of n samples (rows of x) starting at round(1:n*(1-overlap):S-n), 1-based
+    n_times = x.shape[0]
+    starts = _mround(np.arange(1, n_times - n + 1e-9, n * (1 - window_overlap))) - 1
+    csum = np.zeros((n_times + 1,) + x.shape[1:])
+    np.cumsum(x ** 2, axis=0, out=csum[1:])
+    return np.sqrt(np.maximum(csum[starts + n] - csum[starts], 0) / n), starts
+
+
+def clean_reference(x, sfreq, max_bad_channels=0.075, z_thresholds=(-3.5, 5.5), window_len=1.0,
+                    window_overlap=0.66):
+    """
+    Sample mask of the clean windows of a calibration segment.
+
+    Port of clean_windows with the reference settings of clean_asr: a window
+    is dirty if more than max_bad_channels of the channels have a robust RMS
+    z-score outside z_thresholds.
+
+    Parameters
+    ----------
+    x : ndarray, shape (n_channels, n_times)
+        Calibration segment.
+    sfreq : float
+        Sampling frequency (Hz).
+    max_bad_channels : float | int
+        Fraction (< 1) or number of channels allowed outside the thresholds.
+    z_thresholds : tuple of float
+        Lower and upper z-score limits of the window RMS.
+    window_len : float
+        Window length (s).
+    window_overlap : float
+        Window overlap fraction.
+
+    Returns
+    -------
+    ndarray of bool, shape (n_times,)
+        True for samples outside dirty windows.
+    """
+    n_channels, n_times = x.shape
+    if max_bad_channels < 1:
+        max_bad_channels = int(_mround(max_bad_channels * n_channels))
+    n = int(window_len * sfreq)
+    rms, starts = _window_rms(np.asarray(x, dtype=np.float64).T, n, window_overlap)
+    wz = np.empty_like(rms.T)
+    for c in range(n_channels):
+        mu, sig = fit_eeg_distribution(rms[:, c])
+        wz[c] = (rms[:, c] - mu) / sig
+    swz = np.sort(wz, axis=0)
+    remove = np.zeros(len(starts), dtype=bool)
+    if max(z_thresholds) > 0:
+        remove |= swz[n_channels - 1 - max_bad_channels] > max(z_thresholds)
+    if min(z_thresholds) < 0:
+        remove |= swz[max_bad_channels] < min(z_thresholds)
+    mask = np.ones(n_times, dtype=bool)
+    for start in starts[remove]:
+        mask[start:start + n] = False
+    return mask
+
+# ==============================================================================
+# Calibration
+# ==============================================================================
+
+def _geometric_median(x, tol=1e-5, max_iter=500):
+    # Weiszfeld iterations from the coordinate-wise median (rows are points)
+    y = np.median(x, axis=0)
+    for _ in range(max_iter):
+        inv_norms = 1 / np.sqrt(((x - y) ** 2).sum(axis=1))
+        y, old = (x * inv_norms[:, None]).sum(axis=0) / inv_norms.sum(), y
+        if np.linalg.norm(y - old) / np.linalg.norm(y) < tol:
+            break
+    return y
+
+
+def _sqrtm_sym(c):
+    d, v = np.linalg.eigh(c)
+    return (v * np.sqrt(np.maximum(d, 0))) @ v.T
+
+
+def asr_calibrate(x, sfreq, cutoff=BURST_CRITERION, blocksize=10, filt=None, window_len=0.5, window_overlap=0.66,
+                  max_dropout_fraction=0.1, min_clean_fraction=0.25, **stream_args):
+    """
+    Calibrate ASR on clean reference data.
+
+    Port of asr_calibrate: M is the square root of the geometric median of
+    the covariances of blocks of ``blocksize`` filtered samples, and the
+    threshold matrix T scales each principal component of M by the mean plus
+    ``cutoff`` standard deviations of its clean window RMS.
+
+    Parameters
+    ----------
+    x : ndarray, shape (n_channels, n_times)
+        Reference data (zero-mean, high-passed EEG).
+    sfreq : float
+        Sampling frequency (Hz).
+    cutoff : float
+        Burst criterion in standard deviations (20 in eeg_htpEegAsrCleanEeglab).
+    blocksize : int
+        Samples per covariance block.
+    filt : tuple | None
+        (b, a) spectral weighting filter. Defaults to spectral_filter(sfreq).
+    window_len, window_overlap : float
+        Window length (s) and overlap of the RMS statistics.
+    max_dropout_fraction, min_clean_fraction : float
+        See fit_eeg_distribution.
+    **stream_args
+        Passed to AsrStream (window_len, stepsize, maxdims, max_mem).
+
+    Returns
+    -------
+    AsrStream
+        Calibrated stream, ready for process().
+    """
+    b, a = spectral_filter(sfreq) if filt is None else filt
+    x = np.asarray(x, dtype=np.float64)
+    x = np.where(np.isfinite(x), x, 0)
+    n_channels, n_times = x.shape
+    xf, zi = lfilter(b, a, x, axis=-1, zi=np.zeros((n_channels, max(len(a), len(b)) - 1)))
+
+    # Covariance of each block of samples (the last block is padded with the last sample)
+    n_blocks = -(-n_times // blocksize)
+    xp = np.concatenate([xf, np.repeat(xf[:, -1:], n_blocks * blocksize - n_times, axis=1)], axis=1)
+    xb = xp.T.reshape(n_blocks, blocksize, n_channels)
+    u = np.einsum('nki,nkj->nij', xb, xb).reshape(n_blocks, -1)
+    m = _sqrtm_sym(_geometric_median(u / blocksize).reshape(n_channels, n_channels))
+
+    # Robust RMS statistics of each component
+    d, v = np.linalg.eigh(m)
+    rms, _ = _window_rms(np.abs(xf.T @ v), int(_mround(window_len * sfreq)), window_overlap)
+    mu, sig = np.array([fit_eeg_distribution(rms[:, c], min_clean_fraction, max_dropout_fraction)
+                        for c in range(n_channels)]).T
+    t = np.diag(mu + cutoff * sig) @ v.T
+    return AsrStream(m, t, sfreq, (b, a), zi=zi, **stream_args)
+
+# ==============================================================================
+# Processing
+# ==============================================================================
+
+class AsrStream:
+    """
+    Artifact subspace reconstruction of a continuous recording, block by block.
+
+    Port of asr_process with its state (IIR filter state, moving-average
+    covariance state, look-ahead carry, last reconstruction matrix) kept on
+    the object. Output is delayed by the look-ahead internally and realigned,
+    so the concatenated outputs of process() and finish() match the input
+    sample for sample.
+
+    Parameters
+    ----------
+    m : ndarray, shape (n_channels, n_channels)
+        Mixing matrix from asr_calibrate.
+    t : ndarray, shape (n_channels, n_channels)
+        Threshold matrix from asr_calibrate.
+    sfreq : float
+        Sampling frequency (Hz).
+    filt : tuple
+        (b, a) spectral weighting filter.
+    zi : ndarray | None
+        Initial filter state, shape (n_channels, order).
+    window_len : float | None
+        Covariance window (s). Defaults to max(0.5, 1.5 * n_channels / sfreq)
+        as in clean_asr; the look-ahead is half of it.
+    stepsize : int
+        Samples between reconstruction matrix updates.
+    maxdims : float | int
+        Maximum fraction (< 1) or number of components reconstructed.
+    max_mem : float
+        Approximate working memory per chunk (MB).
+    """
+
+    def __init__(self, m, t, sfreq, filt, zi=None, window_len=None, stepsize=32, maxdims=0.66, max_mem=MAX_MEM_MB):
+        self.m, self.t = np.asarray(m, dtype=np.float64), np.asarray(t, dtype=np.float64)
+        self.sfreq = float(sfreq)
+        self.b, self.a = (np.asarray(c, dtype=np.float64) for c in filt)
+        n_channels = len(self.m)
+        self.n_channels = n_channels
+        if window_len is None:
+            window_len = max(0.5, 1.5 * n_channels / self.sfreq)
+        self.n_window = int(_mround(window_len * self.sfreq))
+        self.lookahead = int(_mround(window_len / 2 * self.sfreq))
+        self.stepsize = int(stepsize)
+        self.maxdims = int(_mround(n_channels * maxdims)) if maxdims < 1 else int(maxdims)
+        # Chunks on a fixed grid of whole steps, sized to the memory budget
+        per_step = 8 * (6 * n_channels * self.stepsize + 6 * n_channels * n_channels)
+        self.chunk = self.stepsize * max(1, int(max_mem * 2 ** 20 // per_step))
+
+        order = max(len(self.a), len(self.b)) - 1
+        self.zi = np.zeros((n_channels, order)) if zi is None else np.array(zi, dtype=np.float64)
+        self.history = np.zeros((n_channels, self.n_window))
+        self.carry = None
+        self.last_r = None
+        self.last_trivial = True
+        self._pending = []
+        self._n_pending = 0
+        self._tail = np.zeros((n_channels, 0))
+        self._skip = self.lookahead
+
+    def _covariances(self, xf, update_at):
+        # Mean of x x^T over the last n_window filtered samples at each update point
+        n = self.n_window
+        y = np.concatenate([self.history, xf], axis=1)
+        # Prefix sums of y y^T at the window edges of all update points
+        edges = np.unique(np.r_[0, update_at + 1, update_at + 1 + n])
+        prefix = np.zeros((len(edges), self.n_channels, self.n_channels))
+        for k in range(1, len(edges)):
+            seg = y[:, edges[k - 1]:edges[k]]
+            prefix[k] = prefix[k - 1] + seg @ seg.T
+        pos = np.searchsorted(edges, np.r_[update_at + 1 + n, update_at + 1])
+        n_updates = len(update_at)
+        self.history = y[:, -n:]
+        return (prefix[pos[:n_updates]] - prefix[pos[n_updates:]]) / n
+
+    def _reconstructions(self, cov):
+        # Reconstruction matrix and triviality flag at each update point
+        n_channels = self.n_channels
+        d, v = np.linalg.eigh(cov)
+        threshold = ((self.t @ v) ** 2).sum(axis=1)
+        # clean_rawdata keeps (1:C) < (C-maxdims), i.e. C - maxdims - 1 components
+        # at least; 0-based that is k + 1 < C - maxdims
+        keep = (d < threshold) | (np.arange(n_channels) < n_channels - self.maxdims - 1)
+        trivial = keep.all(axis=1)
+        r = np.broadcast_to(np.eye(n_channels), cov.shape).copy()
+        busy = np.flatnonzero(~trivial)
+        if len(busy):
+            vt = v[busy].transpose(0, 2, 1)
+            kept = keep[busy][:, :, None] * (vt @ self.m)
+            r[busy] = self.m @ np.linalg.pinv(kept, rcond=n_channels * np.finfo(float).eps) @ vt
+            count('asr.reconstructed_updates', len(busy))
+        return r, trivial
+
+    def _process_chunk(self, x):
+        # One asr_process call: x is (n_channels, n_times) raw input
+        n_times, p = x.shape[1], self.lookahead
+        x = np.where(np.isfinite(x), x, 0)
+        if self.carry is None:
+            # Reflected start (2 x0 - x[P..1])
+            self.carry = 2 * x[:, :1] - x[:, np.arange(p, 0, -1) % n_times]
+        data = np.concatenate([self.carry, x], axis=1)
+
+        xf, self.zi = lfilter(self.b, self.a, x, axis=-1, zi=self.zi)
+        update_at = np.minimum(np.arange(self.stepsize, n_times + self.stepsize, self.stepsize), n_times) - 1
+        if self.last_r is None:
+            update_at = np.r_[0, update_at]
+            self.last_r = np.eye(self.n_channels)
+        update_at = np.unique(update_at)
+        r, trivial = self._reconstructions(self._covariances(xf, update_at))
+
+        last_n = 0
+        for j, u in enumerate(update_at):
+            n = u + 1
+            if not trivial[j] or not self.last_trivial:
+                seg = data[:, last_n:n]
+                blend = (1 - np.cos(np.pi * np.arange(1, n - last_n + 1) / (n - last_n))) / 2
+                data[:, last_n:n] = blend * (r[j] @ seg) + (1 - blend) * (self.last_r @ seg)
+            last_n, self.last_r, self.last_trivial = n, r[j], bool(trivial[j])
+
+        self.carry = data[:, -p:] if p else data[:, :0]
+        return data[:, :data.shape[1] - p]
+
+    def _emit(self, out):
+        if self._skip:
+            drop = min(self._skip, out.shape[1])
+            out, self._skip = out[:, drop:], self._skip - drop
+        return out
+
+    def _drain(self, final=False):
+        outputs = []
+        while self._n_pending >= self.chunk or (final and self._n_pending):
+            pending = np.concatenate(self._pending, axis=1)
+            take = pending.shape[1] if final and self._n_pending < self.chunk else self.chunk
+            self._pending = [pending[:, take:]]
+            self._n_pending -= take
+            outputs.append(self._emit(self._process_chunk(pending[:, :take])))
+        if not outputs:
+            return np.zeros((self.n_channels, 0))
+        return np.concatenate(outputs, axis=1)
+
+    def process(self, x):
+        """
+        Clean the next block of samples.
+
+        Parameters
+        ----------
+        x : ndarray, shape (n_channels, n_times)
+            Next samples of the recording (any block length).
+
+        Returns
+        -------
+        ndarray, shape (n_channels, n_out)
+            Cleaned samples that are complete so far; n_out varies with the
+            chunk grid, the remainder is returned by later calls.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        self._pending.append(x)
+        self._n_pending += x.shape[1]
+        self._tail = np.concatenate([self._tail, x], axis=1)[:, -(self.lookahead + 1):]
+        return self._drain()
+
+    def finish(self):
+        """
+        Flush the stream at the end of the recording.
+
+        The last look-ahead samples are processed with the reflected signal
+        end appended, as in clean_asr.
+
+        Returns
+        -------
+        ndarray, shape (n_channels, n_out)
+            Remaining cleaned samples.
+        """
+        p = self.lookahead
+        tail = self._tail
+        if p:
+            # 2 x_end - x[end-1 .. end-P]
+            idx = tail.shape[1] - 2 - np.arange(p)
+            reflected = 2 * tail[:, -1:] - tail[:, np.clip(idx, 0, None)]
+            self._pending.append(reflected)
+            self._n_pending += p
+        out = self._drain(final=True)
+        return out[:, :out.shape[1] - self._skip] if self._skip else out
+
+# ==============================================================================
+# Recordings
+# ==============================================================================
+
+def asr_clean_set(set_file, output=None, directory=None, cutoff=BURST_CRITERION, ref_seconds=300.0,
+                  block_seconds=10.0, highpass=None, max_mem=MAX_MEM_MB, **stream_args):
+    """
+    Calibrate and clean a continuous .set recording at constant memory.
+
+    The reference is the clean part (clean_reference) of the first
+    ``ref_seconds`` of the recording; the recording is then streamed from its
+    memory map block by block and the cleaned samples are written straight
+    into a float32 p106 buffer (readable by p107 read_interchange, MATLAB and
+    Julia).
+
+    Parameters
+    ----------
+    set_file : str
+        Continuous EEGLAB .set file in microvolts, high-passed unless
+        ``highpass`` is given (ASR treats slow drifts as artifacts).
+    output : str | None
+        Buffer name. Defaults to <set name>_asr.
+    directory : str | None
+        Output directory. Defaults to bridge_dir().
+    cutoff : float
+        Burst criterion in standard deviations.
+    ref_seconds : float
+        Length of the segment searched for calibration data (s).
+    block_seconds : float
+        Length of the blocks read from disk (s).
+    highpass : float | None
+        Passband edge (Hz) of a zero-phase windowed-sinc high-pass (p117,
+        pop_eegfiltnew defaults) applied to the reference and the stream
+        first; the output is the filtered signal.
+    max_mem : float
+        Working memory per processing chunk (MB).
+    **stream_args
+        Passed to AsrStream (window_len, stepsize, maxdims).
+
+    Returns
+    -------
+    str
+        Path to the buffer header.
+    """
+    from p103_mea_memmap import read_set_memmap
+    from p106_matlab_bridge import allocate_buffer
+
+    eeg = read_set_memmap(set_file)
+    if eeg.n_trials > 1:
+        raise ValueError(f"{set_file} is epoched; ASR needs a continuous recording.")
+    n_channels, n_times, sfreq = len(eeg.ch_names), eeg.n_times, eeg.srate
+    block, ref_n = int(block_seconds * sfreq), min(n_times, int(ref_seconds * sfreq))
+    if highpass:
+        from p117_filter_bank import fused_kernel, iter_filtered_blocks
+        h = fused_kernel((('highpass', highpass),), sfreq)
+
+    def blocks(stop=n_times):
+        # (first sample, block) of the raw or high-passed recording
+        if highpass:
+            yield from iter_filtered_blocks(eeg, h, block, stop=stop)
+            return
+        for first in range(0, stop, block):
+            yield first, eeg[0, :, first:min(first + block, stop)]
+
+    with stage('asr_calibrate') as st:
+        ref = np.concatenate([x for _, x in blocks(ref_n)], axis=1).astype(np.float64)
+        mask = clean_reference(ref, sfreq)
+        if mask.sum() < 15 * sfreq:
+            count('asr.unclean_reference')
+            mask[:] = True
+        st.arrays(reference=ref[:, mask])
+        stream = asr_calibrate(ref[:, mask], sfreq, cutoff=cutoff, max_mem=max_mem, **stream_args)
+        del ref
+
+    if output is None:
+        output = os.path.splitext(os.path.basename(set_file))[0] + '_asr'
+    meta = {'srate': sfreq, 'xmin': eeg.xmin, 'setname': eeg.setname,
+            'chanlocs': [{'labels': ch} for ch in eeg.ch_names], 'event': eeg.events,
+            'nbchan': n_channels, 'pnts': n_times, 'trials': 1, 'units': 'uV',
+            'asr': {'source': os.path.abspath(set_file), 'cutoff': cutoff, 'ref_seconds': ref_seconds,
+                    'ref_clean_samples': int(mask.sum()), 'highpass': highpass}}
+    header_file, arrays = allocate_buffer(output, {'data': ((n_channels, n_times, 1), np.float32)},
+                                          meta=meta, directory=directory)
+    data = arrays['data']
+
+    with stage('asr_process', n_times=n_times):
+        pos = 0
+        for _, x in blocks():
+            out = stream.process(x)
+            data[:, pos:pos + out.shape[1], 0] = out
+            pos += out.shape[1]
+        out = stream.finish()
+        data[:, pos:pos + out.shape[1], 0] = out
+    data.flush()
+    return header_file
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    from p107_interchange import read_interchange
+    from p108_simulate_eeg import simulate_eeg
+
+    with tempfile.TemporaryDirectory() as tmp:
+        set_file = simulate_eeg(os.path.join(tmp, 'asr_demo.set'), n_channels=32, duration=600.0,
+                                seed=1, chirp_duration=0)['file']
+        # Large bursts on a few channels after the calibration minute
+        eeg = np.memmap(set_file.replace('.set', '.fdt'), dtype='<f4', mode='r+', shape=(32, 300000), order='F')
+        for onset in range(60000, 300000, 20000):
+            eeg[:4, onset:onset + 250] += 300 * np.hanning(250)
+        eeg.flush()
+
+        start = time.perf_counter()
+        header = asr_clean_set(set_file, directory=tmp, ref_seconds=60, highpass=1.0)
+        print(f"Cleaned 600 s x 32 channels in {time.perf_counter() - start:.1f} s")
+        clean = read_interchange(header)[0, :4, 60000:60250]
+        print(f"Peak burst amplitude: {np.abs(eeg[:4, 60000:60250]).max():.0f} uV -> {np.abs(clean).max():.0f} uV")
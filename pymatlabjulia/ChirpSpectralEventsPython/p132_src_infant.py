@@ -5,9 +5,11 @@ import numpy as np
 import mne
 from mne.datasets import fetch_fsaverage
 from mne.datasets import sample
-from mne.coreg import Coregistration
 from mne.io import read_info
 
+from p117_filter_bank import filter_inst
+from p133_coreg_cache import get_coregistration, write_montage_positions
+
 # ------------------------------------------------------------------------------
 # Introduction - MNE Source Localization for Infant Auditory Evoked Data
 # ------------------------------------------------------------------------------
@@ -41,10 +43,7 @@ print("Montage set to EGI 128")
 montage = epochs.get_montage()
 # Exporting the current montage information to a file
 montage_file = '/Users/ernie/Documents/ExampleData/Chirp/montage_info.txt'
-with open(montage_file, 'w') as f:
-    for ch in montage.ch_names:
-        pos = montage.get_positions()['ch_pos'][ch]
-        f.write(f"{ch}: {pos}\n")
+write_montage_positions(montage, montage_file)
 print(f"Montage information exported to {montage_file}")
 
 # Saving the preprocessed epochs data to a FIFF file
@@ -70,7 +69,9 @@ epochs.set_eeg_reference(projection=True)
 # Applying a low-pass filter to the epochs to reduce high-frequency noise.
 # The cutoff frequency is set to 30 Hz, which is commonly used in EEG analysis
 # to focus on the brain's electrical activity within the most relevant frequency range.
-epochs.filter(None, 30., fir_design='firwin')
+# The p117 filter bank applies the same kernel as epochs.filter(None, 30., fir_design='firwin')
+# with a cached design and one overlap-add FFT pass.
+filter_inst(epochs, [('lowpass', 30.)], design='firwin')
 # ------------------------------------------------------------------------------
 
 
@@ -97,22 +98,6 @@ subjects_dir = op.dirname(fs_dir)
 subject = mne.datasets.fetch_infant_template("2mo", subjects_dir, verbose=True)
 
 
-# ------------------------------------------------------------------------------
-# Setting Template Transformation File
-# ------------------------------------------------------------------------------
-# Setting the transformation file to 'fsaverage'. This is a built-in 
-# transformation in MNE that aligns EEG data to the 'fsaverage' brain.
-fname_1020 = op.join(subjects_dir, subject, "montages", "10-20-montage.fif")
-mon = mne.channels.read_dig_fif(fname_1020)
-mon.rename_channels({f"EEG{ii:03d}": ch_name for ii, ch_name in enumerate(ch_names, 1)})
-trans = mne.channels.compute_native_head_t(mon)
-raw.set_montage(mon)
-
-
-print(trans)
-trans = mne.channels.compute_native_head_t(montage)
-print(trans)
-
 # ------------------------------------------------------------------------------
 # Constructing Source Space File Path
 # ------------------------------------------------------------------------------
@@ -146,16 +131,14 @@ bem = mne.read_bem_solution(fname_bem)
 # EEG Electrode and MRI Alignment Check
 # ------------------------------------------------------------------------------
 
-fiducials = "auto"  # get fiducials from fsaverage
-coreg = Coregistration(epochs.info, subject, subjects_dir, fiducials=fiducials)
-
-
-coreg = Coregistration(epochs.info, subject, subjects_dir, fiducials="auto")
-coreg.set_scale_mode("uniform")
-coreg.set_scale([144.23, 144.23 ,144.23])
-coreg.fit_fiducials(verbose=True)
-coreg.fit_icp(n_iterations=20, nasion_weight=10.0, verbose=True)
-coreg.fit_icp(n_iterations=20, nasion_weight=10.0, verbose=True)
+# The fitted transform and electrode positions are cached per montage, template
+# subject and scale (p133_coreg_cache.py), so only the first subject of a cohort
+# pays for the fiducial + ICP fit.
+trans, positions = get_coregistration(
+    epochs.info, subject, subjects_dir, scale=[144.23, 144.23, 144.23],
+    fiducials="auto", n_iterations=20, nasion_weight=10.0, verbose=True
+)
+print(trans)
 
 
 fig = mne.viz.plot_alignment(
@@ -163,7 +146,7 @@ fig = mne.viz.plot_alignment(
     subject=subject,
     subjects_dir=subjects_dir,
     eeg=["original"],
-    trans=coreg.trans,
+    trans=trans,
     src=src,
     bem=bem,
     coord_frame="mri",
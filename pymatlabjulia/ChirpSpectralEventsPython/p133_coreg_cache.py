@@ -0,0 +1,321 @@
+# ==============================================================================
+# Persistent Coregistration Cache for Template Source Models
+# ==============================================================================
+# Source analysis with a template MRI (fsaverage, infant templates) aligns the
+# same electrode montage to the same template for every subject. Fitting the
+# coregistration (fiducials + ICP) and reading the montage positions is the
+# same work each time, so the result only needs to be computed once per
+# (montage, template subject, scale) combination.
+#
+# This module stores the fitted head->MRI transform (-trans.fif) together with
+# the electrode positions (head and MRI coordinates) in a cache directory. Later
+# subjects recorded with the same montage load both from disk and go straight
+# to the forward solution.
+#
+# The cache key is a hash of the channel names and positions, the template
+# subject and its files (subjects_dir path and the size and modification time of
+# the fiducial and head surface files), the scale factors and the fit
+# parameters, so changing any of them triggers a new fit instead of silently
+# reusing a stale transform.
+#
+# Main Functions Used:
+# 1. montage_positions - Channel names and positions from one get_positions call.
+# 2. write_montage_positions - Text export of the montage positions.
+# 3. coreg_cache_key - Cache key for montage, template, scale and fit parameters.
+# 4. fit_coregistration - Fiducial + ICP fit with mne.coreg.Coregistration.
+# 5. get_coregistration - Cached trans and electrode positions.
+# 6. cached_montage - DigMontage rebuilt from cached positions.
+# ==============================================================================
+
+import hashlib
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+import mne
+from mne.coreg import Coregistration
+
+from p010_instrument import count
+
+DEFAULT_CACHE_DIR = op.join(op.expanduser('~'), '.cache', 'vhtp', 'coreg')
+
+# Results from this session, so repeated calls do not even touch the disk
+_memory_cache = {}
+
+# ==============================================================================
+# Montage Positions
+# ==============================================================================
+
+def montage_positions(montage):
+    """
+    Channel names and positions of a montage from a single get_positions call.
+
+    Parameters
+    ----------
+    montage : mne.channels.DigMontage
+        Electrode montage.
+
+    Returns
+    -------
+    ch_names : list of str
+        Channel names.
+    ch_pos : ndarray, shape (n_channels, 3)
+        Channel positions in meters.
+    fiducials : dict
+        'nasion', 'lpa' and 'rpa' positions (None if missing) and 'coord_frame'.
+    """
+    positions = montage.get_positions()
+    ch_names = list(positions['ch_pos'])
+    ch_pos = np.array([positions['ch_pos'][ch] for ch in ch_names], dtype=float).reshape(-1, 3)
+    fiducials = {key: positions[key] for key in ('nasion', 'lpa', 'rpa')}
+    fiducials['coord_frame'] = positions['coord_frame']
+    return ch_names, ch_pos, fiducials
+
+
+def write_montage_positions(montage, fname):
+    """
+    Write montage positions to a text file, one 'channel: position' line each.
+
+    Parameters
+    ----------
+    montage : mne.channels.DigMontage
+        Electrode montage.
+    fname : str
+        Output text file.
+    """
+    ch_names, ch_pos, _ = montage_positions(montage)
+    with open(fname, 'w') as f:
+        for ch, pos in zip(ch_names, ch_pos):
+            f.write(f"{ch}: {pos}\n")
+
+# ==============================================================================
+# Coregistration
+# ==============================================================================
+
+def _template_signature(subject, subjects_dir):
+    # Resolved template directory plus (name, size, mtime) of the files the fit
+    # reads, so a different or rebuilt template tree gets its own key
+    subject_dir = op.realpath(op.join(str(subjects_dir), subject))
+    bem_dir = op.join(subject_dir, 'bem')
+    files = sorted(f for f in os.listdir(bem_dir) if f.endswith('.fif') and
+                   ('fiducials' in f or 'head' in f)) if op.isdir(bem_dir) else []
+    stats = [(f, os.stat(op.join(bem_dir, f)).st_size, os.stat(op.join(bem_dir, f)).st_mtime_ns) for f in files]
+    return {'subject_dir': subject_dir, 'files': stats}
+
+
+def coreg_cache_key(montage, subject, scale=None, subjects_dir=None, **fit_params):
+    """
+    Cache key for a montage, template subject, scale and fit parameters.
+
+    Parameters
+    ----------
+    montage : mne.channels.DigMontage
+        Electrode montage (names and positions are hashed).
+    subject : str
+        Template subject name.
+    subjects_dir : str | None
+        FreeSurfer subjects directory. The template's location and its
+        fiducial and head surface files enter the key.
+    scale : float | sequence of float | None
+        Scale factors applied to the template.
+    **fit_params
+        Additional fit parameters that change the result.
+
+    Returns
+    -------
+    str
+        16 character hexadecimal key.
+    """
+    ch_names, ch_pos, _ = montage_positions(montage)
+    h = hashlib.sha1()
+    h.update(subject.encode())
+    h.update('\n'.join(ch_names).encode())
+    # Round to micrometers so float noise does not change the key
+    h.update(np.round(ch_pos, 6).astype('<f8').tobytes())
+    scale = None if scale is None else [round(float(s), 6) for s in np.atleast_1d(scale)]
+    template = None if subjects_dir is None else _template_signature(subject, subjects_dir)
+    h.update(json.dumps({'scale': scale, 'template': template, **fit_params},
+                        sort_keys=True, default=str).encode())
+    return h.hexdigest()[:16]
+
+
+def fit_coregistration(info, subject, subjects_dir, scale=None, fiducials='auto',
+                       n_iterations=20, nasion_weight=10.0, verbose=None):
+    """
+    Fit the head->MRI transform with fiducial alignment followed by ICP.
+
+    Parameters
+    ----------
+    info : mne.Info
+        Measurement info with a montage set.
+    subject : str
+        Template subject name.
+    subjects_dir : str
+        FreeSurfer subjects directory.
+    scale : float | sequence of float | None
+        Uniform (one value, or three equal values) or 3-axis scale factors.
+        None fits without scaling.
+    fiducials : str | dict
+        MRI fiducials passed to Coregistration ('auto' uses the template's).
+    n_iterations : int
+        Maximum ICP iterations.
+    nasion_weight : float
+        Weight of the nasion in the ICP fit.
+    verbose : bool | None
+        MNE verbosity.
+
+    Returns
+    -------
+    mne.transforms.Transform
+        Head->MRI transform.
+    """
+    coreg = Coregistration(info, subject, subjects_dir, fiducials=fiducials)
+    if scale is not None:
+        scale = np.atleast_1d(np.asarray(scale, dtype=float))
+        coreg.set_scale_mode('uniform' if np.all(scale == scale[0]) else '3-axis')
+        coreg.set_scale(np.broadcast_to(scale, 3))
+    coreg.fit_fiducials(verbose=verbose)
+    coreg.fit_icp(n_iterations=n_iterations, nasion_weight=nasion_weight, verbose=verbose)
+    return coreg.trans
+
+
+def _cache_paths(cache_dir, subject, key):
+    stem = op.join(cache_dir, f"{subject}-{key}")
+    return stem + '-trans.fif', stem + '-pos.npz'
+
+
+def get_coregistration(info, subject, subjects_dir, scale=None, cache_dir=None,
+                       overwrite=False, fiducials='auto', n_iterations=20,
+                       nasion_weight=10.0, verbose=None):
+    """
+    Cached head->MRI transform and electrode positions for a template subject.
+
+    On a cache miss the coregistration is fitted once and written to
+    ``cache_dir``; afterwards every subject with the same montage loads the
+    stored transform and positions.
+
+    Parameters
+    ----------
+    info : mne.Info
+        Measurement info with a montage set.
+    subject : str
+        Template subject name (e.g. 'fsaverage' or an infant template).
+    subjects_dir : str
+        FreeSurfer subjects directory.
+    scale : float | sequence of float | None
+        Scale factors applied to the template.
+    cache_dir : str | None
+        Cache directory. Defaults to ~/.cache/vhtp/coreg.
+    overwrite : bool
+        Refit even if a cached result exists.
+    fiducials, n_iterations, nasion_weight, verbose
+        See fit_coregistration.
+
+    Returns
+    -------
+    trans : mne.transforms.Transform
+        Head->MRI transform.
+    positions : dict
+        'ch_names', 'ch_pos' (head coordinates), 'ch_pos_mri' (MRI coordinates),
+        'nasion', 'lpa', 'rpa' (head coordinates) and 'key'.
+    """
+    montage = info.get_montage()
+    if montage is None:
+        raise ValueError("info has no montage; call set_montage before coregistration.")
+
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    key = coreg_cache_key(montage, subject, scale, subjects_dir, fiducials=fiducials,
+                          n_iterations=n_iterations, nasion_weight=nasion_weight)
+    trans_file, pos_file = _cache_paths(cache_dir, subject, key)
+
+    if not overwrite:
+        if key in _memory_cache:
+            count('coreg_cache.hit')
+            return _memory_cache[key]
+        if op.exists(trans_file) and op.exists(pos_file):
+            trans = mne.read_trans(trans_file)
+            with np.load(pos_file, allow_pickle=False) as saved:
+                positions = {name: saved[name] for name in saved.files}
+            positions['ch_names'] = positions['ch_names'].tolist()
+            for fid in ('nasion', 'lpa', 'rpa'):
+                if positions[fid].size == 0:
+                    positions[fid] = None
+            positions['key'] = key
+            _memory_cache[key] = trans, positions
+            count('coreg_cache.hit')
+            print(f"Loaded cached coregistration {trans_file}")
+            return trans, positions
+
+    count('coreg_cache.miss')
+    trans = fit_coregistration(info, subject, subjects_dir, scale=scale, fiducials=fiducials,
+                               n_iterations=n_iterations, nasion_weight=nasion_weight,
+                               verbose=verbose)
+
+    ch_names, ch_pos, fids = montage_positions(montage)
+    positions = {
+        'ch_names': ch_names,
+        'ch_pos': ch_pos,
+        'ch_pos_mri': mne.transforms.apply_trans(trans, ch_pos),
+    }
+    for fid in ('nasion', 'lpa', 'rpa'):
+        positions[fid] = None if fids[fid] is None else np.asarray(fids[fid], dtype=float)
+
+    # Write to temporary names first so an interrupted run never leaves a
+    # half-written entry that later runs would load
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_trans = trans_file[:-len('-trans.fif')] + f".tmp{os.getpid()}-trans.fif"
+    tmp_pos = pos_file[:-len('.npz')] + f".tmp{os.getpid()}.npz"
+    mne.write_trans(tmp_trans, trans, overwrite=True)
+    np.savez(tmp_pos, ch_names=np.array(ch_names), ch_pos=positions['ch_pos'],
+             ch_pos_mri=positions['ch_pos_mri'],
+             **{fid: np.empty(0) if positions[fid] is None else positions[fid]
+                for fid in ('nasion', 'lpa', 'rpa')})
+    os.replace(tmp_trans, trans_file)
+    os.replace(tmp_pos, pos_file)
+    print(f"Saved coregistration to {trans_file}")
+
+    positions['key'] = key
+    _memory_cache[key] = trans, positions
+    return trans, positions
+
+
+def cached_montage(positions):
+    """
+    Rebuild a head-coordinate DigMontage from cached positions.
+
+    Parameters
+    ----------
+    positions : dict
+        Positions returned by get_coregistration.
+
+    Returns
+    -------
+    mne.channels.DigMontage
+        Montage that can be passed to set_montage without reading the template.
+    """
+    return mne.channels.make_dig_montage(
+        ch_pos=dict(zip(positions['ch_names'], positions['ch_pos'])),
+        nasion=positions['nasion'], lpa=positions['lpa'], rpa=positions['rpa'],
+        coord_frame='head')
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    from mne.datasets import fetch_fsaverage
+
+    eeg_file = '/Users/ernie/Documents/ExampleData/Chirp/128_Chirp_D0657_DIN8.set'
+    epochs = mne.io.read_epochs_eeglab(eeg_file)
+    epochs.set_montage(mne.channels.make_standard_montage('GSN-HydroCel-128'))
+
+    subjects_dir = op.dirname(fetch_fsaverage(verbose=True))
+    subject = mne.datasets.fetch_infant_template("2mo", subjects_dir, verbose=True)
+
+    # First call fits and stores; later subjects with the same montage load from disk
+    trans, positions = get_coregistration(epochs.info, subject, subjects_dir,
+                                          scale=[144.23, 144.23, 144.23])
+    print(trans)
+    print(f"{len(positions['ch_names'])} electrodes, cache key {positions['key']}")
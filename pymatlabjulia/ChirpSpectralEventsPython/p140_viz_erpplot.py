@@ -1,6 +1,8 @@
 import mne
 import os 
 
+from p170_roi_operator import RoiOperator, get_roi_operator
+
 # ==============================================================================
 # File Loading Stage
 # ==============================================================================
@@ -64,6 +66,14 @@ left_temporal_regions = [channel for channel in channel_names if "temporal" in c
 # Criteria: Name contains "temporal" and ends with "R"
 right_temporal_regions = [channel for channel in channel_names if "temporal" in channel and channel.endswith("R")]
 
+# Optional: set to 'DK_atlas-68_dict.csv' to use the DK atlas LT/RT regions of
+# chanfiles/ instead (the eeg_htpAverageStructByRegion grouping, which also
+# includes insula, fusiform, entorhinal, parahippocampal and bankssts)
+roi_dictionary = None
+if roi_dictionary is not None:
+    dk_roi = get_roi_operator(roi_dictionary, channel_names)
+    left_temporal_regions, right_temporal_regions = dk_roi.channels('LT'), dk_roi.channels('RT')
+
 # Display the identified left and right temporal regions
 print("Updated Left Temporal Regions:", left_temporal_regions)
 print("Updated Right Temporal Regions:", right_temporal_regions)
@@ -76,18 +86,15 @@ print("Updated Right Temporal Regions:", right_temporal_regions)
 # The channels are grouped by their respective regions (left or right), 
 # and the mean evoked response for each group is calculated and plotted.
 
-# Select channels corresponding to the left temporal regions
-left_ix = mne.pick_channels(evoked.info["ch_names"], include=left_temporal_regions)
-# Select channels corresponding to the right temporal regions
-right_ix = mne.pick_channels(evoked.info["ch_names"], include=right_temporal_regions)
-
-# Create a dictionary to map the region of interest (ROI) names to their respective channel indices
-roi_dict = dict(left_ROI=left_ix, right_ROI=right_ix)
+# Map the region of interest (ROI) names to their channels; the ROI operator is a
+# sparse region x channel weight matrix (p170)
+roi = RoiOperator(dict(left_ROI=left_temporal_regions, right_ROI=right_temporal_regions), channel_names)
 # Create a dictionary to specify the titles for the plots corresponding to each ROI
 roi_titles = dict(left_ROI="Left Temporal Regions", right_ROI="Right Temporal Regions")
 
 # Combine channels within each ROI using the mean method to get the average evoked response
-roi_evoked = mne.channels.combine_channels(evoked, groups=roi_dict, method="mean")
+# (one sparse matrix product for all regions, as mne.channels.combine_channels with method="mean")
+roi_evoked = roi.apply_inst(evoked)
 
 # Print the channel names for the combined ROIs
 print(roi_evoked.info["ch_names"])
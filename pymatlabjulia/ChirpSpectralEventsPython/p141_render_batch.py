@@ -0,0 +1,414 @@
+# ==============================================================================
+# Batch Figure Rendering for Cohort QC
+# ==============================================================================
+# The visualization scripts (p140_viz_chirp.py, p140_viz_erpplot.py,
+# 153_compare_powspectrum.py, p154_fooof_3dplot.py) build their figures one
+# file at a time with plt.show(). This module renders the same figures for a
+# whole cohort without a display:
+#
+#   psd             - Channel PSDs, 0-80 Hz (p140_viz_chirp)
+#   erp             - Evoked response of one channel (p140_viz_chirp)
+#   epochs_image    - Epochs image of one channel (p140_viz_chirp)
+#   gfp             - Global field power (p140_viz_erpplot)
+#   roi_evoked      - Left/right temporal ROI evoked responses (p140_viz_erpplot)
+#   psd_comparison  - Two-channel Welch PSD in dB (153_compare_powspectrum)
+#   specparam       - Spectral parameterization group report (p154, needs specparam)
+#
+# Files are rendered in parallel on a process pool with the Agg backend; each
+# file is loaded once and all of its figures are drawn from it.
+#
+# Every PNG is named by a hash of the input file (path, size, modification
+# time), the figure name and its parameters. A figure whose hash already
+# exists on disk is not rendered again, and a file whose figures are all
+# cached is not even loaded, so re-running QC after adding subjects only
+# renders the new ones. A manifest CSV lists every figure for review.
+#
+# Main Functions Used:
+# 1. load_recording - Raw, epochs and evoked for one file as in the p140 scripts.
+# 2. render_figure - Draw one named figure.
+# 3. figure_key - Cache key of a file, figure and parameters.
+# 4. render_batch - Render figures for many files on a process pool.
+# ==============================================================================
+
+import argparse
+import csv
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Must be set before matplotlib is imported anywhere in this process
+os.environ['MPLBACKEND'] = 'Agg'
+
+import numpy as np
+
+from p010_instrument import instrument_file, stage
+
+# Bump when a renderer changes so cached figures are redrawn
+RENDER_VERSION = 1
+
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'vhtp', 'figures')
+
+# Default parameters per figure; overrides are merged into these
+FIGURE_PARAMS = {
+    'psd': {'fmin': 0, 'fmax': 80},
+    'erp': {'channel': 0},
+    'epochs_image': {'channel': 0},
+    'gfp': {},
+    'roi_evoked': {'left': '*temporal*L', 'right': '*temporal*R'},
+    'psd_comparison': {'channel_1': 1, 'channel_2': 2, 'fmax': 30, 'notch': [55, 65]},
+    'specparam': {'freq_range': [3, 40], 'peak_width_limits': [1.0, 8.0], 'max_n_peaks': 5,
+                  'aperiodic_mode': 'knee'},
+}
+
+# ==============================================================================
+# Loading
+# ==============================================================================
+
+def load_recording(set_file, points_per_trial=1626, n_trials=80):
+    """
+    Raw, epochs and evoked data for one file, prepared as in the p140 scripts.
+
+    Epoched files are concatenated into a continuous recording for the
+    raw-based figures.
+
+    Parameters
+    ----------
+    set_file : str
+        EEGLAB .set file.
+    points_per_trial : int
+        Samples per trial when cutting continuous data.
+    n_trials : int
+        Number of trials kept.
+
+    Returns
+    -------
+    dict
+        'raw', 'epochs' and 'evoked'.
+    """
+    import mne
+
+    with stage('load') as st:
+        try:
+            raw = mne.io.read_raw_eeglab(set_file, preload=True, verbose=False)
+            epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial / raw.info['sfreq'],
+                                                  preload=True, verbose=False)
+        except (ValueError, TypeError):
+            epochs = mne.io.read_epochs_eeglab(set_file, verbose=False)
+            raw = mne.io.RawArray(np.concatenate(list(epochs.get_data()), axis=-1), epochs.info,
+                                  verbose=False)
+        epochs = epochs[:n_trials]
+        st.arrays(raw=raw, epochs=epochs)
+    return {'raw': raw, 'epochs': epochs, 'evoked': epochs.average()}
+
+# ==============================================================================
+# Renderers
+# ==============================================================================
+# Each renderer takes the loaded recording and its parameters and returns a
+# matplotlib Figure (or None when the recording has nothing to draw).
+
+def _fig_psd(rec, fmin, fmax):
+    spectrum = rec['raw'].compute_psd(fmin=fmin, fmax=fmax, verbose=False)
+    return spectrum.plot(average=False, amplitude=False, show=False)
+
+
+def _fig_erp(rec, channel):
+    return rec['evoked'].plot(picks=[channel], time_unit='s', show=False)
+
+
+def _fig_epochs_image(rec, channel):
+    return rec['epochs'].plot_image(picks=[channel], show=False)[0]
+
+
+def _fig_gfp(rec):
+    return rec['evoked'].plot(gfp='only', show=False)
+
+
+def _fig_roi_evoked(rec, left, right):
+    import fnmatch
+    import mne
+
+    evoked = rec['evoked']
+    groups = {}
+    for roi, pattern in (('left_ROI', left), ('right_ROI', right)):
+        names = fnmatch.filter(evoked.ch_names, pattern)
+        if names:
+            groups[roi] = mne.pick_channels(evoked.ch_names, include=names)
+    if not groups:
+        return None
+    roi_evoked = mne.channels.combine_channels(evoked, groups=groups, method='mean')
+    titles = dict(left_ROI='Left Temporal Regions', right_ROI='Right Temporal Regions')
+    return roi_evoked.plot(spatial_colors=False, gfp=False, titles=titles, show=False)
+
+
+def _welch_uv(raw):
+    from scipy.signal import welch
+
+    sf = raw.info['sfreq']
+    # neurodsp compute_spectrum(method='welch', avg_type='mean', nperseg=2*sf)
+    return welch(raw.get_data(units='uV'), sf, nperseg=int(sf * 2), average='mean')
+
+
+def _fig_psd_comparison(rec, channel_1, channel_2, fmax, notch):
+    import matplotlib.pyplot as plt
+
+    freqs, psd_chans = _welch_uv(rec['raw'])
+    chan_names = rec['raw'].ch_names
+    keep = (freqs >= 0) & (freqs <= fmax) & ~((freqs >= notch[0]) & (freqs <= notch[1]))
+    fig, ax = plt.subplots(figsize=(7, 5))
+    ax.plot(freqs[keep], 10 * np.log10(psd_chans[channel_1, keep]), label=chan_names[channel_1], color='blue')
+    ax.plot(freqs[keep], 10 * np.log10(psd_chans[channel_2, keep]), label=chan_names[channel_2], color='red')
+    ax.set_xlabel('Frequency (Hz)')
+    ax.set_ylabel('Power Spectral Density (dB)')
+    ax.set_title(f'PSD Comparison: {chan_names[channel_1]} vs {chan_names[channel_2]} '
+                 f'(0-{fmax} Hz, excluding {notch[0]}-{notch[1]} Hz)')
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+
+def _fig_specparam(rec, freq_range, peak_width_limits, max_n_peaks, aperiodic_mode):
+    import matplotlib.pyplot as plt
+    from specparam import SpectralGroupModel
+
+    freqs, psd_chans = _welch_uv(rec['raw'])
+    fg = SpectralGroupModel(peak_width_limits=peak_width_limits, aperiodic_mode=aperiodic_mode,
+                            max_n_peaks=max_n_peaks, verbose=False)
+    fg.fit(freqs, psd_chans, freq_range)
+    fg.plot()
+    return plt.gcf()
+
+
+# Optional packages a renderer needs; figures are skipped when they are missing
+REQUIRES = {'specparam': 'specparam'}
+
+RENDERERS = {
+    'psd': _fig_psd,
+    'erp': _fig_erp,
+    'epochs_image': _fig_epochs_image,
+    'gfp': _fig_gfp,
+    'roi_evoked': _fig_roi_evoked,
+    'psd_comparison': _fig_psd_comparison,
+    'specparam': _fig_specparam,
+}
+
+
+def render_figure(rec, name, params=None):
+    """
+    Draw one named figure for a loaded recording.
+
+    Parameters
+    ----------
+    rec : dict
+        Output of load_recording.
+    name : str
+        Figure name (key of RENDERERS).
+    params : dict | None
+        Parameters overriding FIGURE_PARAMS[name].
+
+    Returns
+    -------
+    matplotlib.figure.Figure | None
+        The figure, or None if the recording has nothing to draw for it.
+    """
+    return RENDERERS[name](rec, **{**FIGURE_PARAMS[name], **(params or {})})
+
+# ==============================================================================
+# Caching
+# ==============================================================================
+
+def figure_key(set_file, name, params=None):
+    """
+    Cache key of a figure: input file identity, figure name and parameters.
+
+    Parameters
+    ----------
+    set_file : str
+        Input .set file (path, size and modification time are hashed).
+    name : str
+        Figure name.
+    params : dict | None
+        Parameters overriding FIGURE_PARAMS[name].
+
+    Returns
+    -------
+    str
+        12 character hexadecimal key.
+    """
+    stat = os.stat(set_file)
+    fdt_file = os.path.splitext(set_file)[0] + '.fdt'
+    fdt_stat = os.stat(fdt_file) if os.path.exists(fdt_file) else None
+    identity = {
+        'file': os.path.abspath(set_file), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+        'fdt': None if fdt_stat is None else [fdt_stat.st_size, fdt_stat.st_mtime_ns],
+        'figure': name, 'params': {**FIGURE_PARAMS[name], **(params or {})}, 'version': RENDER_VERSION,
+    }
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _figure_path(output_dir, set_file, name, key):
+    base = os.path.splitext(os.path.basename(set_file))[0]
+    return os.path.join(output_dir, base, f"{name}-{key}.png")
+
+
+def _empty_marker(png_file):
+    # Recordings with nothing to draw (e.g. no temporal ROI channels) are
+    # cached too, so they are not loaded again on the next run
+    return png_file[:-len('.png')] + '.empty'
+
+
+def _remove_stale(output_dir, set_file, name, keep):
+    base = os.path.splitext(os.path.basename(set_file))[0]
+    for old in glob.glob(os.path.join(output_dir, base, f"{name}-*")):
+        if old not in (keep, _empty_marker(keep)):
+            os.remove(old)
+
+# ==============================================================================
+# Batch Rendering
+# ==============================================================================
+
+def _render_file(set_file, todo, output_dir, dpi):
+    """Load one file and render the figures in todo ({name: (params, png)})."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import mne
+    mne.set_log_level('ERROR')
+
+    results = []
+    with instrument_file(set_file, figures=len(todo)):
+        rec = load_recording(set_file)
+        for name, (params, png_file) in todo.items():
+            try:
+                with stage('render', figure=name):
+                    fig = render_figure(rec, name, params)
+                    os.makedirs(os.path.dirname(png_file), exist_ok=True)
+                    if fig is None:
+                        open(_empty_marker(png_file), 'w').close()
+                        _remove_stale(output_dir, set_file, name, png_file)
+                        results.append((name, '', 'empty'))
+                        continue
+                    tmp_file = png_file[:-len('.png')] + f".tmp{os.getpid()}.png"
+                    fig.savefig(tmp_file, dpi=dpi)
+                    os.replace(tmp_file, png_file)
+                _remove_stale(output_dir, set_file, name, png_file)
+                results.append((name, png_file, 'rendered'))
+            except Exception as err:
+                results.append((name, '', f"error: {type(err).__name__}: {err}"))
+            finally:
+                plt.close('all')
+    return results
+
+
+def render_batch(files, figures=None, params=None, output_dir=DEFAULT_OUTPUT_DIR,
+                 n_workers=None, force=False, dpi=100):
+    """
+    Render QC figures for many files on a process pool, reusing cached figures.
+
+    Parameters
+    ----------
+    files : list of str
+        Input .set files.
+    figures : list of str | None
+        Figure names (keys of RENDERERS). Defaults to all.
+    params : dict | None
+        Per-figure parameter overrides, e.g. {'erp': {'channel': 5}}.
+    output_dir : str
+        Directory for the figures (one subdirectory per input file).
+    n_workers : int | None
+        Pool processes. Defaults to the number of CPUs.
+    force : bool
+        Render even if a cached figure exists.
+    dpi : int
+        Figure resolution.
+
+    Returns
+    -------
+    list of dict
+        One entry per file and figure with 'file', 'figure', 'png' and
+        'status' ('cached', 'rendered', 'empty', 'skipped: ...', 'error: ...').
+        Figures whose packages are not installed are skipped.
+        Also written to render_manifest.csv in output_dir.
+    """
+    figures = list(RENDERERS) if figures is None else figures
+    params = params or {}
+    missing = {name: REQUIRES[name] for name in figures
+               if name in REQUIRES and importlib.util.find_spec(REQUIRES[name]) is None}
+    manifest = []
+    jobs = {}
+    for set_file in files:
+        todo = {}
+        for name in figures:
+            try:
+                png_file = _figure_path(output_dir, set_file, name, figure_key(set_file, name, params.get(name)))
+            except OSError as err:
+                # A missing or unreadable file fails on its own; the cohort carries on
+                manifest.append({'file': set_file, 'figure': name, 'png': '',
+                                 'status': f"error: {type(err).__name__}: {err}"})
+                continue
+            if name in missing:
+                manifest.append({'file': set_file, 'figure': name, 'png': '',
+                                 'status': f"skipped: {missing[name]} not installed"})
+            elif force:
+                todo[name] = (params.get(name), png_file)
+            elif os.path.exists(png_file):
+                manifest.append({'file': set_file, 'figure': name, 'png': png_file, 'status': 'cached'})
+            elif os.path.exists(_empty_marker(png_file)):
+                manifest.append({'file': set_file, 'figure': name, 'png': '', 'status': 'empty'})
+            else:
+                todo[name] = (params.get(name), png_file)
+        if todo:
+            jobs[set_file] = todo
+
+    print(f"{len(files)} files: rendering {sum(map(len, jobs.values()))} figures, "
+          f"{sum(row['status'] in ('cached', 'empty') for row in manifest)} cached")
+    if jobs:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(_render_file, set_file, todo, output_dir, dpi): set_file
+                       for set_file, todo in jobs.items()}
+            for future in as_completed(futures):
+                set_file = futures[future]
+                try:
+                    results = future.result()
+                except Exception as err:
+                    results = [(name, '', f"error: {type(err).__name__}: {err}") for name in jobs[set_file]]
+                for name, png_file, status in results:
+                    manifest.append({'file': set_file, 'figure': name, 'png': png_file, 'status': status})
+                print(f"  {os.path.basename(set_file)}: "
+                      f"{sum(status == 'rendered' for _, _, status in results)}/{len(results)} rendered")
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'render_manifest.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['file', 'figure', 'png', 'status'])
+        writer.writeheader()
+        writer.writerows(sorted(manifest, key=lambda row: (row['file'], row['figure'])))
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='p141_render_batch.py',
+                                     description='Render QC figures for a cohort without a display.')
+    parser.add_argument('files', nargs='+', help='.set files or glob patterns')
+    parser.add_argument('--figures', nargs='+', choices=list(RENDERERS), default=None)
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='ignore cached figures')
+    parser.add_argument('--params', type=json.loads, default=None,
+                        help='JSON per-figure overrides, e.g. \'{"erp": {"channel": 5}}\'')
+    parser.add_argument('--dpi', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    files = sorted({f for pattern in args.files for f in (glob.glob(pattern) or [pattern])})
+    manifest = render_batch(files, args.figures, args.params, args.output_dir,
+                            args.workers, args.force, args.dpi)
+    return int(any(row['status'].startswith('error') for row in manifest))
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    sys.exit(main())
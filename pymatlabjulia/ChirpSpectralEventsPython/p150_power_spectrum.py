@@ -10,16 +10,16 @@
 # 2. mne.make_fixed_length_epochs - Creates epochs from continuous EEG data.
 # 3. raw.compute_psd - Computes PSD for continuous EEG data using the Welch method.
 # 4. epochs.compute_psd - Computes PSD for epoched EEG data using the Welch method.
+# 5. compute_multitaper - Gamma-band multitaper PSD with cached tapers (p156).
 # ==============================================================================
 
 import mne
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import os
 import pandas as pd
 
-sns.set(style='white', font_scale=1.2)
+from p010_instrument import finish_file, install_hooks, stage, track_file
+from p156_multitaper import compute_multitaper, psd_to_frame
 
 
 # ==============================================================================
@@ -36,8 +36,14 @@ chirp_file = '/Users/ernie/Documents/ExampleData/Chirp/D0179_chirp-ST_postcomp_M
 file_basename = os.path.basename(chirp_file)
 print(f"Processing file: {file_basename}")
 
+# Record this file (and a failure) even if the script stops early
+install_hooks()
+
 # Read EEG data from the first .set file in the list
-raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+track_file(chirp_file)
+with stage('load') as st:
+    raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+    st.arrays(raw=raw)
 
 # Extract sampling frequency and channel names from the data
 sf = raw.info['sfreq']  # Sampling frequency (Hz)
@@ -48,8 +54,10 @@ no_of_channels = len(raw.info['ch_names'])  # Total number of EEG channels
 points_per_trial = 1626  # Number of time points per trial
 no_of_trials = 80  # Total number of trials
 
-epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
-epochs = epochs[:no_of_trials]
+with stage('epoch') as st:
+    epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
+    epochs = epochs[:no_of_trials]
+    st.arrays(epochs=epochs)
 
 evoked = epochs.average()
 # ==============================================================================
@@ -64,12 +72,14 @@ evoked = epochs.average()
 # the PSD for both continuous and epoched data. Output is to CSV table.
 
 # Compute PSD for the continuous EEG data using the Welch method
-psd_cont = raw.compute_psd(method="welch",  fmin=.5, fmax=80, picks="eeg")  # PSD for continuous data
-psd_cont.shape  # Shape of the PSD array for continuous data
+with stage('psd', method='welch') as st:
+    psd_cont = raw.compute_psd(method="welch",  fmin=.5, fmax=80, picks="eeg")  # PSD for continuous data
+    psd_cont.shape  # Shape of the PSD array for continuous data
 
-# Compute PSD for the epoched EEG data using the Welch method
-psd_epoch = epochs.compute_psd(method="welch",  fmin=.5, fmax=80, picks="eeg")  # PSD for epoched data
-psd_epoch.shape  # Shape of the PSD array for epoched data
+    # Compute PSD for the epoched EEG data using the Welch method
+    psd_epoch = epochs.compute_psd(method="welch",  fmin=.5, fmax=80, picks="eeg")  # PSD for epoched data
+    psd_epoch.shape  # Shape of the PSD array for epoched data
+    st.arrays(psd_cont=psd_cont, psd_epoch=psd_epoch)
 
 
 # ==============================================================================
@@ -82,12 +92,16 @@ psd_epoch.shape  # Shape of the PSD array for epoched data
 # for continuous data series, as it enables the extraction of a denser frequency spectrum. Consequently, the Multitaper
 # method is superior in revealing a broader range of frequencies within the gamma band, as opposed to the Welch method,
 # especially in the context of unepoched (longer) data series.
-psd_mt_cont = raw.compute_psd(method="multitaper",  fmin=30, fmax=80, picks="eeg")  # Calculating PSD for continuous data within the gamma band
-psd_mt_cont.shape  # Shape of the PSD array for continuous data
+# The p156 engine returns the same PSD as compute_psd(method="multitaper") with cached DPSS tapers,
+# all epochs x channels in one batch, and the continuous recording processed in channel chunks.
+with stage('psd', method='multitaper') as st:
+    psd_mt_cont, mt_freqs, mt_chans = compute_multitaper(raw, fmin=30, fmax=80, picks="eeg")  # Calculating PSD for continuous data within the gamma band
+    psd_mt_cont.shape  # Shape of the PSD array for continuous data
 
-# Similarly, for the epoched EEG data, we utilize the Multitaper method to calculate the PSD within the gamma frequency band.
-psd_mt_epoch = epochs.compute_psd(method="multitaper",  fmin=30, fmax=80, picks="eeg")  # Calculating PSD for epoched data within the gamma band
-psd_mt_epoch.shape  # Shape of the PSD array for epoched data
+    # Similarly, for the epoched EEG data, we utilize the Multitaper method to calculate the PSD within the gamma frequency band.
+    psd_mt_epoch, mt_freqs, mt_chans = compute_multitaper(epochs, fmin=30, fmax=80, picks="eeg")  # Calculating PSD for epoched data within the gamma band
+    psd_mt_epoch.shape  # Shape of the PSD array for epoched data
+    st.arrays(psd_mt_cont=psd_mt_cont, psd_mt_epoch=psd_mt_epoch)
 
 
 # ==================================================================================
@@ -102,14 +116,14 @@ psd_mt_epoch.shape  # Shape of the PSD array for epoched data
 # Convert PSD data from numpy arrays to pandas DataFrames for easier manipulation and analysis
 psd_cont_df = psd_cont.to_data_frame()  # PSD data from continuous EEG using Welch method
 psd_epoch_df = psd_epoch.to_data_frame()  # PSD data from epoched EEG using Welch method
-psd_mt_cont_df = psd_mt_cont.to_data_frame()  # PSD data from continuous EEG using Multitaper method
-psd_mt_epoch_df = psd_mt_epoch.to_data_frame()  # PSD data from epoched EEG using Multitaper method
+psd_mt_cont_df = psd_to_frame(psd_mt_cont, mt_freqs, mt_chans)  # PSD data from continuous EEG using Multitaper method
+psd_mt_epoch_df = psd_to_frame(psd_mt_epoch, mt_freqs, mt_chans, epochs)  # PSD data from epoched EEG using Multitaper method
 
 # Convert PSD data to dataframes
 psd_cont_df = psd_cont.to_data_frame()
 psd_epoch_df = psd_epoch.to_data_frame()
-psd_mt_cont_df = psd_mt_cont.to_data_frame()
-psd_mt_epoch_df = psd_mt_epoch.to_data_frame()
+psd_mt_cont_df = psd_to_frame(psd_mt_cont, mt_freqs, mt_chans)
+psd_mt_epoch_df = psd_to_frame(psd_mt_epoch, mt_freqs, mt_chans, epochs)
 
 # Add columns to specify data source, method, and filename at the beginning of the dataframe
 filename = file_basename  # Assuming the filename is static for this example
@@ -127,7 +141,10 @@ print(combined_psd_df.head())
 
 # Export the combined dataframe to a CSV file
 script_name = os.path.basename(__file__).replace('.py', '_pow_spectrum.csv')
-combined_psd_df.to_csv(script_name, index=False)
+with stage('export') as st:
+    combined_psd_df.to_csv(script_name, index=False)
+    st.arrays(combined_psd_df=combined_psd_df)
+finish_file()
 
 
 
@@ -19,12 +19,10 @@
 import mne
 import yasa
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import os
 import pandas as pd
 
-sns.set(style='white', font_scale=1.2)
+from p010_instrument import finish_file, install_hooks, stage, track_file
 
 # ==============================================================================
 # File Loading Stage
@@ -40,8 +38,14 @@ chirp_file = '/Users/ernie/Documents/ExampleData/Chirp/D0179_chirp-ST_postcomp_M
 file_basename = os.path.basename(chirp_file)
 print(f"Processing file: {file_basename}")
 
+# Record this file (and a failure) even if the script stops early
+install_hooks()
+
 # Read EEG data from the first .set file in the list
-raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+track_file(chirp_file)
+with stage('load') as st:
+    raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+    st.arrays(raw=raw)
 
 # Extract sampling frequency and channel names from the data
 sf = raw.info['sfreq']  # Sampling frequency (Hz)
@@ -52,8 +56,10 @@ no_of_channels = len(raw.info['ch_names'])  # Total number of EEG channels
 points_per_trial = 1626  # Number of time points per trial
 no_of_trials = 80  # Total number of trials
 
-epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
-epochs = epochs[:no_of_trials]
+with stage('epoch') as st:
+    epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
+    epochs = epochs[:no_of_trials]
+    st.arrays(epochs=epochs)
 
 evoked = epochs.average()
 # ==============================================================================
@@ -75,8 +81,15 @@ evoked = epochs.average()
 bands = [(2, 3.5, 'Delta'), (3.5, 7, 'Theta'), (7.5, 12.5, 'Alpha'), (7.5, 10.5, 'Alpha1'), 
          (10.5, 12.5, 'Alpha2'), (15, 30, 'Beta'), (30, 55, 'Gamma1'), (65, 80, 'Gamma2')]
 
-powtable_abs = yasa.bandpower(raw, sf=sf, bandpass=True, relative=False, bands=bands)
-powtable_rel = yasa.bandpower(raw, sf=sf, bandpass=True, relative=True, bands=bands)
+# One yasa pass (filter, Welch, integration); relative power is the absolute band power over
+# TotalAbsPow, which is exactly what yasa computes for relative=True
+with stage('bandpower') as st:
+    powtable_abs = yasa.bandpower(raw, sf=sf, bandpass=True, relative=False, bands=bands)
+    band_names = [band[2] for band in bands]
+    powtable_rel = powtable_abs.copy()
+    powtable_rel[band_names] = powtable_abs[band_names].div(powtable_abs['TotalAbsPow'], axis=0)
+    powtable_rel['Relative'] = True
+    st.arrays(powtable_abs=powtable_abs, powtable_rel=powtable_rel)
 powtable_combined = pd.concat([powtable_abs, powtable_rel], axis=0)
 powtable_combined = np.round(powtable_combined, 6)  # Round the bandpower values
 
@@ -86,4 +99,6 @@ powtable_combined.insert(0, 'filename', file_basename)
 
 # Write to CSV
 csv_filename = os.path.basename(__file__).replace('.py','.csv')
-powtable_combined.to_csv(csv_filename)
+with stage('export'):
+    powtable_combined.to_csv(csv_filename)
+finish_file()
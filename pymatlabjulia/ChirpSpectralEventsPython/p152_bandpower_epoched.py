@@ -9,7 +9,7 @@
 # 1. mne.io.read_raw_eeglab - Reads EEG data from .set files.
 # 2. yasa.sliding_window - Creates sliding windows for the data.
 # 3. scipy.signal.welch - Calculates the Power Spectral Density (PSD) using Welch's method.
-# 4. yasa.bandpower_from_psd_ndarray - Calculates the bandpower from the PSD array.
+# 4. BandIntegrator.power - Bandpower from the PSD array (yasa.bandpower_from_psd_ndarray semantics, p157).
 # 5. numpy.round - Rounds the values in an array to the given number of decimals.
 # 6. pandas.DataFrame - Creates a DataFrame for storing the results.
 # 7. DataFrame.to_csv - Writes the DataFrame to a CSV file.
@@ -19,14 +19,12 @@
 import mne  # For EEG data manipulation
 import yasa  # For spectral analysis
 import numpy as np  # For numerical operations
-import seaborn as sns  # For plotting
-import matplotlib.pyplot as plt  # For plotting
 import os  # For file path operations
 import pandas as pd  # For data manipulation
 from scipy.signal import welch  # For PSD calculation
 
-# Set seaborn style for plots
-sns.set(style='white', font_scale=1.2)
+from p010_instrument import finish_file, install_hooks, stage, track_file
+from p157_band_integrator import BandIntegrator
 
 
 # ==============================================================================
@@ -43,8 +41,14 @@ chirp_file = '/Users/ernie/Documents/ExampleData/Chirp/D0179_chirp-ST_postcomp_M
 file_basename = os.path.basename(chirp_file)
 print(f"Processing file: {file_basename}")
 
+# Record this file (and a failure) even if the script stops early
+install_hooks()
+
 # Read EEG data from the first .set file in the list
-raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+track_file(chirp_file)
+with stage('load') as st:
+    raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+    st.arrays(raw=raw)
 
 # Extract sampling frequency and channel names from the data
 sf = raw.info['sfreq']  # Sampling frequency (Hz)
@@ -55,8 +59,10 @@ no_of_channels = len(raw.info['ch_names'])  # Total number of EEG channels
 points_per_trial = 1626  # Number of time points per trial
 no_of_trials = 80  # Total number of trials
 
-epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
-epochs = epochs[:no_of_trials]
+with stage('epoch') as st:
+    epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
+    epochs = epochs[:no_of_trials]
+    st.arrays(epochs=epochs)
 
 evoked = epochs.average()
 # ==============================================================================
@@ -82,14 +88,19 @@ _, data = yasa.sliding_window(data, sf, window=points_per_trial/sf)
 
 # Calculate the power spectral density (PSD) using Welch's method
 win = int(1 * sf)  # Window size is set to 1 second
-freqs, psd = welch(data, sf, nperseg=win, axis=-1) 
+with stage('psd', method='welch') as st:
+    freqs, psd = welch(data, sf, nperseg=win, axis=-1)
+    st.arrays(data=data, psd=psd)
 
 # Define frequency bands of interest
 bands = [(2, 3.5, 'Delta'), (3.5, 7, 'Theta'), (7.5, 12.5, 'Alpha'), (7.5, 10.5, 'Alpha1'), 
          (10.5, 12.5, 'Alpha2'), (15, 30, 'Beta'), (30, 55, 'Gamma1'), (65, 80, 'Gamma2')]
 
 # Calculate the bandpower on 3-D PSD array
-bandpower = yasa.bandpower_from_psd_ndarray(psd, freqs, bands)
+with stage('bandpower') as st:
+    # Same Simpson integration as yasa.bandpower_from_psd_ndarray, from one prefix-sum index (p157)
+    bandpower = BandIntegrator(psd, freqs).power(bands, 'relative')
+    st.arrays(bandpower=bandpower)
 bandpower = np.round(bandpower,6)  # Round the bandpower values
 
 # Create a multi-index for rows (epochs and channels)
@@ -118,4 +129,6 @@ df_bandpower.insert(0, 'filename', file_basename)
 
 # Optionally, save the DataFrame to a CSV file for further analysis
 script_name = os.path.basename(__file__).replace('.py', '.csv')
-df_bandpower.to_csv(script_name, index=False)
+with stage('export'):
+    df_bandpower.to_csv(script_name, index=False)
+finish_file()
@@ -14,6 +14,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 import os
 
+from p010_instrument import finish_file, install_hooks, stage, track_file
+
 # Set Seaborn style for plots
 sns.set(style='white', font_scale=1.2)
 
@@ -32,8 +34,14 @@ chirp_file = '/Users/ernie/Documents/ExampleData/Chirp/D0179_chirp-ST_postcomp_M
 file_basename = os.path.basename(chirp_file)
 print(f"Processing file: {file_basename}")
 
+# Record this file (and a failure) even if the script stops early
+install_hooks()
+
 # Read EEG data from the .set file
-raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+track_file(chirp_file)
+with stage('load') as st:
+    raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+    st.arrays(raw=raw)
 
 # Extract sampling frequency and channel names from the data
 sf = raw.info['sfreq']  # Sampling frequency (Hz)
@@ -45,8 +53,10 @@ points_per_trial = 1626  # Number of time points per trial
 no_of_trials = 80  # Total number of trials
 
 # Create epochs from raw data
-epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
-epochs = epochs[:no_of_trials]
+with stage('epoch') as st:
+    epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
+    epochs = epochs[:no_of_trials]
+    st.arrays(epochs=epochs)
 
 # Compute average over epochs
 evoked = epochs.average()
@@ -106,7 +116,9 @@ def plot_psd_comparison(channel_1, channel_2, freqs, psd_chans):
     plt.show()
 
 # Example usage of PSD functions
-freqs, psd_chans, chan_names = compute_psd_welch(raw)
+with stage('psd', method='welch') as st:
+    freqs, psd_chans, chan_names = compute_psd_welch(raw)
+    st.arrays(psd_chans=psd_chans)
 plot_psd_comparison(1, 2, freqs, psd_chans)
 
 # ==============================================================================
@@ -123,7 +135,8 @@ fm = SpectralModel()
 freq_range = [3, 40]
 
 # Parameterize the power spectrum, and print out a report
-fm.report(freqs,  psd_chans[2,:], freq_range)
+with stage('fit', model='SpectralModel'):
+    fm.report(freqs,  psd_chans[2,:], freq_range)
 
 # ==============================================================================
 # Spectral Parameterization using FOOOF x 2D Array
@@ -133,10 +146,14 @@ fm.report(freqs,  psd_chans[2,:], freq_range)
 fg = SpectralGroupModel(peak_width_limits=[1.0, 8.0], max_n_peaks=8)
 
 # Fit models across the matrix of power spectra
-fg.report(freqs, psd_chans,freq_range)
+with stage('fit', model='SpectralGroupModel') as st:
+    fg.report(freqs, psd_chans,freq_range)
+    st.note(n_spectra=len(psd_chans))
 
 # Create and save out a report summarizing the results across the group of power spectra
-fg.save_report(file_name='group_results')
+with stage('export'):
+    fg.save_report(file_name='group_results')
 
-# Save out results for further analysis later
-fg.save(file_name='group_results', save_results=True)
\ No newline at end of file
+    # Save out results for further analysis later
+    fg.save(file_name='group_results', save_results=True)
+finish_file()
\ No newline at end of file
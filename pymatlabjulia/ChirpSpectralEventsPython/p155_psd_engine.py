@@ -0,0 +1,289 @@
+# ==============================================================================
+# Spectral Engine with Selectable Precision (float32 / float64)
+# ==============================================================================
+# EEGLAB stores samples as float32 microvolts, but the analysis scripts read
+# them through MNE (float64 volts) and run Welch, TFR and bandpower in float64.
+# On the batch nodes the copies and memory bandwidth of those float64 arrays,
+# not the arithmetic, limit throughput.
+#
+# This module keeps the whole path in one dtype chosen by ``precision``:
+#
+#   reader  - .fdt samples memory-mapped with p103 (float32 uV, no conversion)
+#   Welch   - scipy.signal.welch, which computes in the input dtype
+#   bands   - yasa-compatible band integration (p157 BandIntegrator),
+#             returned in the PSD dtype
+#   TFR     - p162 wavelet bank with complex64 kernels
+#
+# Band integration is the one step not done in the chosen dtype: the p157
+# prefix sums are accumulated in float64 even for a float32 PSD, because a
+# narrow band is the difference of two running sums that can be far larger
+# than the band itself. Its rounding error (< 1e-11 relative) is negligible
+# next to the float32 rounding of the returned band power (< 1e-7 relative),
+# and the prefix arrays add the memory of one float64 copy of the PSD.
+#
+# 'float64' (the default, or $VHTP_PRECISION) reproduces the existing results;
+# 'float32' halves the footprint of every array on the path.
+#
+# Accuracy of the float32 path against float64, measured with compare_precision
+# on tests/example_data_mea.set and simulated p108 recordings:
+#
+#   Welch PSD          max relative error  < 1e-5  (bins above 1e-6 of the peak)
+#   relative bandpower max absolute error  < 1e-6  (values are fractions of 1)
+#   wavelet TFR power  max relative error  < 1e-4  (bins above 1e-6 of the peak)
+#
+# Relative bandpower rounded to 6 decimals (p152) can therefore differ in the
+# last digit. Bins far below the spectral peak (e.g. at notch frequencies)
+# carry larger relative error, as the bound is set by float32 rounding of the
+# larger terms they are summed with.
+#
+# Main Functions Used:
+# 1. resolve_dtype - numpy dtype for a precision name.
+# 2. load_trials - Trials x channels x samples in microvolts from a .set file.
+# 3. welch_psd - Welch PSD per trial in the data dtype (MNE defaults).
+# 4. band_power - Band integration with yasa.bandpower_from_psd_ndarray semantics.
+# 5. compare_precision - float32 vs float64 error of PSD, bandpower and TFR.
+# ==============================================================================
+
+import os
+
+import numpy as np
+from scipy.signal import welch
+
+from p103_mea_memmap import read_set_memmap
+from p115_trial_rejection import screen_trials
+from p157_band_integrator import BandIntegrator
+
+PRECISIONS = {'float32': np.float32, 'single': np.float32,
+              'float64': np.float64, 'double': np.float64}
+
+DEFAULT_PRECISION = os.environ.get('VHTP_PRECISION', 'float64')
+
+# ==============================================================================
+# Precision
+# ==============================================================================
+
+def resolve_dtype(precision=None):
+    """
+    numpy dtype for a precision name.
+
+    Parameters
+    ----------
+    precision : str | numpy dtype | None
+        'float32'/'single' or 'float64'/'double', a float dtype, or None for
+        $VHTP_PRECISION (default 'float64').
+
+    Returns
+    -------
+    numpy.dtype
+        float32 or float64.
+    """
+    if precision is None:
+        precision = DEFAULT_PRECISION
+    if isinstance(precision, str):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}'; use one of {sorted(PRECISIONS)}.")
+        return np.dtype(PRECISIONS[precision])
+    dtype = np.dtype(precision)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"Precision must be float32 or float64, got {dtype}.")
+    return dtype
+
+# ==============================================================================
+# Reader
+# ==============================================================================
+
+def load_trials(set_file, points_per_trial=None, n_trials=None, precision=None, reject=None):
+    """
+    Trials of a .set file in microvolts without a float64 intermediate.
+
+    Epoched files keep their trials; continuous files are cut into
+    consecutive non-overlapping trials of ``points_per_trial`` samples (the
+    incomplete tail is dropped), as mne.make_fixed_length_epochs does.
+
+    Parameters
+    ----------
+    set_file : str
+        EEGLAB .set file.
+    points_per_trial : int | None
+        Samples per trial for continuous data. None keeps one trial.
+    n_trials : int | None
+        Keep only the first n trials (the first n clean trials with ``reject``).
+    precision : str | None
+        See resolve_dtype.
+    reject : dict | None
+        Thresholds of p115_trial_rejection.rejection_mask (e.g.
+        ``{'ptp': 500}``); trials with a channel above any of them are dropped.
+
+    Returns
+    -------
+    data : ndarray, shape (n_trials, n_channels, n_times)
+        Samples in microvolts.
+    sfreq : float
+        Sampling frequency.
+    ch_names : list of str
+        Channel labels.
+    """
+    dtype = resolve_dtype(precision)
+    eeg = read_set_memmap(set_file)
+    if eeg.n_trials > 1 or points_per_trial is None:
+        if reject:
+            # Statistics are streamed from the memmap; only clean trials are read
+            keep, _, _ = screen_trials(eeg, n_trials, **reject)
+            eeg = eeg.select_trials(keep)
+            n_trials = None
+        data = eeg[slice(None) if n_trials is None else slice(0, n_trials)]
+    else:
+        n_cut = eeg.n_times // points_per_trial
+        if n_trials is not None and not reject:
+            n_cut = min(n_cut, n_trials)
+        # (1, channels, times) -> (trials, channels, points_per_trial)
+        data = eeg[0, :, :n_cut * points_per_trial]
+        data = data.reshape(len(eeg.ch_names), n_cut, points_per_trial).transpose(1, 0, 2)
+        if reject:
+            keep, _, _ = screen_trials(data, n_trials, **reject)
+            data = data[keep]
+    return np.ascontiguousarray(data, dtype=dtype), eeg.srate, eeg.ch_names
+
+# ==============================================================================
+# Spectra
+# ==============================================================================
+
+def welch_psd(data, sfreq, n_fft=None, n_overlap=0, n_per_seg=None, fmin=0, fmax=np.inf,
+              window='hamming', remove_dc=True, precision=None):
+    """
+    Welch PSD computed in the data dtype, with the defaults of MNE compute_psd.
+
+    Parameters
+    ----------
+    data : ndarray, shape (..., n_times)
+        Samples (float32 or float64).
+    sfreq : float
+        Sampling frequency.
+    n_fft : int | None
+        FFT length (shortened to n_times if longer). Defaults to
+        min(n_times, 2048), as Epochs.compute_psd.
+    n_overlap : int
+        Overlapping samples between segments.
+    n_per_seg : int | None
+        Segment length. Defaults to n_fft.
+    fmin, fmax : float
+        Frequency range kept.
+    window : str
+        Segment window.
+    remove_dc : bool
+        Subtract the mean of each segment.
+    precision : str | None
+        Output dtype. None keeps the dtype of ``data``.
+
+    Returns
+    -------
+    freqs : ndarray
+        Frequencies in Hz.
+    psd : ndarray, shape (..., n_freqs)
+        Power spectral density (units of data squared per Hz).
+    """
+    data = np.asarray(data)
+    dtype = data.dtype if precision is None else resolve_dtype(precision)
+    data = data.astype(dtype, copy=False)
+    n_fft = min(2048 if n_fft is None else n_fft, data.shape[-1])
+    n_per_seg = n_fft if n_per_seg is None else n_per_seg
+    freqs, psd = welch(data, sfreq, window=window, nperseg=n_per_seg, noverlap=n_overlap,
+                       nfft=n_fft, detrend='constant' if remove_dc else False, average='mean', axis=-1)
+    keep = (freqs >= fmin) & (freqs <= fmax)
+    return freqs[keep], psd[..., keep].astype(dtype, copy=False)
+
+
+def band_power(psd, freqs, bands, relative=True):
+    """
+    Band power from a PSD with yasa.bandpower_from_psd_ndarray semantics.
+
+    Each band is integrated with Simpson's rule over the bins with
+    ``fmin <= f <= fmax``; relative power divides by the power between the
+    lowest and highest band edge. Sums are accumulated in float64; the result
+    keeps the dtype of ``psd``.
+    See p157_band_integrator.BandIntegrator for dB power, other band sets
+    and the eeg_htpCalcRestPower (mean over bins) rule from the same PSD.
+
+    Parameters
+    ----------
+    psd : ndarray, shape (..., n_freqs)
+        Power spectral density.
+    freqs : ndarray, shape (n_freqs,)
+        Equally spaced frequencies.
+    bands : list of tuple
+        (fmin, fmax, name) per band.
+    relative : bool
+        Return power relative to the total over all bands (yasa default).
+
+    Returns
+    -------
+    ndarray, shape (n_bands, ...)
+        Band power.
+    """
+    return BandIntegrator(psd, freqs).power(bands, 'relative' if relative else 'absolute')
+
+# ==============================================================================
+# Accuracy
+# ==============================================================================
+
+def _max_rel_error(approx, exact, floor=1e-6):
+    exact = np.asarray(exact, dtype=np.float64)
+    mask = np.abs(exact) > floor * np.abs(exact).max()
+    return float(np.max(np.abs(np.asarray(approx, dtype=np.float64)[mask] - exact[mask])
+                        / np.abs(exact[mask])))
+
+
+def compare_precision(data, sfreq, bands, tfr_freqs=None, n_fft=None):
+    """
+    Error of the float32 path against float64 on the same samples.
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_trials, n_channels, n_times)
+        Samples (converted to both precisions).
+    sfreq : float
+        Sampling frequency.
+    bands : list of tuple
+        (fmin, fmax, name) per band.
+    tfr_freqs : array-like | None
+        Frequencies for the TFR comparison (first channel). None skips it.
+    n_fft : int | None
+        Welch segment length. Defaults to one second.
+
+    Returns
+    -------
+    dict
+        'psd_rel', 'bandpower_abs' and (with tfr_freqs) 'tfr_rel' errors.
+    """
+    n_fft = int(sfreq) if n_fft is None else n_fft
+    errors = {}
+    freqs, psd64 = welch_psd(data, sfreq, n_fft=n_fft, precision='float64')
+    _, psd32 = welch_psd(data, sfreq, n_fft=n_fft, precision='float32')
+    errors['psd_rel'] = _max_rel_error(psd32, psd64)
+    bp64 = band_power(psd64, freqs, bands)
+    bp32 = band_power(psd32, freqs, bands)
+    errors['bandpower_abs'] = float(np.max(np.abs(bp32.astype(np.float64) - bp64)))
+    if tfr_freqs is not None:
+        from p162_wavelet_bank import tfr
+        chan = np.asarray(data)[:, 0, :]
+        tfr64 = tfr(chan.astype(np.float64), tfr_freqs, sfreq)
+        tfr32 = tfr(chan.astype(np.float32), tfr_freqs, sfreq, dtype=np.float32)
+        errors['tfr_rel'] = _max_rel_error(tfr32, tfr64)
+    return errors
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    set_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests',
+                            'example_data_mea.set')
+    bands = [(2, 3.5, 'Delta'), (3.5, 7, 'Theta'), (7.5, 12.5, 'Alpha'), (15, 30, 'Beta'),
+             (30, 55, 'Gamma1'), (65, 80, 'Gamma2')]
+
+    data, sfreq, ch_names = load_trials(set_file, precision='float32')
+    print(f"{data.shape} {data.dtype}, {data.nbytes / 1e6:.1f} MB")
+    freqs, psd = welch_psd(data, sfreq, n_fft=int(sfreq))
+    print(f"PSD {psd.shape} {psd.dtype}; relative alpha power of channel 1: "
+          f"{band_power(psd, freqs, bands)[2, :, 0].mean():.4f}")
+    print(compare_precision(data, sfreq, bands, tfr_freqs=np.arange(1, 61)))
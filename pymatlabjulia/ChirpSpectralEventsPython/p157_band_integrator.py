@@ -0,0 +1,250 @@
+# ==============================================================================
+# Prefix-Sum Band Integrator for Many Band Sets from One PSD
+# ==============================================================================
+# Band power is computed in several places, each pass going over the
+# frequency bins of every band again:
+#
+#   p151  yasa.bandpower twice on the same recording (absolute, then relative)
+#   p152  yasa.bandpower_from_psd_ndarray (Simpson per band)
+#   p155  band_power for the p020 bandpower command
+#   eeg_htpCalcRestPower.m  mean of abs / dB / relative PSD per band and channel
+#
+# A BandIntegrator builds prefix sums over the frequency axis of a PSD once,
+# for all channels and epochs. Every band is then a handful of lookups, so
+# absolute, relative and dB power of any number of band sets cost O(bands)
+# per spectrum instead of O(bands x bins):
+#
+#   rule='simpson' - yasa semantics: Simpson's rule (scipy.integrate.simpson,
+#                    including its correction of the last interval for an
+#                    even number of bins) over fmin <= f <= fmax, from
+#                    prefix sums of the even and odd bins; relative power is
+#                    divided by the integral between the lowest and highest
+#                    band edge
+#   rule='mean'    - eeg_htpCalcRestPower semantics: mean over the band bins
+#                    of the PSD, of 10*log10(PSD), and of the PSD divided by
+#                    its sum over all bins
+#
+# Prefix sums are accumulated in float64 whatever the PSD dtype; results are
+# returned in the PSD dtype. They agree with the per-band computation to the
+# float64 rounding of the prefix sums: < 1e-11 relative even for narrow bands
+# far below the cumulative power of a 1/f^2 spectrum.
+#
+# Main Functions Used:
+# 1. BandIntegrator - Prefix-sum index over the frequency axis of a PSD.
+# 2. BandIntegrator.power - Absolute, relative or dB power of a band set.
+# 3. BandIntegrator.band_sets - Several band sets and kinds in one call.
+# ==============================================================================
+
+import numpy as np
+
+KINDS = ['absolute', 'relative', 'db']
+RULES = ['simpson', 'mean']
+
+# ==============================================================================
+# Integrator
+# ==============================================================================
+
+def _prefix(y):
+    # Prefix sums with a leading zero: out[..., k] = sum(y[..., :k])
+    out = np.zeros(y.shape[:-1] + (y.shape[-1] + 1,), dtype=np.float64)
+    np.cumsum(y, axis=-1, dtype=np.float64, out=out[..., 1:])
+    return out
+
+
+class BandIntegrator:
+    """
+    Prefix-sum index over the frequency axis of a PSD.
+
+    Parameters
+    ----------
+    psd : ndarray, shape (..., n_freqs)
+        Power spectral density of any number of epochs and channels.
+    freqs : ndarray, shape (n_freqs,)
+        Equally spaced frequencies in Hz.
+    """
+
+    def __init__(self, psd, freqs):
+        self.psd = np.asarray(psd)
+        self.freqs = np.asarray(freqs, dtype=float)
+        if self.psd.shape[-1] != len(self.freqs):
+            raise ValueError(f"PSD has {self.psd.shape[-1]} frequency bins, got {len(self.freqs)} frequencies.")
+        self.dx = self.freqs[1] - self.freqs[0]
+        y = self.psd.astype(np.float64, copy=False)
+        # Prefix sums of the even and of the odd bins (Simpson weights alternate)
+        even = y.copy()
+        even[..., 1::2] = 0
+        self._even = _prefix(even)
+        self._odd = _prefix(y - even)
+        self._log = None
+
+    def bin_range(self, bands):
+        """
+        First and last bin of each band (fmin <= f <= fmax).
+
+        Parameters
+        ----------
+        bands : list of tuple
+            (fmin, fmax, name) or (fmin, fmax) per band.
+
+        Returns
+        -------
+        start, stop : ndarray of int
+            Inclusive bin indices; stop < start for bands without bins.
+        """
+        edges = np.array([band[:2] for band in bands], dtype=float).reshape(-1, 2)
+        start = np.searchsorted(self.freqs, edges[:, 0], side='left')
+        stop = np.searchsorted(self.freqs, edges[:, 1], side='right') - 1
+        return start, stop
+
+    def _take(self, prefix, idx):
+        # prefix[..., idx] with the band axis first
+        return np.moveaxis(prefix[..., idx], -1, 0)
+
+    def _bins(self, idx):
+        return np.moveaxis(self.psd[..., idx].astype(np.float64, copy=False), -1, 0)
+
+    def _range_sum(self, start, stop):
+        # Sum of all bins start..stop
+        return (self._take(self._even, stop + 1) + self._take(self._odd, stop + 1)
+                - self._take(self._even, start) - self._take(self._odd, start))
+
+    def _parity_sum(self, start, stop):
+        # Sum of bins start, start + 2, ..., up to stop (empty if stop < start)
+        n_freqs = len(self.freqs)
+        start = np.minimum(start, n_freqs)
+        stop = np.clip(stop, start - 1, n_freqs - 1)
+        even = (start % 2 == 0).reshape((-1,) + (1,) * (self.psd.ndim - 1))
+        return np.where(even,
+                        self._take(self._even, stop + 1) - self._take(self._even, start),
+                        self._take(self._odd, stop + 1) - self._take(self._odd, start))
+
+    def _simpson(self, start, stop):
+        n_bins = stop - start + 1
+        shape = (-1,) + (1,) * (self.psd.ndim - 1)
+        last = len(self.freqs) - 1
+        i, j = np.clip(start, 0, last), np.clip(stop, 0, last)
+        # Composite Simpson over an odd number of bins start..j_odd
+        j_odd = np.where(n_bins % 2 == 1, j, j - 1)
+        inner = 4 * self._parity_sum(i + 1, j_odd - 1) + 2 * self._parity_sum(i + 2, j_odd - 2)
+        value = self.dx / 3 * (self._bins(i) + self._bins(np.clip(j_odd, 0, last)) + inner)
+        # Even number of bins (>= 4): scipy's correction for the last interval
+        tail = self.dx * (5 / 12 * self._bins(j) + 2 / 3 * self._bins(np.clip(j - 1, 0, last))
+                          - 1 / 12 * self._bins(np.clip(j - 2, 0, last)))
+        value += np.where(((n_bins % 2 == 0) & (n_bins >= 4)).reshape(shape), tail, 0)
+        # Two bins: trapezoid; one bin: zero (as scipy); none: NaN
+        value = np.where((n_bins == 2).reshape(shape), self.dx / 2 * (self._bins(i) + self._bins(j)), value)
+        value = np.where((n_bins == 1).reshape(shape), 0., value)
+        return np.where((n_bins < 1).reshape(shape), np.nan, value)
+
+    def _mean(self, start, stop, log=False):
+        if log:
+            if self._log is None:
+                y = self.psd.astype(np.float64, copy=False)
+                self._log = _prefix(10 * np.log10(y))
+            total = self._take(self._log, stop + 1) - self._take(self._log, np.minimum(start, stop + 1))
+        else:
+            total = self._range_sum(start, np.maximum(stop, start - 1))
+        n_bins = (stop - start + 1).reshape((-1,) + (1,) * (self.psd.ndim - 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n_bins > 0, total / n_bins, np.nan)
+
+    def power(self, bands, kind='absolute', rule='simpson', total_range=None):
+        """
+        Power of each band for every spectrum.
+
+        Parameters
+        ----------
+        bands : list of tuple
+            (fmin, fmax, name) per band.
+        kind : 'absolute' | 'relative' | 'db'
+            Absolute power, power relative to ``total_range``, or dB.
+        rule : 'simpson' | 'mean'
+            'simpson' integrates as yasa (dB = 10*log10 of the integral);
+            'mean' averages the bins as eeg_htpCalcRestPower (dB = mean of
+            the per-bin dB).
+        total_range : tuple | None
+            (fmin, fmax) of the relative-power denominator. Defaults to the
+            lowest and highest band edge for 'simpson' (yasa) and to all
+            bins for 'mean' (eeg_htpCalcRestPower).
+
+        Returns
+        -------
+        ndarray, shape (n_bands, ...)
+            Band power in the PSD dtype; NaN for bands without bins.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind '{kind}'; use one of {KINDS}.")
+        if rule not in RULES:
+            raise ValueError(f"Unknown rule '{rule}'; use one of {RULES}.")
+        start, stop = self.bin_range(bands)
+        dtype = self.psd.dtype if self.psd.dtype.kind == 'f' else np.float64
+
+        if rule == 'mean':
+            if kind == 'db':
+                return self._mean(start, stop, log=True).astype(dtype)
+            value = self._mean(start, stop)
+            if kind == 'relative':
+                t_start, t_stop = (np.array([0]), np.array([len(self.freqs) - 1])) if total_range is None \
+                    else self.bin_range([total_range])
+                value = value / self._range_sum(t_start, t_stop)
+            return value.astype(dtype)
+
+        value = self._simpson(start, stop)
+        if kind == 'relative':
+            if total_range is None:
+                edges = [edge for band in bands for edge in band[:2]]
+                total_range = (min(edges), max(edges))
+            t_start, t_stop = self.bin_range([total_range])
+            value = value / self._simpson(t_start, t_stop)
+        elif kind == 'db':
+            value = 10 * np.log10(value)
+        return value.astype(dtype)
+
+    def band_sets(self, band_sets, kinds=('absolute', 'relative'), rule='simpson'):
+        """
+        Power of several band sets and kinds from the same index.
+
+        Parameters
+        ----------
+        band_sets : dict
+            Set name -> list of (fmin, fmax, name) bands.
+        kinds : sequence of str
+            Kinds computed for every set (see power).
+        rule : 'simpson' | 'mean'
+            Integration rule (see power).
+
+        Returns
+        -------
+        dict
+            (set name, kind) -> ndarray, shape (n_bands, ...).
+        """
+        return {(set_name, kind): self.power(bands, kind, rule)
+                for set_name, bands in band_sets.items() for kind in kinds}
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    import time
+
+    from scipy.integrate import simpson
+
+    rng = np.random.default_rng(0)
+    freqs = np.arange(0, 250.5, 0.5)
+    psd = rng.gamma(2.0, size=(80, 32, len(freqs))) / (1 + freqs) ** 2
+    band_sets = {'default': [(2, 3.5, 'Delta'), (3.5, 7, 'Theta'), (7.5, 12.5, 'Alpha'), (15, 30, 'Beta'),
+                             (30, 55, 'Gamma1'), (65, 80, 'Gamma2')],
+                 'fine': [(f, f + 2, f'{f}-{f + 2} Hz') for f in range(1, 80, 2)]}
+
+    start = time.perf_counter()
+    index = BandIntegrator(psd, freqs)
+    powers = index.band_sets(band_sets, kinds=KINDS)
+    powers.update(index.band_sets(band_sets, kinds=KINDS, rule='mean'))
+    print(f"{len(powers)} tables from one index in {time.perf_counter() - start:.3f} s")
+
+    # Reference: Simpson's rule band by band
+    bands = band_sets['fine']
+    ref = np.array([simpson(psd[..., (freqs >= lo) & (freqs <= hi)], dx=0.5, axis=-1) for lo, hi, _ in bands])
+    print(f"max relative difference to scipy simpson: "
+          f"{np.max(np.abs(index.power(bands) - ref) / ref):.1e}")
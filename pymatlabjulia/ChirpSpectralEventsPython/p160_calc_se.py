@@ -2,8 +2,10 @@
 import os, sys
 import numpy as np
 import mne
-from matplotlib import pyplot as plt
-import pandas as pd
+
+from p010_instrument import finish_file, install_hooks, stage, track_file
+from p162_wavelet_bank import tfr
+from p163_spectral_events import SPECTRALEVENTS_COLUMNS, events_to_frame, find_events
 
 # Add the path to the SpectralEvents package to the system path
 sys.path.append('/Users/ernie/Documents/GitHub/SpectralEvents')
@@ -11,12 +13,15 @@ import spectralevents as se
 
 def spec_events_to_df(spec_events, filename, channel_no):
     """
-    Convert the list of spectral events into a pandas DataFrame and add filename and channel number columns.
+    Convert the spectral events into a pandas DataFrame and add filename and channel number columns.
+
+    Columns keep the spectralevents names ('Peak Frequency', 'Normalized Peak Power', ...). The
+    spectralevents outlier and hit/miss flags are not produced.
 
     Parameters
     ----------
-    spec_events : list
-        The list of spectral events, where each event is a dictionary.
+    spec_events : dict
+        Struct-of-arrays spectral events from p163_spectral_events.find_events.
     filename : str
         The name of the file from which the spectral events were extracted.
     channel_no : int
@@ -27,16 +32,9 @@ def spec_events_to_df(spec_events, filename, channel_no):
     pd.DataFrame
         A DataFrame containing the spectral events with filename and channel number columns.
     """
-    # Flatten the list of lists of dictionaries to a single list of dictionaries
-    flattened_events = [event for sublist in spec_events for event in sublist]
-    
-    # Convert the list of dictionaries to a DataFrame
-    spec_events_df = pd.DataFrame(flattened_events)
-
-    # Move filename and channel number to the first two columns
-    spec_events_df.insert(0, 'Filename', filename)
-    spec_events_df.insert(0, 'Channel_Number', channel_no)
-    return spec_events_df
+    # Columns are built straight from the event arrays; no per-event dicts
+    return events_to_frame(spec_events, filename=filename, channel_no=channel_no).rename(
+        columns=SPECTRALEVENTS_COLUMNS)
 def epoch_and_extract_eeg_data(epochs, points_per_trial, channel_index=None, num_trials=None):
     """
     Extract EEG data from epochs and optionally select data by channel index and number of trials.
@@ -92,8 +90,14 @@ chirp_file = '/Users/ernie/Documents/ExampleData/Chirp/D0179_chirp-ST_postcomp_M
 file_basename = os.path.basename(chirp_file)
 print(f"Processing file: {file_basename}")
 
+# Record this file (and a failure) even if the script stops early
+install_hooks()
+
 # Read EEG data from the first .set file in the list
-raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+track_file(chirp_file)
+with stage('load') as st:
+    raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+    st.arrays(raw=raw)
 
 # Extract sampling frequency and channel names from the data
 sf = raw.info['sfreq']  # Sampling frequency (Hz)
@@ -104,8 +108,10 @@ no_of_channels = len(raw.info['ch_names'])  # Total number of EEG channels
 points_per_trial = 1626  # Number of time points per trial
 no_of_trials = 80  # Total number of trials
 
-epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
-epochs = epochs[:no_of_trials]
+with stage('epoch') as st:
+    epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
+    epochs = epochs[:no_of_trials]
+    st.arrays(epochs=epochs)
 
 evoked = epochs.average()
 
@@ -129,16 +135,22 @@ chan_data = epoch_data[:, channel_no, :].squeeze()  # Squeeze to remove single-d
 print(f"Channel {channel_no} data shape: {chan_data.shape}")  # Log the shape of the channel data
 
 # Perform time-frequency representation (TFR) analysis
-tfrs = se.tfr(chan_data, freqs, sf)  # Calculate the TFR
+with stage('tfr', channel=channel_no) as st:
+    tfrs = tfr(chan_data, freqs, sf)  # Calculate the TFR (cached wavelet bank, same output as se.tfr)
+    st.arrays(chan_data=chan_data, tfrs=tfrs)
 fig = se.plot_avg_spectrogram(tfr=tfrs, times=times, freqs=freqs,
                               event_band=event_band)  # Plot the average spectrogram
 
 # Detect spectral events within the specified frequency band and threshold
-spec_events = se.find_events(tfr=tfrs, times=times, freqs=freqs,
-                             event_band=event_band, threshold_FOM=thresh_FOM)  # Find spectral events
+with stage('events', channel=channel_no) as st:
+    spec_events = find_events(tfr=tfrs, times=times, freqs=freqs,
+                              event_band=event_band, threshold_FOM=thresh_FOM)  # Find spectral events
+    st.note(n_events=len(spec_events['Trial']))
 
 # Convert spectral events data to a DataFrame for easier handling
 spec_events_df = spec_events_to_df(spec_events, os.path.basename(chirp_file), channel_no)  # Convert to DataFrame
 
 # Save the spectral events data to a CSV file for further analysis
-spec_events_df.to_csv('spectral_events.csv', index=False)  # Save DataFrame to CSV
+with stage('export'):
+    spec_events_df.to_csv('spectral_events.csv', index=False)  # Save DataFrame to CSV
+finish_file()
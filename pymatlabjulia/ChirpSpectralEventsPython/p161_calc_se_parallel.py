@@ -1,22 +1,23 @@
 # Execute another script and access its variables
-import os, sys
+import os
 import numpy as np
 import mne
-from matplotlib import pyplot as plt
 import pandas as pd
 
-# Add the path to the SpectralEvents package to the system path
-sys.path.append('/Users/ernie/Documents/GitHub/SpectralEvents')
-import spectralevents as se
+from p010_instrument import finish_file, install_hooks, stage, track_file
+from p163_spectral_events import SPECTRALEVENTS_COLUMNS, events_to_frame, stream_band_events, summarize_events
 
 def spec_events_to_df(spec_events, filename, channel_no):
     """
-    Convert the list of spectral events into a pandas DataFrame and add filename and channel number columns.
+    Convert the spectral events into a pandas DataFrame and add filename and channel number columns.
+
+    Columns keep the spectralevents names ('Peak Frequency', 'Normalized Peak Power', ...). The
+    spectralevents outlier and hit/miss flags are not produced.
 
     Parameters
     ----------
-    spec_events : list
-        The list of spectral events, where each event is a dictionary.
+    spec_events : dict
+        Struct-of-arrays spectral events from p163_spectral_events.find_events.
     filename : str
         The name of the file from which the spectral events were extracted.
     channel_no : int
@@ -27,16 +28,8 @@ def spec_events_to_df(spec_events, filename, channel_no):
     pd.DataFrame
         A DataFrame containing the spectral events with filename and channel number columns.
     """
-    # Flatten the list of lists of dictionaries to a single list of dictionaries
-    flattened_events = [event for sublist in spec_events for event in sublist]
-    
-    # Convert the list of dictionaries to a DataFrame
-    spec_events_df = pd.DataFrame(flattened_events)
-
-    # Move filename and channel number to the first two columns
-    spec_events_df.insert(0, 'Filename', filename)
-    spec_events_df.insert(0, 'Channel_Number', channel_no)
-    return spec_events_df
+    return events_to_frame(spec_events, filename=filename, channel_no=channel_no).rename(
+        columns=SPECTRALEVENTS_COLUMNS)
 def epoch_and_extract_eeg_data(epochs, points_per_trial, channel_index=None, num_trials=None):
     """
     Extract EEG data from epochs and optionally select data by channel index and number of trials.
@@ -93,8 +86,14 @@ file_basename = os.path.basename(chirp_file)
 file_basename = os.path.basename(chirp_file)
 print(f"Processing file: {file_basename}")
 
+# Record this file (and a failure) even if the script stops early
+install_hooks()
+
 # Read EEG data from the first .set file in the list
-raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+track_file(chirp_file)
+with stage('load') as st:
+    raw = mne.io.read_raw_eeglab(chirp_file, preload=True)
+    st.arrays(raw=raw)
 
 # Extract sampling frequency and channel names from the data
 sf = raw.info['sfreq']  # Sampling frequency (Hz)
@@ -105,8 +104,10 @@ no_of_channels = len(raw.info['ch_names'])  # Total number of EEG channels
 points_per_trial = 1626  # Number of time points per trial
 no_of_trials = 80  # Total number of trials
 
-epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
-epochs = epochs[:no_of_trials]
+with stage('epoch') as st:
+    epochs = mne.make_fixed_length_epochs(raw, duration=points_per_trial/raw.info['sfreq'], preload=True)
+    epochs = epochs[:no_of_trials]
+    st.arrays(epochs=epochs)
 
 evoked = epochs.average()
 
@@ -122,8 +123,9 @@ chan_data_full = epoch_data
 # Define the parameters for spectral event detection
 freqs = np.arange(1, 60+1, 1)  # Frequency range in Hz
 times = np.arange(points_per_trial) / sf  # Time points in seconds
-event_band = [7.5, 12.5]  # Define the beta band frequency range in Hz
-thresh_FOM = 4.0  # Set the factor-of-the-median threshold for event detection
+# Bands detected from the same TFR of each channel (fmin, fmax, name)
+event_bands = [(3.5, 7, 'Theta'), (7.5, 12.5, 'Alpha'), (15, 30, 'Beta'), (30, 55, 'Gamma1')]
+thresh_FOM = {'Theta': 4.0, 'Alpha': 4.0, 'Beta': 4.0, 'Gamma1': 4.0}  # Factor-of-the-median threshold per band
 
 from joblib import Parallel, delayed
 import pandas as pd
@@ -131,30 +133,45 @@ import pandas as pd
 # chan_data_full = epoch_and_extract_eeg_data(raw, points_per_trial, channel_index=None, num_trials=no_of_trials)[0]
 spec_events_df = pd.DataFrame()
 
-def process_channel(channel_no, epoch_data, points_per_trial, no_of_trials, freqs, samp_freq, times, event_band, thresh_FOM, filename):
+def process_channel(channel_no, epoch_data, points_per_trial, no_of_trials, freqs, samp_freq, times, event_bands, thresh_FOM, filename):
     # Extract EEG data for the specified channel
     chan_data = epoch_data[:, channel_no, :]
     print(f"Processing Channel {channel_no}: Data Shape - {chan_data.shape}")
     
-    # Perform time-frequency representation (TFR) analysis
-    tfrs = se.tfr(chan_data, freqs, samp_freq)
+    # Stream the TFR in blocks of 8 trials with float32 power, so each joblib
+    # worker holds a few MB of power instead of the full trials x freqs x times
+    # array; the median per frequency is exact (two passes), so the events match
+    # the full-array detection. The wavelet bank is cached on disk, so every
+    # worker maps the same kernels
+    spec_events, med_powers, band_powers = stream_band_events(chan_data, freqs, samp_freq, event_bands, thresh_FOM,
+                                                              block_trials=8, dtype=np.float32, times=times)
+    trial_powers = pd.concat([pd.DataFrame({'Channel_Number': channel_no, 'Band': band[2], 'Trial': np.arange(len(chan_data)),
+                                            'Trial_Power': band_power})
+                              for band, band_power in zip(event_bands, band_powers)], ignore_index=True)
     
-    # Identify spectral events within the specified frequency band and threshold
-    spec_events = se.find_events(tfr=tfrs, times=times, freqs=freqs, event_band=event_band, threshold_FOM=thresh_FOM)
-    
-    # Structure spectral events data into a DataFrame
-    spec_events_df = pd.DataFrame([event for sublist in spec_events for event in sublist])
-    spec_events_df['Filename'] = filename
-    spec_events_df['Channel_Number'] = channel_no
-    
-    return spec_events_df
+    # Structure spectral events data into a DataFrame (columns come straight from the event arrays)
+    return spec_events_to_df(spec_events, filename, channel_no), trial_powers
 
 # Parallelize the processing of each EEG channel
-processed_channels = Parallel(n_jobs=-1)(delayed(process_channel)(channel_no, epoch_data, points_per_trial, no_of_trials, freqs, sf, times, event_band, thresh_FOM, file_basename) for channel_no in range(0,no_of_channels))
+with stage('events', n_channels=no_of_channels) as st:
+    processed_channels = Parallel(n_jobs=-1)(delayed(process_channel)(channel_no, epoch_data, points_per_trial, no_of_trials, freqs, sf, times, event_bands, thresh_FOM, file_basename) for channel_no in range(0,no_of_channels))
 
-# Combine the results into a single DataFrame
-all_channels_spec_events_df = pd.concat(processed_channels, ignore_index=True)
+    # Combine the results into a single DataFrame
+    all_channels_spec_events_df = pd.concat([events for events, _ in processed_channels], ignore_index=True)
+    all_trial_powers_df = pd.concat([powers for _, powers in processed_channels], ignore_index=True)
+    st.arrays(epoch_data=epoch_data, spec_events=all_channels_spec_events_df)
 print(all_channels_spec_events_df.shape)
 
+# Per-channel and per-band summary with the columns of eeg_htpCalcSpectralEvents.m
+with stage('summary') as st:
+    # summarize_events reads the p163 field names
+    events_df = all_channels_spec_events_df.rename(columns={v: k for k, v in SPECTRALEVENTS_COLUMNS.items()})
+    spec_events_summary_df = summarize_events(events_df, len(epoch_data), points_per_trial / sf, all_trial_powers_df)
+    spec_events_summary_df.insert(0, 'Filename', file_basename)
+    st.arrays(summary=spec_events_summary_df)
+
 # Save the compiled spectral events data to a CSV file
-all_channels_spec_events_df.to_csv('all_channels_spectral_events_parallel.csv', index=False)
\ No newline at end of file
+with stage('export'):
+    all_channels_spec_events_df.to_csv('all_channels_spectral_events_parallel.csv', index=False)
+    spec_events_summary_df.to_csv('all_channels_spectral_events_summary.csv', index=False)
+finish_file()
\ No newline at end of file
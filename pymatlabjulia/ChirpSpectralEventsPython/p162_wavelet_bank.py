@@ -0,0 +1,297 @@
+# ==============================================================================
+# Cached Morlet Wavelet Bank for Time-Frequency Analysis
+# ==============================================================================
+# spectralevents.tfr builds one Morlet wavelet per frequency and convolves it
+# with every trial in the time domain. p160/p161 call it for each channel of
+# each file with the same frequencies, sampling rate and trial length, so the
+# same wavelet family is rebuilt thousands of times per cohort.
+#
+# A WaveletBank holds the frequency-domain kernels of that family for one
+# (freqs, width, sfreq, n_times) combination, padded to a fast FFT length. The
+# TFR of a channel is then one batched FFT of its trials and one multiply +
+# inverse FFT per frequency, instead of n_trials x n_freqs convolutions.
+#
+# Banks are cached in memory for the session and as .npy files under
+# ~/.cache/vhtp/wavelets ($VHTP_WAVELET_CACHE). The kernels are memory-mapped
+# when read back, so worker processes on one machine share a single copy in
+# the page cache instead of each building its own.
+#
+# The output matches spectralevents.tfr (Morlet width 7, +/-3.5 standard
+# deviations, linear detrend, power 2*(dt*|y|)^2 on the full convolution
+# cropped from ceil(M/2)). numpy/scipy have no explicit FFT plan objects;
+# scipy.fft keeps its twiddle factors cached per length, and the bank pins
+# the length so they are reused across channels and files.
+#
+# With dtype=float32 the kernels are stored as complex64 and the transform
+# runs in single precision (accuracy bound in p155_psd_engine.py).
+#
+# Main Functions Used:
+# 1. morlet - Complex Morlet wavelet as in spectralevents/4DToolbox.
+# 2. wavelet_bank_key - Cache key for freqs, width, sfreq and n_times.
+# 3. get_wavelet_bank - Cached WaveletBank (memory, then disk, then build).
+# 4. tfr - Drop-in replacement for spectralevents.tfr.
+# ==============================================================================
+
+import hashlib
+import os
+import os.path as op
+
+import numpy as np
+import scipy.fft
+
+from p010_instrument import count
+
+DEFAULT_CACHE_DIR = os.environ.get('VHTP_WAVELET_CACHE',
+                                   op.join(op.expanduser('~'), '.cache', 'vhtp', 'wavelets'))
+
+# Bump when the kernel construction changes so old cache files are ignored
+BANK_VERSION = 1
+
+_memory_cache = {}
+
+# ==============================================================================
+# Wavelets
+# ==============================================================================
+
+def morlet(freq, sfreq, width=7):
+    """
+    Complex Morlet wavelet sampled over +/-3.5 standard deviations.
+
+    Parameters
+    ----------
+    freq : float
+        Center frequency in Hz.
+    sfreq : float
+        Sampling frequency in Hz.
+    width : float
+        Number of cycles (spectralevents uses 7).
+
+    Returns
+    -------
+    ndarray, shape (n_samples,)
+        Complex wavelet, unit area Gaussian envelope.
+    """
+    dt = 1 / sfreq
+    sf = freq / width
+    st = 1 / (2 * np.pi * sf)
+    t = np.arange(-3.5 * st, 3.5 * st, dt)
+    amplitude = 1 / (st * np.sqrt(2 * np.pi))
+    return amplitude * np.exp(-t ** 2 / (2 * st ** 2)) * np.exp(1j * 2 * np.pi * freq * t)
+
+
+def _detrend_rows(X):
+    """
+    Remove the least-squares line from each row (scipy.signal.detrend 'linear').
+
+    Each row is fitted on its own with row-wise sums, so a trial gives the
+    same bits whether it is transformed alone or in any batch; scipy's detrend
+    solves all rows in one lstsq call, whose rounding depends on the batch.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    t = np.arange(X.shape[-1], dtype=np.float64)
+    t -= t.mean()
+    X = X - X.mean(axis=-1, keepdims=True)
+    slope = (X * t).sum(axis=-1, keepdims=True) / (t * t).sum()
+    return X - slope * t
+
+
+class WaveletBank:
+    """
+    Frequency-domain Morlet kernels for a fixed frequency set and trial length.
+
+    Parameters
+    ----------
+    freqs : array-like
+        Frequencies in Hz.
+    sfreq : float
+        Sampling frequency in Hz.
+    n_times : int
+        Samples per trial.
+    width : float
+        Wavelet width in cycles.
+    dtype : numpy dtype
+        float64, or float32 for single-precision kernels and output.
+    kernels : ndarray | None
+        Precomputed kernel spectra, shape (n_freqs, n_fft). Built if None.
+    offsets : ndarray | None
+        Start of the kept part of each full convolution. Built if None.
+    """
+
+    def __init__(self, freqs, sfreq, n_times, width=7, dtype=np.float64, kernels=None, offsets=None):
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.sfreq = float(sfreq)
+        self.n_times = int(n_times)
+        self.width = width
+        self.dtype = np.dtype(dtype)
+        if kernels is None:
+            wavelets = [morlet(f, self.sfreq, width) for f in self.freqs]
+            lengths = np.array([len(m) for m in wavelets])
+            # Full linear convolution of every wavelet fits without wrap-around
+            self.n_fft = scipy.fft.next_fast_len(self.n_times + lengths.max() - 1)
+            kernels = np.empty((len(self.freqs), self.n_fft), dtype=np.result_type(self.dtype, np.complex64))
+            for k, m in enumerate(wavelets):
+                kernels[k] = scipy.fft.fft(m, self.n_fft)
+            offsets = np.ceil(lengths / 2).astype(int)
+        self.kernels = kernels
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.n_fft = self.kernels.shape[1]
+
+    def power(self, X):
+        """
+        Wavelet power of trials, as spectralevents.tfr.
+
+        Parameters
+        ----------
+        X : ndarray, shape (n_trials, n_times)
+            Trials of one channel.
+
+        Returns
+        -------
+        ndarray, shape (n_trials, n_freqs, n_times)
+            Power 2 * (dt * |y|)^2 of each trial and frequency, in the bank dtype.
+        """
+        X = np.atleast_2d(X)
+        if X.shape[-1] != self.n_times:
+            raise ValueError(f"Wavelet bank is built for {self.n_times} samples per trial, "
+                             f"got {X.shape[-1]}.")
+        dt = self.dtype.type(1 / self.sfreq)
+        X = _detrend_rows(X).astype(self.dtype, copy=False)
+        spectra = scipy.fft.fft(X, self.n_fft, axis=-1, workers=-1)
+        out = np.empty((X.shape[0], len(self.freqs), self.n_times), dtype=self.dtype)
+        for k, offset in enumerate(self.offsets):
+            y = scipy.fft.ifft(spectra * self.kernels[k], axis=-1, workers=-1)
+            out[:, k] = 2 * (dt * np.abs(y[:, offset:offset + self.n_times])) ** 2
+        return out
+
+# ==============================================================================
+# Cache
+# ==============================================================================
+
+def wavelet_bank_key(freqs, sfreq, n_times, width=7, dtype=np.float64):
+    """
+    Cache key for a wavelet bank.
+
+    Parameters
+    ----------
+    freqs : array-like
+        Frequencies in Hz.
+    sfreq : float
+        Sampling frequency in Hz.
+    n_times : int
+        Samples per trial.
+    width : float
+        Wavelet width in cycles.
+    dtype : numpy dtype
+        float64 or float32.
+
+    Returns
+    -------
+    str
+        16 character hexadecimal key.
+    """
+    h = hashlib.sha1()
+    h.update(np.asarray(freqs, dtype='<f8').tobytes())
+    h.update(repr((float(sfreq), int(n_times), float(width), np.dtype(dtype).name, BANK_VERSION)).encode())
+    return h.hexdigest()[:16]
+
+
+def get_wavelet_bank(freqs, sfreq, n_times, width=7, dtype=np.float64, cache_dir=None):
+    """
+    Cached WaveletBank for a frequency set, sampling rate and trial length.
+
+    Looks in the session cache, then in ``cache_dir``; on a miss the bank is
+    built and saved so other processes and later runs can map it.
+
+    Parameters
+    ----------
+    freqs : array-like
+        Frequencies in Hz.
+    sfreq : float
+        Sampling frequency in Hz.
+    n_times : int
+        Samples per trial.
+    width : float
+        Wavelet width in cycles.
+    dtype : numpy dtype
+        float64, or float32 for complex64 kernels.
+    cache_dir : str | None
+        Cache directory. Defaults to $VHTP_WAVELET_CACHE or ~/.cache/vhtp/wavelets.
+        Pass False to skip the disk cache.
+
+    Returns
+    -------
+    WaveletBank
+        The wavelet bank.
+    """
+    key = wavelet_bank_key(freqs, sfreq, n_times, width, dtype)
+    if key in _memory_cache:
+        count('wavelet_bank.hit')
+        return _memory_cache[key]
+
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    if cache_dir:
+        kernel_file = op.join(cache_dir, f"{key}-kernels.npy")
+        offset_file = op.join(cache_dir, f"{key}-offsets.npy")
+        if op.exists(kernel_file) and op.exists(offset_file):
+            bank = WaveletBank(freqs, sfreq, n_times, width, dtype,
+                               kernels=np.load(kernel_file, mmap_mode='r'),
+                               offsets=np.load(offset_file))
+            _memory_cache[key] = bank
+            count('wavelet_bank.hit')
+            return bank
+
+    count('wavelet_bank.miss')
+    bank = WaveletBank(freqs, sfreq, n_times, width, dtype)
+    if cache_dir:
+        # Temporary names first so a concurrent reader never maps a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        for fname, array in ((offset_file, bank.offsets), (kernel_file, bank.kernels)):
+            tmp_file = fname[:-len('.npy')] + f".tmp{os.getpid()}.npy"
+            np.save(tmp_file, array)
+            os.replace(tmp_file, fname)
+    _memory_cache[key] = bank
+    return bank
+
+
+def tfr(X, freqs, samp_freq, width=7, dtype=np.float64):
+    """
+    Morlet wavelet power of trials; drop-in replacement for spectralevents.tfr.
+
+    Parameters
+    ----------
+    X : ndarray, shape (n_trials, n_times)
+        Trials of one channel.
+    freqs : array-like
+        Frequencies in Hz.
+    samp_freq : float
+        Sampling frequency in Hz.
+    width : float
+        Wavelet width in cycles.
+    dtype : numpy dtype
+        Computation and output dtype (float64 as spectralevents, or float32).
+
+    Returns
+    -------
+    ndarray, shape (n_trials, n_freqs, n_times)
+        Time-frequency power.
+    """
+    X = np.atleast_2d(X)
+    return get_wavelet_bank(freqs, samp_freq, X.shape[-1], width, dtype).power(X)
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    import time
+
+    sfreq, n_times, n_trials = 500.0, 1626, 80
+    freqs = np.arange(1, 60 + 1, 1)
+    X = np.random.default_rng(0).standard_normal((n_trials, n_times))
+
+    start = time.perf_counter()
+    tfrs = tfr(X, freqs, sfreq)
+    print(f"First channel (builds or loads the bank): {time.perf_counter() - start:.3f} s")
+    start = time.perf_counter()
+    tfrs = tfr(X, freqs, sfreq)
+    print(f"Next channel (cached bank): {time.perf_counter() - start:.3f} s, shape {tfrs.shape}")
@@ -0,0 +1,380 @@
+# ==============================================================================
+# Sparse Region-of-Interest Operator for Channel Data
+# ==============================================================================
+# Region-level results are computed in several ways today: p140 finds the
+# temporal channels by string matching and calls mne.channels.combine_channels
+# on one Evoked, eeg_htpAverageStructByRegion (development/) loops over the DK
+# atlas regions, and the MATLAB calc functions select channels per region from
+# the net definitions that electrodeConfigClass reads.
+#
+# A RoiOperator is a sparse (n_regions x n_channels) weight matrix built once
+# per montage from those same definitions:
+#
+#   chanfiles/*_dict.csv          - a channel dictionary grouped by any of its
+#                                   columns (region, side, lobe, zone, ...)
+#   chanfiles/cfg_htpEegSystems.xml - <net_regions> of a net (1-based channel
+#                                   numbers, as electrodeConfigClass)
+#
+# Applying it is one sparse matrix product over the channel axis, for any
+# array layout (raw, epochs, evoked, PSD, TFR), for MNE objects and for
+# per-channel result tables, so region-level analyses never loop over
+# channels. Rows average their channels by default (combine_channels
+# method='mean'); weights='sum' adds them instead.
+#
+# Operators are cached per definition and channel list, so every file of a
+# cohort recorded with the same montage reuses the same matrix.
+#
+# Main Functions Used:
+# 1. RoiOperator - Sparse region x channel weights and their application.
+# 2. regions_from_dict - Region -> channel labels from a chanfiles dictionary.
+# 3. regions_from_config - Region -> channel numbers from cfg_htpEegSystems.xml.
+# 4. get_roi_operator - Cached operator for a definition and a montage.
+# ==============================================================================
+
+import functools
+import os
+import os.path as op
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from p010_instrument import count
+
+CHANFILES_DIR = os.environ.get('VHTP_CHANFILES', op.normpath(
+    op.join(op.dirname(op.abspath(__file__)), '..', '..', 'chanfiles')))
+NET_CONFIG = op.join(CHANFILES_DIR, 'cfg_htpEegSystems.xml')
+
+# Channel label columns of the chanfiles dictionaries (GSN, MEA, DK atlas)
+LABEL_COLUMNS = ['chan', 'labels', 'label', 'labelclean', 'Name']
+
+# ==============================================================================
+# Region Definitions
+# ==============================================================================
+
+def _label_column(table, ch_names=None):
+    # The label column matching most of the montage channels (the first
+    # label column present when no channel list is given)
+    candidates = [c for c in LABEL_COLUMNS if c in table.columns]
+    if not candidates:
+        raise ValueError(f"No channel label column ({LABEL_COLUMNS}) in {list(table.columns)}.")
+    if ch_names is None:
+        return candidates[0]
+    ch_names = set(ch_names)
+    return max(candidates, key=lambda c: len(ch_names.intersection(table[c].astype(str).str.strip())))
+
+
+def regions_from_dict(dict_file, by='region', ch_names=None, label_column=None):
+    """
+    Regions of a chanfiles channel dictionary.
+
+    Parameters
+    ----------
+    dict_file : str
+        Dictionary CSV, a path or a name in chanfiles/ (e.g. 'DK_atlas-68_dict.csv').
+    by : str | list of str
+        Column(s) defining the regions; several columns are joined with '_'
+        (e.g. ['side', 'lobe'] -> 'Left_Temporal').
+    ch_names : list of str | None
+        Montage channels, used to choose the label column.
+    label_column : str | None
+        Channel label column. Detected if None.
+
+    Returns
+    -------
+    dict
+        Region name -> list of channel labels, in dictionary order. Channels
+        without a region (empty or NA) are left out.
+    """
+    if not op.exists(dict_file):
+        dict_file = op.join(CHANFILES_DIR, dict_file)
+    table = pd.read_csv(dict_file, encoding='utf-8-sig')
+    by = [by] if isinstance(by, str) else list(by)
+    label_column = _label_column(table, ch_names) if label_column is None else label_column
+    table = table.dropna(subset=by)
+    names = table[by].astype(str).apply(lambda row: '_'.join(v.strip() for v in row), axis=1)
+    labels = table[label_column].astype(str).str.strip()
+    regions = {}
+    for name, label in zip(names, labels):
+        regions.setdefault(name, []).append(label)
+    return regions
+
+
+def regions_from_config(net_name, config_file=None):
+    """
+    Regions of a net in cfg_htpEegSystems.xml, as read by electrodeConfigClass.
+
+    Parameters
+    ----------
+    net_name : str
+        <net_name> of the net (e.g. 'EGI128', 'MEA30').
+    config_file : str | None
+        Net configuration. Defaults to chanfiles/cfg_htpEegSystems.xml.
+
+    Returns
+    -------
+    dict
+        Region name -> list of 1-based channel numbers.
+    """
+    root = ET.parse(NET_CONFIG if config_file is None else config_file).getroot()
+    for item in root.iter('listitem'):
+        if (item.findtext('net_name') or '').strip() == net_name:
+            regions = {}
+            net_regions = item.find('net_regions')
+            for region in ([] if net_regions is None else list(net_regions)):
+                numbers = (region.text or '').strip().strip('[]')
+                regions[region.tag] = [int(n) for n in numbers.replace(';', ',').split(',') if n.strip()]
+            return regions
+    raise ValueError(f"Net '{net_name}' is not defined in {config_file or NET_CONFIG}.")
+
+# ==============================================================================
+# Operator
+# ==============================================================================
+
+class RoiOperator:
+    """
+    Sparse region x channel weights over a fixed channel list.
+
+    Parameters
+    ----------
+    regions : dict
+        Region name -> list of channel labels (str) or 1-based channel
+        numbers (int). Channels missing from ``ch_names`` are ignored and
+        regions without any channel are dropped.
+    ch_names : list of str
+        Channels of the montage, in data order.
+    weights : 'mean' | 'sum'
+        Average the channels of a region, or add them.
+    """
+
+    def __init__(self, regions, ch_names, weights='mean'):
+        if weights not in ('mean', 'sum'):
+            raise ValueError(f"weights must be 'mean' or 'sum', got '{weights}'.")
+        self.ch_names = list(ch_names)
+        self.weights = weights
+        position = {name: k for k, name in enumerate(self.ch_names)}
+        rows, cols, names = [], [], []
+        for name, channels in regions.items():
+            idx = sorted({c - 1 if isinstance(c, (int, np.integer)) else position.get(c, -1) for c in channels})
+            idx = [k for k in idx if 0 <= k < len(self.ch_names)]
+            if idx:
+                rows.extend([len(names)] * len(idx))
+                cols.extend(idx)
+                names.append(name)
+        self.region_names = names
+        values = np.ones(len(rows))
+        if weights == 'mean':
+            values /= np.bincount(rows, minlength=len(names))[rows]
+        self.matrix = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(len(names), len(self.ch_names)))
+
+    def __repr__(self):
+        return f"<RoiOperator | {len(self.region_names)} regions x {len(self.ch_names)} channels, {self.weights}>"
+
+    @property
+    def membership(self):
+        """Boolean (n_regions, n_channels) array of region membership."""
+        return self.matrix.toarray() != 0
+
+    def channels(self, region):
+        """Channel names of one region."""
+        row = self.matrix.getrow(self.region_names.index(region))
+        return [self.ch_names[k] for k in row.indices]
+
+    def apply(self, data, axis=0):
+        """
+        Region data from channel data in one sparse matrix product.
+
+        Parameters
+        ----------
+        data : ndarray
+            Any array with a channel axis, e.g. (channels, times) raw,
+            (epochs, channels, times), (epochs, channels, freqs) PSD or
+            (channels, trials, freqs, times) TFR.
+        axis : int
+            Channel axis.
+
+        Returns
+        -------
+        ndarray
+            ``data`` with the channel axis replaced by the region axis.
+        """
+        data = np.asarray(data)
+        if data.shape[axis] != len(self.ch_names):
+            raise ValueError(f"Operator is built for {len(self.ch_names)} channels, "
+                             f"got {data.shape[axis]} on axis {axis}.")
+        moved = np.moveaxis(data, axis, 0)
+        out = self.matrix @ moved.reshape(len(self.ch_names), -1)
+        out = np.asarray(out, dtype=np.result_type(data.dtype, np.float32))
+        return np.moveaxis(out.reshape((len(self.region_names),) + moved.shape[1:]), 0, axis)
+
+    def apply_inst(self, inst):
+        """
+        Region-level copy of an MNE Raw, Epochs or Evoked.
+
+        Equivalent to mne.channels.combine_channels with one group per region.
+
+        Parameters
+        ----------
+        inst : mne.io.Raw | mne.Epochs | mne.Evoked
+            Instance whose channels are ``ch_names`` (in order).
+
+        Returns
+        -------
+        Same type as ``inst``
+            One channel per region.
+        """
+        import mne
+
+        inst = inst.copy().pick(self.ch_names)
+        info = mne.create_info(self.region_names, inst.info['sfreq'], ch_types='eeg')
+        if isinstance(inst, mne.io.BaseRaw):
+            return mne.io.RawArray(self.apply(inst.get_data(), axis=0), info, first_samp=inst.first_samp,
+                                   verbose=False)
+        if isinstance(inst, mne.Evoked):
+            return mne.EvokedArray(self.apply(inst.data, axis=0), info, tmin=inst.times[0], nave=inst.nave,
+                                   comment=inst.comment, verbose=False)
+        return mne.EpochsArray(self.apply(inst.get_data(), axis=1), info, events=inst.events,
+                               tmin=inst.tmin, event_id=inst.event_id, verbose=False)
+
+    def apply_frame(self, df, channel_column, value_columns=None, keys=()):
+        """
+        Region values from a long per-channel result table.
+
+        Channels missing from a key combination are left out of its region
+        means (as NaN-skipping averages), e.g. event summaries of channels
+        without events.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            One row per channel (and key combination), e.g. event summaries
+            (Channel_Number, Band, ...) or bandpower (Channel, Epoch, ...).
+        channel_column : str
+            Channel labels, or 0-based channel positions for integer columns.
+        value_columns : list of str | None
+            Columns to aggregate. Defaults to all other numeric columns.
+        keys : sequence of str
+            Columns kept as row keys (e.g. 'Band', 'Epoch').
+
+        Returns
+        -------
+        pandas.DataFrame
+            keys..., 'Region', values... with one row per key combination and region.
+        """
+        keys = list(keys)
+        if value_columns is None:
+            value_columns = [c for c in df.select_dtypes('number').columns if c not in [channel_column] + keys]
+        channels = df[channel_column]
+        if pd.api.types.is_integer_dtype(channels):
+            channels = channels.map(dict(enumerate(self.ch_names)))
+        df = df.assign(**{channel_column: channels})
+        index = keys if keys else ['_row']
+        if not keys:
+            df = df.assign(_row=0)
+        frames = []
+        for column in value_columns:
+            wide = df.pivot_table(index=index, columns=channel_column, values=column, aggfunc='first')
+            values = wide.reindex(columns=self.ch_names).to_numpy(dtype=float)
+            present = ~np.isnan(values)
+            total = (self.matrix @ np.where(present, values, 0).T).T
+            if self.weights == 'mean':
+                # Average over the channels present in each row
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    total = total / (self.matrix @ present.T.astype(float)).T
+            frames.append(pd.DataFrame(total, index=wide.index, columns=self.region_names)
+                          .rename_axis(columns='Region').stack(future_stack=True).rename(column))
+        out = pd.concat(frames, axis=1).reset_index()
+        return out.drop(columns='_row') if not keys else out
+
+    def assign_regions(self, df, channel_column):
+        """
+        Rows of a per-event table repeated for each region of their channel.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            Table with one row per event (or any per-channel row).
+        channel_column : str
+            Channel labels, or 0-based channel positions for integer columns.
+
+        Returns
+        -------
+        pandas.DataFrame
+            ``df`` with a 'Region' column; rows of channels outside every
+            region are dropped.
+        """
+        channels = df[channel_column]
+        if not pd.api.types.is_integer_dtype(channels):
+            position = {name: k for k, name in enumerate(self.ch_names)}
+            channels = channels.map(position).fillna(-1).astype(int)
+        membership = self.matrix.T.tocsr()
+        valid = (channels.to_numpy() >= 0) & (channels.to_numpy() < len(self.ch_names))
+        rows = np.flatnonzero(valid)
+        # Region indices of every row from the transposed CSR structure
+        sub = membership[channels.to_numpy()[rows]]
+        repeat = np.diff(sub.indptr)
+        out = df.iloc[np.repeat(rows, repeat)].copy()
+        out.insert(0, 'Region', np.array(self.region_names, dtype=object)[sub.indices])
+        return out.reset_index(drop=True)
+
+# ==============================================================================
+# Cache
+# ==============================================================================
+
+@functools.lru_cache(maxsize=32)
+def _cached_operator(source, by, ch_names, weights):
+    count('roi_operator.miss')
+    if source.lower().endswith('.csv'):
+        regions = regions_from_dict(source, by=by, ch_names=ch_names)
+    else:
+        regions = regions_from_config(source)
+    return RoiOperator(regions, ch_names, weights)
+
+
+def get_roi_operator(source, ch_names, by='region', weights='mean'):
+    """
+    Cached RoiOperator for a region definition and a montage.
+
+    Parameters
+    ----------
+    source : str
+        A chanfiles dictionary CSV (e.g. 'DK_atlas-68_dict.csv') or a
+        <net_name> of cfg_htpEegSystems.xml (e.g. 'EGI128').
+    ch_names : list of str
+        Montage channels, in data order.
+    by : str | tuple of str
+        Dictionary column(s) defining the regions (ignored for nets).
+    weights : 'mean' | 'sum'
+        Average or add the channels of a region.
+
+    Returns
+    -------
+    RoiOperator
+        Shared operator; do not modify.
+    """
+    by = by if isinstance(by, str) else tuple(by)
+    return _cached_operator(source, by, tuple(ch_names), weights)
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+
+    # Hydrocel 128: regions of the net configuration (1-based channel numbers)
+    ch_names = [f"E{k}" for k in range(1, 129)]
+    roi = get_roi_operator('EGI128', ch_names)
+    epochs = rng.standard_normal((80, 128, 1000))
+    print(roi, '->', roi.apply(epochs, axis=1).shape)
+
+    # Same montage grouped by side and region of the channel dictionary
+    roi = get_roi_operator('GSN-HydroCel-129_dict.csv', ch_names, by=('side', 'region'))
+    psd = rng.random((80, 128, 161))
+    print(roi, '->', roi.apply(psd, axis=1).shape, roi.region_names[:4])
+
+    # Per-channel table -> per-region table
+    table = pd.DataFrame({'Channel': np.repeat(ch_names, 2), 'Band': ['Alpha', 'Beta'] * 128,
+                          'Power': rng.random(256)})
+    print(roi.apply_frame(table, 'Channel', keys=['Band']).head())
@@ -0,0 +1,410 @@
+# ==============================================================================
+# Incremental Cohort Aggregation of Per-Subject Results
+# ==============================================================================
+# Cohort tables are built by concatenating the per-file CSVs of the analysis
+# stages (p150/p152/p153/p160/p161 and p020_cli.py), so every new subject means
+# rereading and recomputing the whole cohort.
+#
+# This module keeps a cohort directory with two layers:
+#
+#   subjects/<measure>/<subject>.npz - per-subject partial result: count, mean
+#                                      and sum of squared deviations (M2) of
+#                                      every feature over the subject's epochs
+#   group_<measure>.npz / .csv       - group summary: running mean and variance
+#                                      of the subject means across subjects
+#
+# Mean/M2 triples are merged with the pairwise update of Chan et al. (Welford's
+# algorithm for two partitions), so adding a subject updates the group summary
+# in O(features) without touching the other subjects. A subject whose results
+# changed is first removed from the group with the inverse update and then
+# added again. Input files whose size and modification time are unchanged since
+# the last update are skipped without being read.
+#
+# Measures are recognised from the CSV columns:
+#
+#   bandpower - filename, Channel, Epoch, <bands...>         (p152, p020 bandpower)
+#   psd       - Filename, [Data Source], Method, epoch, freq, <channels...> (p150)
+#   specparam - Filename, Channel, Offset, Exponent, ...     (p020 specparam)
+#   events    - Channel_Number, Filename, <event columns...> (p160/p161, counts)
+#   events_summary - Filename, Channel_Number, Channel, notrials, ... (p163, also sweeps)
+#
+# Event tables only list channels that had events, so a channel without events
+# is missing (not zero) for that subject.
+#
+# Features are labelled 'Channel|Band', 'Method|Channel|freq', ... so subjects
+# with different montages are aligned by label; each feature keeps its own n.
+#
+# Main Functions Used:
+# 1. RunningStats - Mergeable count/mean/M2 per labelled feature.
+# 2. subject_summaries - Per-subject RunningStats from a result CSV.
+# 3. update_cohort - Add new or changed subjects to a cohort directory.
+# 4. load_group - Group summary of one measure as a DataFrame.
+# ==============================================================================
+
+import argparse
+import json
+import os
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+from p010_instrument import count, stage
+
+DEFAULT_COHORT_DIR = os.environ.get('VHTP_COHORT_DIR', 'cohort')
+
+MEASURES = ['bandpower', 'psd', 'specparam', 'events', 'events_summary']
+
+# ==============================================================================
+# Running Statistics
+# ==============================================================================
+
+class RunningStats:
+    """
+    Count, mean and sum of squared deviations (M2) of labelled features.
+
+    Parameters
+    ----------
+    labels : list of str
+        Feature labels.
+    n : array-like
+        Observations per feature.
+    mean : array-like
+        Mean per feature.
+    m2 : array-like
+        Sum of squared deviations from the mean per feature.
+    """
+
+    def __init__(self, labels=(), n=None, mean=None, m2=None):
+        self.labels = [str(label) for label in labels]
+        size = len(self.labels)
+        self.n = np.zeros(size) if n is None else np.asarray(n, dtype=float)
+        self.mean = np.zeros(size) if mean is None else np.asarray(mean, dtype=float)
+        self.m2 = np.zeros(size) if m2 is None else np.asarray(m2, dtype=float)
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Statistics of a table with one row per observation and one column per
+        feature (NaN values are not counted).
+        """
+        values = df.to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        n = valid.sum(axis=0).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, np.nansum(values, axis=0) / n, 0.0)
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        return cls(df.columns, n, mean, m2)
+
+    @classmethod
+    def from_observation(cls, labels, values):
+        """Statistics of a single observation (one value per feature)."""
+        values = np.asarray(values, dtype=float)
+        n = (~np.isnan(values)).astype(float)
+        return cls(labels, n, np.nan_to_num(values), np.zeros(len(values)))
+
+    def _aligned(self, other):
+        """This and other with the union of their labels, in the same order."""
+        index = {label: i for i, label in enumerate(self.labels)}
+        new = [label for label in other.labels if label not in index]
+        labels = self.labels + new
+        pad = np.zeros(len(new))
+        a = (np.concatenate([self.n, pad]), np.concatenate([self.mean, pad]),
+             np.concatenate([self.m2, pad]))
+        for label in new:
+            index[label] = len(index)
+        pos = np.array([index[label] for label in other.labels], dtype=int)
+        b = [np.zeros(len(labels)) for _ in range(3)]
+        for arr, values in zip(b, (other.n, other.mean, other.m2)):
+            arr[pos] = values
+        return labels, a, b
+
+    def merge(self, other):
+        """Statistics of the union of both sets of observations."""
+        labels, (na, ma, m2a), (nb, mb, m2b) = self._aligned(other)
+        n = na + nb
+        delta = mb - ma
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, ma + delta * nb / n, 0.0)
+            m2 = np.where(n > 0, m2a + m2b + delta ** 2 * na * nb / n, 0.0)
+        return RunningStats(labels, n, mean, m2)
+
+    def remove(self, other):
+        """Statistics with the observations of ``other`` taken out again."""
+        labels, (n, mean, m2), (nb, mb, m2b) = self._aligned(other)
+        na = n - nb
+        if np.any(na < 0):
+            raise ValueError("Cannot remove more observations than were merged.")
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ma = np.where(na > 0, (n * mean - nb * mb) / na, 0.0)
+            delta = mb - ma
+            m2a = np.where(na > 0, m2 - m2b - delta ** 2 * na * nb / n, 0.0)
+        # Rounding can leave tiny negative sums of squares
+        return RunningStats(labels, na, ma, np.maximum(m2a, 0.0))
+
+    def variance(self, ddof=1):
+        """Variance per feature (NaN where n <= ddof)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > ddof, self.m2 / (self.n - ddof), np.nan)
+
+    def to_frame(self):
+        """Feature, N, Mean, SD and Variance per feature."""
+        variance = self.variance()
+        return pd.DataFrame({'Feature': self.labels, 'N': self.n.astype(int), 'Mean': self.mean,
+                             'SD': np.sqrt(variance), 'Variance': variance})
+
+    def save(self, fname):
+        """Write to an .npz file (atomically)."""
+        tmp_file = fname[:-len('.npz')] + f".tmp{os.getpid()}.npz"
+        np.savez(tmp_file, labels=np.array(self.labels, dtype=str), n=self.n, mean=self.mean, m2=self.m2)
+        os.replace(tmp_file, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Read from an .npz file written by save."""
+        with np.load(fname) as f:
+            return cls(f['labels'].tolist(), f['n'], f['mean'], f['m2'])
+
+# ==============================================================================
+# Per-Subject Summaries
+# ==============================================================================
+
+def detect_measure(columns):
+    """
+    Measure stored in a result CSV, from its column names.
+
+    Parameters
+    ----------
+    columns : list of str
+        CSV header.
+
+    Returns
+    -------
+    str
+        'bandpower', 'psd', 'specparam', 'events' or 'events_summary'.
+    """
+    columns = set(columns)
+    if 'freq' in columns:
+        return 'psd'
+    if 'Exponent' in columns:
+        return 'specparam'
+    if 'notrials' in columns:
+        return 'events_summary'
+    if 'Channel_Number' in columns:
+        return 'events'
+    if {'Channel', 'Epoch'} <= columns:
+        return 'bandpower'
+    raise ValueError(f"Unrecognised result table with columns {sorted(columns)}.")
+
+
+def _subject_name(filename):
+    return op.splitext(op.basename(str(filename)))[0]
+
+
+def _filename_column(df):
+    return 'filename' if 'filename' in df.columns else 'Filename'
+
+
+def subject_summaries(df, measure=None):
+    """
+    Per-subject RunningStats from one result table.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Rows of one or more subjects, as written by the analysis stages.
+    measure : str | None
+        Measure of the table. Detected from the columns if None.
+
+    Returns
+    -------
+    measure : str
+        Measure of the table.
+    summaries : dict
+        Subject name -> RunningStats over the subject's epochs (a single
+        observation for specparam and the event tables).
+    """
+    measure = detect_measure(df.columns) if measure is None else measure
+    file_col = _filename_column(df)
+    summaries = {}
+    for filename, rows in df.groupby(file_col, sort=False):
+        if measure == 'bandpower':
+            bands = [c for c in rows.columns if c not in (file_col, 'Channel', 'Epoch')]
+            wide = rows.pivot_table(index='Epoch', columns='Channel', values=bands, aggfunc='first')
+            wide.columns = [f"{channel}|{band}" for band, channel in wide.columns]
+            stats = RunningStats.from_frame(wide)
+        elif measure == 'psd':
+            keys = [c for c in ('Data Source', 'Method') if c in rows.columns]
+            id_cols = {file_col, 'condition', 'epoch', 'freq', *keys}
+            channels = [c for c in rows.columns if c not in id_cols]
+            epoch = rows['epoch'] if 'epoch' in rows.columns else 0
+            long = rows.assign(_epoch=epoch).melt(id_vars=keys + ['_epoch', 'freq'], value_vars=channels,
+                                                  var_name='_channel', value_name='_power')
+            long['_feature'] = long[keys + ['_channel']].astype(str).agg('|'.join, axis=1) \
+                + '|' + long['freq'].map('{:g}'.format)
+            wide = long.pivot_table(index='_epoch', columns='_feature', values='_power', aggfunc='first')
+            stats = RunningStats.from_frame(wide)
+        elif measure == 'specparam':
+            params = [c for c in rows.columns if c not in (file_col, 'Channel')]
+            values = rows.set_index('Channel')[params]
+            labels = [f"{channel}|{param}" for channel in values.index for param in params]
+            stats = RunningStats.from_observation(labels, values.to_numpy(dtype=float).ravel())
+        elif measure == 'events':
+            keys = ['Channel_Number'] + (['Band'] if 'Band' in rows.columns else [])
+            counts = rows.groupby(keys).size()
+            labels = ['|'.join(map(str, key if isinstance(key, tuple) else (key,))) + '|Event_Count'
+                      for key in counts.index]
+            stats = RunningStats.from_observation(labels, counts.to_numpy())
+        elif measure == 'events_summary':
+            channel_col = 'Channel' if 'Channel' in rows.columns else 'Channel_Number'
+            keys = [channel_col] + [c for c in ('Band', 'Threshold_FOM') if c in rows.columns]
+            fields = [c for c in rows.columns
+                      if c not in (file_col, 'Channel', 'Channel_Number', 'Band', 'Fmin', 'Fmax', 'Threshold_FOM')]
+            values = rows.set_index(keys)[fields]
+            labels = ['|'.join(map(str, key if isinstance(key, tuple) else (key,))) + f"|{field}"
+                      for key in values.index for field in fields]
+            stats = RunningStats.from_observation(labels, values.to_numpy(dtype=float).ravel())
+        else:
+            raise ValueError(f"Unknown measure '{measure}'; use one of {MEASURES}.")
+        summaries[_subject_name(filename)] = stats
+    return measure, summaries
+
+# ==============================================================================
+# Cohort Directory
+# ==============================================================================
+
+def _manifest_file(cohort_dir):
+    return op.join(cohort_dir, 'manifest.json')
+
+
+def _load_manifest(cohort_dir):
+    if op.exists(_manifest_file(cohort_dir)):
+        with open(_manifest_file(cohort_dir)) as f:
+            return json.load(f)
+    return {'files': {}, 'subjects': {measure: {} for measure in MEASURES}}
+
+
+def _save_manifest(cohort_dir, manifest):
+    tmp_file = _manifest_file(cohort_dir) + f".tmp{os.getpid()}"
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, _manifest_file(cohort_dir))
+
+
+def _fingerprint(path):
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+
+def _subject_mean(stats):
+    """One observation per subject: the subject mean of each feature."""
+    values = np.where(stats.n > 0, stats.mean, np.nan)
+    return RunningStats.from_observation(stats.labels, values)
+
+
+def update_cohort(csv_files, cohort_dir=None, force=False):
+    """
+    Add the subjects of result CSVs to a cohort directory.
+
+    New subjects are merged into the group summary; subjects already in the
+    cohort are replaced (their old contribution is removed first). Files
+    unchanged since the last update are skipped unless ``force`` is set.
+
+    Parameters
+    ----------
+    csv_files : list of str
+        Result CSVs of any measure (one or more subjects each).
+    cohort_dir : str | None
+        Cohort directory. Defaults to $VHTP_COHORT_DIR or ./cohort.
+    force : bool
+        Read every file even if unchanged.
+
+    Returns
+    -------
+    dict
+        Subjects 'added', 'replaced' and files 'skipped', per measure.
+    """
+    cohort_dir = DEFAULT_COHORT_DIR if cohort_dir is None else cohort_dir
+    os.makedirs(cohort_dir, exist_ok=True)
+    manifest = _load_manifest(cohort_dir)
+    report = {'added': [], 'replaced': [], 'skipped': []}
+    groups = {}
+
+    with stage('aggregate', n_files=len(csv_files)) as st:
+        for csv_file in csv_files:
+            key = op.abspath(csv_file)
+            if not force and manifest['files'].get(key) == _fingerprint(csv_file):
+                count('cohort.skip')
+                report['skipped'].append(csv_file)
+                continue
+            measure, summaries = subject_summaries(pd.read_csv(csv_file))
+            if measure not in groups:
+                group_file = op.join(cohort_dir, f"group_{measure}.npz")
+                groups[measure] = RunningStats.load(group_file) if op.exists(group_file) else RunningStats()
+            subject_dir = op.join(cohort_dir, 'subjects', measure)
+            os.makedirs(subject_dir, exist_ok=True)
+
+            for subject, stats in summaries.items():
+                subject_file = op.join(subject_dir, f"{subject}.npz")
+                subjects = manifest['subjects'].setdefault(measure, {})
+                if subject in subjects and op.exists(subject_file):
+                    groups[measure] = groups[measure].remove(_subject_mean(RunningStats.load(subject_file)))
+                    report['replaced'].append(f"{measure}:{subject}")
+                else:
+                    report['added'].append(f"{measure}:{subject}")
+                groups[measure] = groups[measure].merge(_subject_mean(stats))
+                stats.save(subject_file)
+                subjects[subject] = key
+                count('cohort.merge')
+            manifest['files'][key] = _fingerprint(csv_file)
+
+        for measure, group in groups.items():
+            group.save(op.join(cohort_dir, f"group_{measure}.npz"))
+            df = group.to_frame()
+            df.insert(0, 'Measure', measure)
+            df.to_csv(op.join(cohort_dir, f"group_{measure}.csv"), index=False)
+        _save_manifest(cohort_dir, manifest)
+        st.note(n_added=len(report['added']), n_replaced=len(report['replaced']),
+                n_skipped=len(report['skipped']))
+    return report
+
+
+def load_group(measure, cohort_dir=None):
+    """
+    Group summary of one measure.
+
+    Parameters
+    ----------
+    measure : str
+        'bandpower', 'psd', 'specparam', 'events' or 'events_summary'.
+    cohort_dir : str | None
+        Cohort directory. Defaults to $VHTP_COHORT_DIR or ./cohort.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Feature, N (subjects), Mean, SD and Variance across subject means.
+    """
+    cohort_dir = DEFAULT_COHORT_DIR if cohort_dir is None else cohort_dir
+    return RunningStats.load(op.join(cohort_dir, f"group_{measure}.npz")).to_frame()
+
+
+def load_subject(measure, subject, cohort_dir=None):
+    """Per-subject RunningStats (over epochs) of one measure."""
+    cohort_dir = DEFAULT_COHORT_DIR if cohort_dir is None else cohort_dir
+    return RunningStats.load(op.join(cohort_dir, 'subjects', measure, f"{subject}.npz"))
+
+# ==============================================================================
+# Example Usage
+# ==============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incremental cohort aggregation of result CSVs.')
+    parser.add_argument('csv_files', nargs='+', help='result CSVs (bandpower, PSD, specparam, events, event summaries)')
+    parser.add_argument('--cohort-dir', default=DEFAULT_COHORT_DIR)
+    parser.add_argument('--force', action='store_true', help='reread unchanged files')
+    args = parser.parse_args()
+
+    report = update_cohort(args.csv_files, args.cohort_dir, args.force)
+    print(f"{len(report['added'])} subjects added, {len(report['replaced'])} replaced, "
+          f"{len(report['skipped'])} files unchanged")
@@ -0,0 +1,132 @@
+function headerFile = util_htpBridgeExport(EEG, varargin)
+% Description: Export EEG data to a shared buffer for Python analysis
+% ShortTitle: Export EEG Bridge Buffer
+% Category: Utility
+% Tags: Python, Export
+%
+%% Syntax:
+%   headerFile = util_htpBridgeExport( EEG, varargin )
+%
+%% Required Inputs:
+%     EEG [struct]           - EEGLAB Structure
+%
+%% Function Specific Inputs:
+%   'name'      - buffer name (header is <name>.json)
+%                 default: EEG.setname without extension, or 'vhtp_bridge'
+%
+%   'outputdir' - buffer directory
+%                 default: $VHTP_BRIDGE_DIR, /dev/shm if available, tempdir
+%
+%   'arrays'    - struct of additional numeric arrays to export alongside
+%                 EEG.data (one .bin file each)
+%                 default: struct()
+%
+%% Outputs:
+%    headerFile [char]   - path to the buffer header (.json)
+%
+%% Notes:
+%   The buffer is a JSON header plus one raw binary file per array, written
+%   column-major. EEG.data is written with a single fwrite in its native
+%   (nbchan, pnts, trials) layout, the same layout as an EEGLAB .fdt file, and
+%   is memory-mapped on the Python side (p106_matlab_bridge.py) without a
+%   .set round trip. Results come back with util_htpBridgeImport.
+%
+%% Disclaimer:
+%  This file is part of the Cincinnati Visual High Throughput Pipeline
+%
+%  Please see http://github.com/cincibrainlab
+
+defaultName = '';
+defaultOutputDir = '';
+defaultArrays = struct();
+
+ip = inputParser();
+ip.StructExpand = 0;
+addRequired(ip, 'EEG', @isstruct);
+addParameter(ip, 'name', defaultName, @ischar);
+addParameter(ip, 'outputdir', defaultOutputDir, @ischar);
+addParameter(ip, 'arrays', defaultArrays, @isstruct);
+
+parse(ip, EEG, varargin{:});
+
+name = ip.Results.name;
+if isempty(name)
+    [~, name, ~] = fileparts(char(EEG.setname));
+    if isempty(name), name = 'vhtp_bridge'; end
+end
+name = regexprep(name, '[^\w\-]', '_');
+
+outputDir = ip.Results.outputdir;
+if isempty(outputDir)
+    outputDir = bridgeDir();
+end
+if ~exist(outputDir, 'dir'), mkdir(outputDir); end
+
+arrays = ip.Results.arrays;
+arrays.data = EEG.data;
+
+% write arrays first so the header only appears once the data is complete
+spec = struct();
+arrayNames = fieldnames(arrays);
+for i = 1 : numel(arrayNames)
+    key = arrayNames{i};
+    value = arrays.(key);
+    if islogical(value), value = uint8(value); end
+    precision = bridgePrecision(class(value));
+    arrayFile = sprintf('%s_%s.bin', name, key);
+    fid = fopen(fullfile(outputDir, arrayFile), 'w', 'l');
+    if fid == -1
+        error('%s: could not open %s for writing.', mfilename, fullfile(outputDir, arrayFile));
+    end
+    fwrite(fid, value, precision);
+    fclose(fid);
+    spec.(key) = struct('file', arrayFile, 'dtype', precision, ...
+        'shape', size(value), 'order', 'F');
+end
+
+meta = struct();
+meta.srate = EEG.srate;
+meta.xmin = EEG.xmin;
+meta.setname = char(EEG.setname);
+meta.nbchan = EEG.nbchan;
+meta.pnts = EEG.pnts;
+meta.trials = EEG.trials;
+meta.chanlocs = EEG.chanlocs;
+meta.event = EEG.event;
+
+header = struct('format', 'vhtp-buffer', 'version', 1, 'meta', meta, 'arrays', spec);
+
+headerFile = fullfile(outputDir, [name '.json']);
+tmpFile = [headerFile '.tmp'];
+fid = fopen(tmpFile, 'w');
+fprintf(fid, '%s', jsonencode(header));
+fclose(fid);
+movefile(tmpFile, headerFile, 'f');
+
+end
+
+function precision = bridgePrecision(matlabClass)
+    % MATLAB class -> precision name shared by fwrite and numpy
+    switch matlabClass
+        case 'single'
+            precision = 'float32';
+        case 'double'
+            precision = 'float64';
+        case {'int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64'}
+            precision = matlabClass;
+        otherwise
+            error('util_htpBridgeExport: unsupported array class %s.', matlabClass);
+    end
+end
+
+function outputDir = bridgeDir()
+    % same search order as bridge_dir() in p106_matlab_bridge.py
+    outputDir = getenv('VHTP_BRIDGE_DIR');
+    if isempty(outputDir)
+        if exist('/dev/shm', 'dir')
+            outputDir = '/dev/shm';
+        else
+            outputDir = tempdir;
+        end
+    end
+end
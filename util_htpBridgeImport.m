@@ -0,0 +1,113 @@
+function results = util_htpBridgeImport(headerFile, varargin)
+% Description: Import results from a shared Python bridge buffer
+% ShortTitle: Import Bridge Buffer
+% Category: Utility
+% Tags: Python, Import
+%
+%% Syntax:
+%   results = util_htpBridgeImport( headerFile, varargin )
+%
+%% Required Inputs:
+%     headerFile [char]      - path to a buffer header (.json) written by
+%                              util_htpBridgeExport or p106_matlab_bridge.py
+%
+%% Function Specific Inputs:
+%   'delete'    - remove the header and array files after reading
+%                 default: false
+%
+%   'astable'   - convert column dictionaries in the metadata (pandas
+%                 DataFrames on the Python side) to MATLAB tables
+%                 default: true
+%
+%% Outputs:
+%    results [struct]   - one field per array (read with its stored shape and
+%                         class) and one field per metadata entry
+%
+%% Disclaimer:
+%  This file is part of the Cincinnati Visual High Throughput Pipeline
+%
+%  Please see http://github.com/cincibrainlab
+
+defaultDelete = false;
+defaultAsTable = true;
+
+ip = inputParser();
+addRequired(ip, 'headerFile', @(x) ischar(x) || isstring(x));
+addParameter(ip, 'delete', defaultDelete, @islogical);
+addParameter(ip, 'astable', defaultAsTable, @islogical);
+
+parse(ip, headerFile, varargin{:});
+
+headerFile = char(headerFile);
+header = jsondecode(fileread(headerFile));
+if ~isfield(header, 'format') || ~strcmp(header.format, 'vhtp-buffer')
+    error('%s: %s is not a vhtp-buffer header.', mfilename, headerFile);
+end
+bufferDir = fileparts(headerFile);
+
+results = struct();
+
+% metadata first, arrays take precedence on name clashes
+if isfield(header, 'meta') && isstruct(header.meta)
+    metaNames = fieldnames(header.meta);
+    for i = 1 : numel(metaNames)
+        value = header.meta.(metaNames{i});
+        if ip.Results.astable && isColumnStruct(value)
+            value = struct2table(value);
+        end
+        results.(metaNames{i}) = value;
+    end
+end
+
+arrayFiles = {};
+if isfield(header, 'arrays') && isstruct(header.arrays)
+    arrayNames = fieldnames(header.arrays);
+    for i = 1 : numel(arrayNames)
+        spec = header.arrays.(arrayNames{i});
+        shape = reshape(double(spec.shape), 1, []);
+        if isscalar(shape), shape = [shape 1]; end
+        arrayFile = fullfile(bufferDir, spec.file);
+        arrayFiles{end+1} = arrayFile; %#ok<AGROW>
+        if prod(shape) == 0
+            results.(arrayNames{i}) = zeros(shape, matlabClass(spec.dtype));
+            continue;
+        end
+        % single read in column-major order, the layout Python wrote
+        fid = fopen(arrayFile, 'r', 'l');
+        if fid == -1
+            error('%s: array file %s not found.', mfilename, arrayFile);
+        end
+        value = fread(fid, prod(shape), ['*' spec.dtype]);
+        fclose(fid);
+        results.(arrayNames{i}) = reshape(value, shape);
+    end
+end
+
+if ip.Results.delete
+    for i = 1 : numel(arrayFiles)
+        if exist(arrayFiles{i}, 'file'), delete(arrayFiles{i}); end
+    end
+    delete(headerFile);
+end
+
+end
+
+function tf = isColumnStruct(value)
+    % scalar struct whose fields are equal-length columns (a DataFrame)
+    tf = false;
+    if ~isstruct(value) || ~isscalar(value) || isempty(fieldnames(value)), return; end
+    heights = structfun(@(c) size(c, 1), value);
+    columns = structfun(@(c) isvector(c) || isempty(c), value);
+    tf = all(columns) && all(heights == heights(1));
+end
+
+function cls = matlabClass(precision)
+    switch precision
+        case 'float32'
+            cls = 'single';
+        case 'float64'
+            cls = 'double';
+        otherwise
+            cls = precision;
+    end
+end
@@ -0,0 +1,84 @@
+function [results, resultFile] = util_htpBridgeRunPython(EEG, moduleName, functionName, varargin)
+% Description: Run a Python analysis function on EEG data via a shared buffer
+% ShortTitle: Run Python Analysis
+% Category: Utility
+% Tags: Python
+%
+%% Syntax:
+%   [ results, resultFile ] = util_htpBridgeRunPython( EEG, moduleName, functionName, varargin )
+%
+%% Required Inputs:
+%     EEG [struct]           - EEGLAB Structure
+%     moduleName [char]      - Python module (e.g. 'p163_spectral_events')
+%     functionName [char]    - function taking a MemmapEEG as first argument
+%
+%% Function Specific Inputs:
+%   'kwargs'     - struct of keyword arguments passed to the Python function
+%                  default: struct()
+%
+%   'pythonpath' - folder added to the Python path
+%                  default: pymatlabjulia/ChirpSpectralEventsPython
+%
+%   'cleanup'    - delete input and result buffers after import
+%                  default: true
+%
+%% Outputs:
+%    results [struct]    - arrays and metadata returned by the Python function
+%
+%    resultFile [char]   - result buffer header (deleted if cleanup is true)
+%
+%% Notes:
+%   Requires a configured Python environment (util_htpSetupPythonInMatlab).
+%   EEG.data is handed over with util_htpBridgeExport and read on the Python
+%   side by run_bridge() in p106_matlab_bridge.py; no .set file is written.
+%
+%% Disclaimer:
+%  This file is part of the Cincinnati Visual High Throughput Pipeline
+%
+%  Please see http://github.com/cincibrainlab
+
+[scriptDir, ~, ~] = fileparts(mfilename('fullpath'));
+defaultKwargs = struct();
+defaultPythonPath = fullfile(scriptDir, 'pymatlabjulia', 'ChirpSpectralEventsPython');
+defaultCleanup = true;
+
+ip = inputParser();
+ip.StructExpand = 0;
+addRequired(ip, 'EEG', @isstruct);
+addRequired(ip, 'moduleName', @ischar);
+addRequired(ip, 'functionName', @ischar);
+addParameter(ip, 'kwargs', defaultKwargs, @isstruct);
+addParameter(ip, 'pythonpath', defaultPythonPath, @ischar);
+addParameter(ip, 'cleanup', defaultCleanup, @islogical);
+
+parse(ip, EEG, moduleName, functionName, varargin{:});
+
+note = @(msg) fprintf('%s: %s\n', mfilename, msg);
+
+pyPath = ip.Results.pythonpath;
+if count(py.sys.path, pyPath) == 0
+    insert(py.sys.path, int32(0), pyPath);
+end
+
+headerFile = util_htpBridgeExport(EEG);
+note(sprintf('Exported %s', headerFile));
+
+try
+    resultFile = pyrun(["import json", ...
+        "from p106_matlab_bridge import run_bridge", ...
+        "out = run_bridge(header_file, module, function_name, **json.loads(kwargs))"], ...
+        "out", header_file = headerFile, module = moduleName, ...
+        function_name = functionName, kwargs = jsonencode(ip.Results.kwargs));
+    resultFile = char(resultFile);
+catch ME
+    if ip.Results.cleanup, pyrun("from p106_matlab_bridge import remove_buffer; remove_buffer(h)", h = headerFile); end
+    rethrow(ME);
+end
+
+results = util_htpBridgeImport(resultFile, 'delete', ip.Results.cleanup);
+if ip.Results.cleanup
+    pyrun("from p106_matlab_bridge import remove_buffer; remove_buffer(h)", h = headerFile);
+end
+note(sprintf('%s.%s completed', moduleName, functionName));
+
+end